@@ -1,21 +1,35 @@
 #listo solo agregar cositas
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    ApplicationBuilder, CallbackQueryHandler, ContextTypes,
+    ApplicationBuilder, BaseUpdateProcessor, CallbackQueryHandler, ContextTypes,
     CommandHandler, ConversationHandler, MessageHandler, filters
 )
 import csv
+import hashlib
+import io
+import json
 import logging
-# Añade junto a los otros imports al principio del archivo
-import tempfile
+import mimetypes
 import os 
 import uuid
-from collections import defaultdict
-from datetime import datetime
-from types import SimpleNamespace
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime, timedelta
 from pathlib import Path
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 import re  # ya importado en el archivo; si no, esta línea es segura
+import secrets
+import sqlite3
+import sys
+import asyncio
+import bisect
+import contextvars
+import functools
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
 # Configuración de logging
 logging.basicConfig(
@@ -34,23 +48,166 @@ ADMIN_ID = 7006777962
 
 # Archivos de persistencia
 CSV_CLIENTES = 'clientes.csv'
+# Ledger de saldos (backend CSV): cada cambio de saldo es una línea; clientes.csv es la foto
+# compactada y CLIENTES_OFFSET_FILE guarda hasta qué byte del ledger ya está incluido en ella
+SALDOS_LEDGER_FILE = 'movimientos_saldo.csv'
+CLIENTES_OFFSET_FILE = 'clientes.offset'
 STOCK_FILE = 'stock.csv'
+# Diario de cambios de stock (backend CSV): una línea JSON numerada por evento, se aplica sobre
+# STOCK_FILE; la primera fila de la foto (STOCK_MARCA_DIARIO, n) dice hasta qué evento ya incluye
+STOCK_JOURNAL_FILE = 'stock.journal'
+STOCK_MARCA_DIARIO = '#diario'
+COMPACTACION_SEGUNDOS = 300  # cada cuánto se pliegan el diario de stock y el ledger de saldos
 COMPRAS_FILE = 'compras_global.csv' 
+# Índice ID_Compra -> (usuario, fecha, plan, correo) del backend CSV; se reconstruye si falta
+COMPRAS_INDEX_FILE = 'compras_global.idx'
+# Compras particionadas por mes para /ventas (backend CSV): VENTAS_DIR/AAAA-MM.csv + manifiesto
+VENTAS_DIR = 'ventas'
+VENTAS_MANIFEST = 'manifest.json'
+# Contadores de /estadisticas (se guardan cada ESTADISTICAS_GUARDAR_SEGUNDOS)
+ESTADISTICAS_FILE = 'estadisticas.json'
+ESTADISTICAS_GUARDAR_SEGUNDOS = 60
+# /difundir: estado, chats destino y progreso (reanudable tras un reinicio)
+DIFUSION_FILE = 'difusion.json'
+DIFUSION_DESTINOS_FILE = 'difusion_destinos.txt'
+DIFUSION_PROGRESO_FILE = 'difusion_progreso.txt'
+ENVIOS_POR_SEGUNDO = 25  # Telegram permite ~30 mensajes/s en total; el resto queda para los handlers
+DIFUSION_CONCURRENCIA = 10
+DIFUSION_REINTENTOS = 5
+DIFUSION_REPORTE_SEGUNDOS = 10
+# Cola de salida (backend CSV): entregas y avisos pendientes de enviar; sobrevive a reinicios
+SALIDA_FILE = 'salida.journal'
+SALIDA_TRABAJADORES = 4
+SALIDA_REINTENTOS = 8
+SALIDA_ESPERA_MAX = 300  # tope en segundos del backoff entre reintentos
 # Cambiado para persistir combos en CSV compatible con Excel
 COMBOS_FILE = 'combos.csv'
+# Backend de almacenamiento: 'csv' (archivos de arriba) o 'sqlite' (SQLITE_FILE).
+# Para pasar a SQLite: python BotDeTelegram.py migrar-sqlite y luego BOT_STORAGE=sqlite
+STORAGE_BACKEND = os.environ.get("BOT_STORAGE", "csv")
+SQLITE_FILE = 'bot.db'
+# Recepción de updates: 'polling' (run_polling) o 'webhook'. En modo webhook el bot escucha
+# HTTP en WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH (por defecto sólo localhost, para ponerlo
+# detrás de un proxy inverso con HTTPS) y registra en Telegram WEBHOOK_URL, la URL pública
+# completa (https://dominio/ruta) a la que el proxy reenvía. Con WEBHOOK_CERT/WEBHOOK_KEY
+# sirve TLS él mismo. Requiere python-telegram-bot[webhooks].
+MODO_BOT = os.environ.get("BOT_MODO", "polling")
+WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("BOT_WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("BOT_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("BOT_WEBHOOK_PATH", "telegram")
+# Telegram lo manda en cada petición (X-Telegram-Bot-Api-Secret-Token) y se rechaza lo que no
+# lo traiga. Si no se configura se genera uno en cada arranque (setWebhook lo vuelve a registrar);
+# con varias instancias detrás del mismo proxy hay que fijarlo.
+WEBHOOK_SECRET = os.environ.get("BOT_WEBHOOK_SECRET", "")
+WEBHOOK_CERT = os.environ.get("BOT_WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.environ.get("BOT_WEBHOOK_KEY", "")
+WEBHOOK_MAX_CONEXIONES = int(os.environ.get("BOT_WEBHOOK_MAX_CONEXIONES", "40"))  # conexiones simultáneas de Telegram (1-100)
+# Métricas en formato Prometheus: http://METRICAS_HOST:METRICAS_PUERTO/metrics (0 = desactivado)
+METRICAS_HOST = os.environ.get("BOT_METRICAS_HOST", "127.0.0.1")
+METRICAS_PUERTO = int(os.environ.get("BOT_METRICAS_PUERTO", "9464"))
+# Updates que tardan más de UMBRAL_LENTO_MS se anotan (una línea JSON) en UPDATES_LENTOS_FILE
+# con su comando o callback_data y el desglose: Bot API, persistencia y el resto
+UPDATES_LENTOS_FILE = 'updates_lentos.log'
+UMBRAL_LENTO_MS = float(os.environ.get("BOT_UMBRAL_LENTO_MS", "1000"))
 # Añade estas variables de configuración (edítalas con tus datos)
 ADMIN_WHATSAPP = "+529992779422"  # Ej: "+52 844 212 5550" — coloca tu número de WhatsApp aquí
 BANK_ACCOUNT = "722969020048622836 💰 Stp / Mercado Pago 👤 Yobas Vnts"    # Ej: "Banco XYZ - CLABE: 012345678901234567" — coloca los datos bancarios aquí
 MIN_RECARGA = 50.0   # Mínimo de recarga en pesos
+CLIENTES_POR_PAGINA = 25  # página por defecto de /verclientes (se puede cambiar con /verclientes <orden> <tamaño>)
+CLIENTES_POR_PAGINA_MAX = 80  # con IDs de 10 dígitos, más de esto se acerca al límite de 4096 caracteres
+
+# --- Índice de clientes ---
+class Clientes(dict):
+    """Saldos {user_id: saldo} que además mantienen dos órdenes para /verclientes:
+    por ID y por saldo (mayor primero). Cada alta, cambio o baja mueve una sola entrada
+    con bisect, así una página se arma cortando la lista ordenada en vez de recorrer
+    y ordenar todos los clientes."""
+
+    def __init__(self, datos=()):
+        super().__init__()
+        self._por_id = []
+        self._por_saldo = []  # (-saldo, user_id)
+        self.saldo_total = 0.0
+        self.update(datos)
+
+    def _quitar_saldo(self, user_id, saldo):
+        i = bisect.bisect_left(self._por_saldo, (-saldo, user_id))
+        if i < len(self._por_saldo) and self._por_saldo[i] == (-saldo, user_id):
+            del self._por_saldo[i]
+        self.saldo_total -= saldo
+
+    def __setitem__(self, user_id, saldo):
+        if user_id in self:
+            self._quitar_saldo(user_id, dict.__getitem__(self, user_id))
+        else:
+            bisect.insort(self._por_id, user_id)
+        super().__setitem__(user_id, saldo)
+        bisect.insort(self._por_saldo, (-saldo, user_id))
+        self.saldo_total += saldo
+
+    def __delitem__(self, user_id):
+        saldo = dict.__getitem__(self, user_id)
+        super().__delitem__(user_id)
+        self._quitar_saldo(user_id, saldo)
+        i = bisect.bisect_left(self._por_id, user_id)
+        if i < len(self._por_id) and self._por_id[i] == user_id:
+            del self._por_id[i]
+
+    def pop(self, user_id, *default):
+        if user_id in self:
+            saldo = dict.__getitem__(self, user_id)
+            del self[user_id]
+            return saldo
+        if default:
+            return default[0]
+        raise KeyError(user_id)
+
+    def setdefault(self, user_id, saldo=0.0):
+        if user_id not in self:
+            self[user_id] = saldo
+        return dict.__getitem__(self, user_id)
+
+    def update(self, datos=(), **kwargs):
+        for user_id, saldo in dict(datos, **kwargs).items():
+            self[user_id] = saldo
+
+    def clear(self):
+        super().clear()
+        self._por_id, self._por_saldo, self.saldo_total = [], [], 0.0
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): no hay clientes')
+        user_id = next(reversed(self))
+        return user_id, self.pop(user_id)
+
+    def pagina(self, orden, numero, tamano):
+        """[(user_id, saldo)] de la página `numero` (desde 0) según `orden` ('saldo' o 'id')."""
+        inicio = numero * tamano
+        if orden == 'id':
+            ids = self._por_id[inicio:inicio + tamano]
+            return [(user_id, dict.__getitem__(self, user_id)) for user_id in ids]
+        return [(user_id, -neg) for neg, user_id in self._por_saldo[inicio:inicio + tamano]]
+
+    def ordenados(self, orden):
+        """Copia completa en el orden pedido (para exportar desde otro hilo)."""
+        return self.pagina(orden, 0, len(self))
+
 
 
 # Variables globales para el estado
-clientes = {}
+clientes = Clientes()  # {user_id: saldo}, ordenado por ID y por saldo para /verclientes
 tmp_venta = {} # Usado para /addventa
 tmp_reporte = {} # Usado para el flujo de Reporte
 ADMIN_USERNAME = "YobasAdmin" # Nombre de referencia
 ADMIN_PHONE = ""  # Configura aquí tu número, ej: "+52 844 212 5550"
 WELCOME_IMAGE = "welcome_bot.jpg"  # Coloca este archivo en el mismo directorio o cambia el nombre
+# file_id que Telegram devuelve al subir un archivo: se reutilizan en vez de volver a subirlo
+FILE_IDS_FILE = 'file_ids.json'
+# Material adjunto de las cuentas: blobs por sha256 en MATERIAL_DIR + registro correo|perfil -> blob
+MATERIAL_DIR = 'material'
+MATERIAL_REGISTRY_FILE = 'materiales.json'
 # Constante para la garantía
 GARANTIA_DIAS = 25 
 
@@ -71,121 +228,2149 @@ def is_admin(user_id):
     return user_id == ADMIN_ID
 
 
+# --- Capa de almacenamiento (CSV / SQLite) ---
+# Los handlers nunca abren archivos directamente: llaman a cargar_clientes, guardar_saldo,
+# load_stock, persistir_stock, save_combos_csv, log_compra..., que delegan en `storage`.
+# CsvStorage conserva el formato de siempre (el stock, como foto + diario de eventos);
+# SqliteStorage guarda todo en SQLITE_FILE (modo WAL, tablas indexadas) y convierte cada venta en una transacción pequeña.
+
+HISTORIAL_HEADER = ['Fecha de entrega', 'Plan', 'Correo', 'Contraseña', 'Precio', 'ID_Compra']
+COMPRAS_HEADER = ['ID_Compra', 'ID_Usuario', 'Fecha de entrega', 'Plan', 'Correo', 'Contraseña', 'Precio']
+MOVIMIENTOS_HEADER = ['Fecha', 'ID_Usuario', 'Delta', 'Saldo', 'Motivo', 'Actor', 'ID_Compra']
+CSV_ENCODINGS = ["utf-8-sig", "utf-8", "cp1252", "latin-1"]
+
+
+def _leer_csv_tolerante(path: Path):
+    """Generator: intenta abrir path usando varias codificaciones y devuelve (linea, fila)."""
+    for enc in CSV_ENCODINGS:
+        try:
+            with path.open('r', newline='', encoding=enc) as f:
+                filas = list(enumerate(csv.reader(f), start=1))
+        except UnicodeDecodeError as ude:
+            logging.warning(f"_leer_csv_tolerante: fallo decoding {path} with {enc}: {ude}")
+            continue
+        except Exception as e:
+            logging.exception(f"_leer_csv_tolerante: error abriendo {path} con {enc}: {e}")
+            return
+        yield from filas
+        return
+    # último intento: abrir con replacement para evitar excepciones
+    try:
+        with path.open('r', newline='', encoding=CSV_ENCODINGS[-1], errors='replace') as f:
+            logging.warning(f"_leer_csv_tolerante: usando fallback errors='replace' para {path}")
+            yield from enumerate(csv.reader(f), start=1)
+    except Exception as e:
+        logging.exception(f"_leer_csv_tolerante: fallback fallo abriendo {path}: {e}")
+
+
+def _lineas_decodificadas(f):
+    """Líneas de un archivo binario como texto: UTF-8 y, si una línea no lo es, latin-1."""
+    for linea in f:
+        try:
+            yield linea.decode('utf-8')
+        except UnicodeDecodeError:
+            yield linea.decode('latin-1', errors='replace')
+
+
+def _normalizar_historial(header, rows):
+    """Convierte las filas de un historial_{id}.csv (cabeceras variables) en tuplas
+    (fecha, plan, correo, contraseña, precio, id_compra), de a una a medida que se leen."""
+    def _index_of_any(hdr, candidates):
+        if not hdr:
+            return None
+        low = [c.lower().strip() for c in hdr]
+        for cand in candidates:
+            for j, val in enumerate(low):
+                if cand in val:
+                    return j
+        return None
+
+    fecha_idx = _index_of_any(header, ['fecha', 'fecha de entrega', 'date'])
+    plan_idx = _index_of_any(header, ['plan'])
+    correo_idx = _index_of_any(header, ['correo', 'email'])
+    pass_idx = _index_of_any(header, ['contraseña', 'password', 'pass'])
+    precio_idx = _index_of_any(header, ['precio', 'price'])
+    id_idx = _index_of_any(header, ['id_compra', 'id', 'id de compra'])
+
+    # Sin cabecera el archivo está vacío (la primera fila siempre se toma como cabecera)
+    for r in rows:
+        def safe_get(idx):
+            return r[idx].strip() if idx is not None and idx < len(r) else ''
+        yield (
+            safe_get(fecha_idx) or safe_get(1) or safe_get(0),
+            safe_get(plan_idx) or safe_get(2) or '',
+            safe_get(correo_idx) or safe_get(3) or '',
+            safe_get(pass_idx) or safe_get(4) or '',
+            safe_get(precio_idx) or safe_get(5) or '',
+            safe_get(id_idx) or '',
+        )
+
+
+def _con_lock(metodo):
+    """Serializa el método del storage con su RLock (se llama desde varios hilos)."""
+    @functools.wraps(metodo)
+    def envoltura(self, *args, **kwargs):
+        with self._lock:
+            return metodo(self, *args, **kwargs)
+    return envoltura
+
+
+def _linea_csv(fila):
+    """Una fila CSV como texto terminado en '\\n', lista para anexar a un diario."""
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerow(fila)
+    return buf.getvalue()
+
+
+def _clave_stock(fila):
+    """Identidad de una fila de stock: plataforma, tipo, correo, pass y precio."""
+    return tuple(fila[:5])
+
+
+def aplicar_eventos_stock(filas, eventos):
+    """Aplica eventos (op, fila) del diario sobre una lista de filas y devuelve la lista resultante.
+    'add' añade la fila; 'take' trae la fila tal como quedó tras entregar un perfil (si ya no
+    quedan perfiles, o es cuenta completa, se elimina); 'del' elimina la fila.
+    Las filas se identifican como en SQLite: la primera con las mismas 5 columnas."""
+    filas = [list(f) for f in filas]
+    por_clave = defaultdict(list)
+    for fila in filas:
+        por_clave[_clave_stock(fila)].append(fila)
+    borradas = set()
+    for op, fila in eventos:
+        if op == 'add':
+            nueva = list(fila)
+            filas.append(nueva)
+            por_clave[_clave_stock(nueva)].append(nueva)
+            continue
+        candidatas = por_clave.get(_clave_stock(fila))
+        if not candidatas:
+            logging.warning(f"Diario de stock: fila no encontrada para '{op}': {fila[:3]}")
+            continue
+        actual = candidatas[0]
+        if op == 'take' and len(fila) >= 7 and str(fila[5]).isdigit() and int(fila[5]) > 0:
+            actual[5:] = list(fila[5:])
+        else:
+            candidatas.pop(0)
+            borradas.add(id(actual))
+    if borradas:
+        filas = [f for f in filas if id(f) not in borradas]
+    return filas
+
+
+def _plataforma_de_plan(plan):
+    """Plataforma de una compra vieja sin ese dato: los combos registran 'Combo - Plataforma - Plan'."""
+    partes = [p.strip() for p in (plan or "").split(' - ')]
+    return partes[-2] if len(partes) >= 3 else ''
+
+
+def _meses_entre(desde, hasta):
+    """Meses 'AAAA-MM' desde el de `desde` hasta el de `hasta` (fechas 'AAAA-MM-DD...')."""
+    anio, mes = int(desde[:4]), int(desde[5:7])
+    fin = (int(hasta[:4]), int(hasta[5:7]))
+    while (anio, mes) <= fin:
+        yield f"{anio:04d}-{mes:02d}"
+        anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+
+
+def _resumen_vacio():
+    return {'compras': 0, 'items': 0, 'total': 0.0, 'por_plataforma': {}}
+
+
+def _sumar_resumen(resumen, otro):
+    resumen['compras'] += otro['compras']
+    resumen['items'] += otro['items']
+    resumen['total'] += otro['total']
+    for plat, (items, total) in otro['por_plataforma'].items():
+        actual = resumen['por_plataforma'].setdefault(plat, [0, 0.0])
+        actual[0] += items
+        actual[1] += total
+
+
+class ParticionesVentas:
+    """Compras del backend CSV particionadas por mes para los reportes de /ventas.
+
+    Cada compra se añade a VENTAS_DIR/AAAA-MM.csv (fecha, usuario, ID_Compra, plataforma,
+    plan, precio; sin contraseñas). VENTAS_MANIFEST guarda por mes el tamaño en bytes,
+    las fechas mínima/máxima y los totales por plataforma, así un mes que cae entero
+    dentro del rango pedido no se lee. El manifiesto sólo se reescribe cuando aparece un mes
+    nuevo; al cargar, el mes cuyo tamaño no coincide (el mes en curso, que siguió creciendo)
+    se vuelve a resumir.
+    La primera vez se construye a partir de compras_global.csv."""
+
+    COLUMNAS = ['Fecha', 'ID_Usuario', 'ID_Compra', 'Plataforma', 'Plan', 'Precio']
+
+    def __init__(self, origen, carpeta=None):
+        self.origen = origen  # CsvStorage, para la construcción inicial
+        self.carpeta = Path(carpeta or VENTAS_DIR)
+        self._manifiesto = None
+        self._ultimo_id = None
+
+    def _ruta(self, mes):
+        return self.carpeta / f"{mes}.csv"
+
+    def cargar(self):
+        if self._manifiesto is not None:
+            return self._manifiesto
+        manifiesto_path = self.carpeta / VENTAS_MANIFEST
+        if not self.carpeta.exists():
+            return self._construir()
+        try:
+            with manifiesto_path.open('r', encoding='utf-8') as f:
+                self._manifiesto = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._manifiesto = {}
+        cambios = False
+        for mes in [m for m in self._manifiesto if not self._ruta(m).exists()]:
+            del self._manifiesto[mes]  # mes anotado cuya primera venta no llegó al disco
+            cambios = True
+        for ruta in self.carpeta.glob('*.csv'):
+            mes = ruta.stem
+            info = self._manifiesto.get(mes)
+            if info is None or info.get('bytes') != ruta.stat().st_size:
+                self._manifiesto[mes] = self._resumir_mes(mes)
+                cambios = True
+        if cambios:
+            self._guardar_manifiesto()
+        return self._manifiesto
+
+    def _construir(self):
+        self.carpeta.mkdir(exist_ok=True)
+        por_mes = defaultdict(list)
+        for row in self.origen.iterar_compras_global(incluir_script_dir=False):
+            row = list(row) + [''] * (7 - len(row))
+            fecha = _clave_fecha(row[2])
+            if not fecha:
+                continue
+            por_mes[fecha[:7]].append([fecha, str(row[1]).strip(), _sanitize_id(row[0]),
+                                       _plataforma_de_plan(row[3]), row[3], row[6].strip()])
+        self._manifiesto = {}
+        for mes, filas in por_mes.items():
+            filas.sort(key=lambda f: f[0])
+            with self._ruta(mes).open('w', newline='', encoding='utf-8') as f:
+                csv.writer(f, lineterminator='\n').writerows(filas)
+            self._manifiesto[mes] = self._resumir_mes(mes)
+        self._guardar_manifiesto()
+        logging.info(f"Ventas particionadas por mes: {len(por_mes)} meses")
+        return self._manifiesto
+
+    def _filas_mes(self, mes):
+        try:
+            with self._ruta(mes).open('r', newline='', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if len(row) == len(self.COLUMNAS):
+                        yield row
+        except FileNotFoundError:
+            return
+
+    def _resumir(self, filas, desde=None, hasta=None, plataforma=None):
+        resumen = _resumen_vacio()
+        ids = set()
+        fechas = []
+        for fecha, _, id_compra, plat, _, precio in filas:
+            if (desde and fecha < desde) or (hasta and fecha > hasta):
+                continue
+            if plataforma and plat.lower() != plataforma:
+                continue
+            try:
+                precio = float(precio)
+            except ValueError:
+                precio = 0.0
+            ids.add(id_compra)
+            fechas.append(fecha)
+            resumen['items'] += 1
+            resumen['total'] += precio
+            actual = resumen['por_plataforma'].setdefault(plat, [0, 0.0])
+            actual[0] += 1
+            actual[1] += precio
+        resumen['compras'] = len(ids)
+        if fechas:
+            resumen['desde'], resumen['hasta'] = min(fechas), max(fechas)
+        return resumen
+
+    def _resumir_mes(self, mes):
+        resumen = self._resumir(self._filas_mes(mes))
+        resumen['bytes'] = self._ruta(mes).stat().st_size if self._ruta(mes).exists() else 0
+        return resumen
+
+    def _guardar_manifiesto(self):
+        tmp_path = self.carpeta / (VENTAS_MANIFEST + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(self._manifiesto, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.carpeta / VENTAS_MANIFEST)
+
+    def agregar(self, fecha, user_id, id_compra, plataforma, plan, precio):
+        """Añade una fila. Se debe haber llamado a `cargar` antes de escribir la compra en
+        compras_global.csv (si no, la construcción inicial ya la incluiría).
+        La línea se escribe con la transacción del origen; si ésta falla, el manifiesto en
+        memoria se descarta y se vuelve a leer (y resumir lo que no cuadre) desde el disco."""
+        manifiesto = self.cargar()
+        fecha = _clave_fecha(fecha)
+        if not fecha:
+            return
+        mes = fecha[:7]
+        fila = [fecha, str(user_id), _sanitize_id(id_compra), plataforma or '', plan, precio]
+        linea = _linea_csv(fila)
+        mes_nuevo = mes not in manifiesto
+        self.origen._encolar(str(self._ruta(mes)), linea)
+        self.origen._al_escribir(confirmar=self._guardar_manifiesto if mes_nuevo else None,
+                                 deshacer=self._descartar)
+        info = manifiesto.setdefault(mes, _resumen_vacio())
+        nuevo = self._resumir([fila])
+        # Los ítems de un combo se registran seguidos con el mismo ID: es una sola compra
+        if fila[2] == self._ultimo_id:
+            nuevo['compras'] = 0
+        self._ultimo_id = fila[2]
+        _sumar_resumen(info, nuevo)
+        info['desde'] = min(info.get('desde') or fecha, fecha)
+        info['hasta'] = max(info.get('hasta') or fecha, fecha)
+        info['bytes'] = info.get('bytes', 0) + len(linea.encode('utf-8'))
+
+    def _descartar(self):
+        self._manifiesto = None
+        self._ultimo_id = None
+
+    def filas(self):
+        for mes in sorted(self.cargar()):
+            yield from self._filas_mes(mes)
+
+    def resumen(self, desde, hasta, plataforma=None):
+        """Totales entre `desde` y `hasta` (texto 'AAAA-MM-DD HH:MM:SS', inclusivos)."""
+        manifiesto = self.cargar()
+        plataforma = (plataforma or '').strip().lower() or None
+        resumen = _resumen_vacio()
+        for mes in _meses_entre(desde, hasta):
+            info = manifiesto.get(mes)
+            if not info or not info.get('items'):
+                continue
+            if not plataforma and desde <= info['desde'] and info['hasta'] <= hasta:
+                _sumar_resumen(resumen, info)  # mes completo dentro del rango: sin leer el archivo
+            else:
+                _sumar_resumen(resumen, self._resumir(self._filas_mes(mes), desde, hasta, plataforma))
+        return resumen
+
+
+class CsvStorage:
+    """Almacenamiento en los CSV de siempre (clientes.csv, stock.csv, combos.csv, compras).
+    El stock se guarda como una foto (STOCK_FILE) más un diario de eventos (STOCK_JOURNAL_FILE)
+    y los saldos como una foto (CSV_CLIENTES) más un ledger de movimientos (SALDOS_LEDGER_FILE):
+    cada cambio añade una línea con fsync y la compactación pliega diario y ledger en fotos nuevas."""
+
+    nombre = 'csv'
+
+    def __init__(self, incluir_script_dir=True):
+        self._lock = threading.RLock()
+        self._nivel = 0
+        # Si también se lee el compras_global.csv de la carpeta del script (instalaciones viejas)
+        self.incluir_script_dir = incluir_script_dir
+        self._pendientes = {}  # archivo -> líneas acumuladas dentro de una transacción
+        self._cabeceras = {}  # archivo -> cabecera que se escribe si el archivo está vacío
+        self._confirmar = []  # acciones en memoria que se aplican cuando las líneas llegaron al disco
+        self._deshacer = []  # acciones en memoria que se revierten si la transacción falla
+        self._indice_compras = None  # se carga la primera vez que se necesita
+        self._ventas = ParticionesVentas(self)
+        self._ultimo_evento_stock = None  # número del último evento del diario de stock
+
+    @contextmanager
+    def transaccion(self):
+        """Sólo se evita que otro hilo se intercale; las líneas que el bloque añade (diario,
+        ledger, compras, índice, particiones de ventas, historiales, cola de salida) se escriben
+        juntas, con un único fsync por archivo, al cerrar la transacción. Si el bloque falla no
+        se escribe ninguna y se revierten los cambios en memoria que las acompañaban; si falla
+        la escritura de un archivo, los ya escritos se recortan a su tamaño anterior.
+        No es atómica frente a un apagado: si el proceso muere a mitad de la escritura quedan
+        en disco los archivos ya escritos y nada marca la venta como incompleta. La cola de
+        salida se escribe la última, así una venta cortada nunca entrega."""
+        with self._lock:
+            self._nivel += 1
+            try:
+                yield
+            except BaseException:
+                self._nivel -= 1
+                if self._nivel == 0:
+                    self._revertir()
+                raise
+            self._nivel -= 1
+            if self._nivel == 0:
+                pendientes, self._pendientes = self._pendientes, {}
+                confirmar, self._confirmar = self._confirmar, []
+                try:
+                    self._escribir(pendientes)
+                except BaseException:
+                    self._revertir()
+                    raise
+                self._deshacer.clear()
+                for accion in confirmar:
+                    accion()
+
+    def _revertir(self):
+        self._pendientes.clear()
+        self._confirmar.clear()
+        deshacer, self._deshacer = self._deshacer, []
+        for accion in reversed(deshacer):
+            accion()
+
+    def _escribir(self, pendientes):
+        """Añade las líneas de una transacción. Si un archivo falla, los ya escritos (y el que
+        falló) vuelven a su tamaño anterior antes de propagar el error."""
+        escritos = []
+        try:
+            # La cola de salida va al final: una entrega sólo llega al disco
+            # cuando el resto de la venta ya está escrito
+            for path in sorted(pendientes, key=lambda path: path == SALIDA_FILE):
+                escritos.append((path, os.path.getsize(path) if os.path.exists(path) else 0))
+                self._anexar(path, pendientes[path])
+        except BaseException:
+            for path, tamano in reversed(escritos):
+                try:
+                    self._recortar(path, tamano)
+                except OSError as e:
+                    logging.error(f"No se pudo recortar {path} a {tamano} bytes tras un fallo de escritura: {e}")
+            raise
+
+    @staticmethod
+    def _recortar(path, tamano):
+        try:
+            with open(path, 'r+b') as f:
+                f.truncate(tamano)
+                f.flush()
+                os.fsync(f.fileno())
+        except FileNotFoundError:
+            pass
+
+    def _anexar(self, path, lineas):
+        """Añade líneas al final de un archivo y espera a que lleguen al disco."""
+        with open(path, 'a', encoding='utf-8', newline='') as f:
+            cabecera = self._cabeceras.get(path)
+            if cabecera and f.tell() == 0:
+                lineas = [_linea_csv(cabecera)] + list(lineas)
+            f.write(''.join(lineas))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _encolar(self, path, linea, cabecera=None):
+        if cabecera:
+            self._cabeceras[path] = cabecera
+        if self._nivel > 0:
+            self._pendientes.setdefault(path, []).append(linea)
+        else:
+            self._anexar(path, [linea])
+
+    @_con_lock
+    def al_confirmar(self, accion):
+        """Corre `accion` cuando la transacción en curso llegó al disco (ahora mismo si no hay una)."""
+        self._al_escribir(confirmar=accion)
+
+    def _al_escribir(self, confirmar=None, deshacer=None):
+        """Liga cambios en memoria a las líneas encoladas: `confirmar` corre cuando llegaron al
+        disco y `deshacer` si la transacción falla. Fuera de una transacción ya están escritas."""
+        if self._nivel == 0:
+            if confirmar:
+                confirmar()
+            return
+        if confirmar:
+            self._confirmar.append(confirmar)
+        if deshacer:
+            self._deshacer.append(deshacer)
+
+    # Clientes
+    def _leer_foto_clientes(self):
+        clientes = {}
+        try:
+            with open(CSV_CLIENTES, 'r') as f:
+                reader = csv.reader(f)
+                for row in reader:
+                    if len(row) == 2:
+                        try:
+                            clientes[int(row[0])] = float(row[1])
+                        except ValueError as e:
+                            logging.error(f"Error al parsear fila en {CSV_CLIENTES}: {row}. Error: {e}")
+        except FileNotFoundError:
+            logging.warning(f"{CSV_CLIENTES} no existe. Se creará al guardar.")
+        except Exception as e:
+            logging.error(f"Error desconocido al cargar clientes: {e}")
+        return clientes
+
+    def _leer_movimientos(self, desde=0):
+        """Filas del ledger a partir del byte `desde`. Ignora la cabecera y una última línea
+        sin salto de línea (escritura cortada por un apagado)."""
+        try:
+            with open(SALDOS_LEDGER_FILE, 'rb') as f:
+                f.seek(desde)
+                datos = f.read()
+        except FileNotFoundError:
+            return []
+        texto = datos.decode('utf-8', errors='replace')
+        if texto and not texto.endswith('\n'):
+            texto = texto[:texto.rfind('\n') + 1]
+        return [row for row in csv.reader(io.StringIO(texto))
+                if len(row) == len(MOVIMIENTOS_HEADER) and row[0] != MOVIMIENTOS_HEADER[0]]
+
+    def _offset_foto_clientes(self):
+        try:
+            with open(CLIENTES_OFFSET_FILE, 'r') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _estado_saldos(self):
+        """Saldos en disco (foto + movimientos posteriores) y cuántos movimientos se aplicaron.
+        Cada movimiento trae el saldo resultante, así que repetir uno ya incluido en la foto
+        no cambia nada."""
+        clientes = self._leer_foto_clientes()
+        movimientos = self._leer_movimientos(self._offset_foto_clientes())
+        for row in movimientos:
+            try:
+                user_id = int(row[1])
+                if row[3] == '':
+                    clientes.pop(user_id, None)  # baja
+                else:
+                    clientes[user_id] = float(row[3])
+            except ValueError:
+                logging.error(f"{SALDOS_LEDGER_FILE}: movimiento inválido ignorado: {row}")
+        return clientes, len(movimientos)
+
+    @_con_lock
+    def cargar_clientes(self):
+        return self._estado_saldos()[0]
+
+    @_con_lock
+    def guardar_clientes(self, clientes):
+        """Escribe una foto completa de saldos; el ledger escrito hasta ahora queda incluido en ella."""
+        items = list(clientes.items())  # copia atómica bajo el GIL
+        try:
+            offset = os.path.getsize(SALDOS_LEDGER_FILE)
+        except OSError:
+            offset = 0
+        tmp_path = CSV_CLIENTES + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            for user, saldo in items:
+                writer.writerow([user, f"{saldo:.2f}"])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, CSV_CLIENTES)
+        # Si el proceso muere antes de esto, se vuelven a aplicar movimientos ya incluidos: inocuo
+        with open(CLIENTES_OFFSET_FILE + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.replace(CLIENTES_OFFSET_FILE + '.tmp', CLIENTES_OFFSET_FILE)
+
+    @_con_lock
+    def registrar_movimiento_saldo(self, movimiento):
+        self._encolar(SALDOS_LEDGER_FILE, _linea_csv(movimiento), MOVIMIENTOS_HEADER)
+
+    @_con_lock
+    def compactar_saldos(self):
+        """Pliega el ledger en una foto nueva de CSV_CLIENTES (desde disco, como el stock).
+        Devuelve cuántos movimientos se plegaron; el ledger no se borra: es el registro de auditoría."""
+        clientes, n = self._estado_saldos()
+        if n:
+            self.guardar_clientes(clientes)
+        return n
+
+    def movimientos_usuario(self, user_id, limite=20):
+        """Últimos `limite` movimientos del usuario, del más viejo al más nuevo."""
+        uid = str(user_id)
+        return [row for row in self._leer_movimientos() if row[1] == uid][-limite:]
+
+    # Stock
+    def _leer_foto_stock(self):
+        """Filas de la foto y el número del último evento del diario incluido en ella
+        (0 si la foto no lo dice: una escrita a mano o por una versión anterior)."""
+        stock_data = []
+        incluido = 0
+        try:
+            with open(STOCK_FILE, 'r') as f:
+                reader = csv.reader(f)
+                for row in reader:
+                    if row and row[0] == STOCK_MARCA_DIARIO:
+                        try:
+                            incluido = int(row[1])
+                        except (IndexError, ValueError):
+                            logging.warning(f"{STOCK_FILE}: marca del diario ilegible ignorada: {row}")
+                        continue
+                    # Normalizar espacios en cada campo
+                    if row:
+                        stock_data.append([c.strip() for c in row])
+        except FileNotFoundError:
+            logging.warning(f"{STOCK_FILE} no existe.")
+        except Exception as e:
+            logging.error(f"Error al cargar stock: {e}")
+        return stock_data, incluido
+
+    def _leer_diario(self, incluido=0):
+        """Eventos (op, fila) posteriores al evento `incluido` y el número del último evento
+        del diario. Los eventos sin número (diario de una versión anterior) se aplican siempre."""
+        eventos = []
+        ultimo = incluido
+        try:
+            with open(STOCK_JOURNAL_FILE, 'r', encoding='utf-8') as f:
+                for n, linea in enumerate(f, 1):
+                    if not linea.strip():
+                        continue
+                    try:
+                        evento = json.loads(linea)
+                        numero = evento.get('n')
+                        if numero is not None:
+                            ultimo = max(ultimo, numero)
+                            if numero <= incluido:
+                                continue  # ya está en la foto (apagado entre la foto y vaciar el diario)
+                        eventos.append((evento['op'], evento['fila']))
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        # Una línea cortada por un apagado a mitad de escritura: se ignora
+                        logging.warning(f"{STOCK_JOURNAL_FILE}: línea {n} ilegible ignorada ({e})")
+        except FileNotFoundError:
+            pass
+        return eventos, ultimo
+
+    def _estado_stock(self):
+        filas, incluido = self._leer_foto_stock()
+        eventos, self._ultimo_evento_stock = self._leer_diario(incluido)
+        return filas, eventos
+
+    @_con_lock
+    def load_stock(self):
+        return aplicar_eventos_stock(*self._estado_stock())
+
+    @_con_lock
+    def save_stock(self, stock_list):
+        """Escribe una foto completa del stock y vacía el diario. La foto lleva el número del
+        último evento registrado: si el proceso muere antes de vaciar el diario, al cargar
+        se saltan los eventos que ya incluye."""
+        filas = list(stock_list)  # copia atómica bajo el GIL; admite cualquier iterable de filas
+        if self._ultimo_evento_stock is None:
+            self._estado_stock()
+        tmp_path = STOCK_FILE + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([STOCK_MARCA_DIARIO, self._ultimo_evento_stock])
+            writer.writerows(filas)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, STOCK_FILE)
+        with open(STOCK_JOURNAL_FILE, 'w', encoding='utf-8'):
+            pass
+
+    @_con_lock
+    def registrar_stock(self, op, fila):
+        if self._ultimo_evento_stock is None:
+            self._estado_stock()
+        self._ultimo_evento_stock += 1  # si la transacción falla queda un hueco en la numeración: inocuo
+        evento = {'n': self._ultimo_evento_stock, 'op': op, 'fila': list(fila)}
+        self._encolar(STOCK_JOURNAL_FILE, json.dumps(evento, ensure_ascii=False) + '\n')
+
+    @_con_lock
+    def compactar_stock(self):
+        """Pliega el diario en una foto nueva de STOCK_FILE. Devuelve cuántos eventos se plegaron.
+        Parte de lo que hay en disco (no de la memoria), así la foto nunca incluye
+        cambios que aún no se hayan registrado."""
+        filas, eventos = self._estado_stock()
+        if not eventos:
+            return 0
+        self.save_stock(aplicar_eventos_stock(filas, eventos))
+        return len(eventos)
+
+    # Cola de salida
+    def _leer_salida(self):
+        """Mensajes pendientes {id: mensaje} en orden de llegada y cuántas líneas tiene el diario."""
+        pendientes, n = {}, 0
+        try:
+            with open(SALIDA_FILE, 'r', encoding='utf-8') as f:
+                for n, linea in enumerate(f, 1):
+                    if not linea.strip():
+                        continue
+                    try:
+                        evento = json.loads(linea)
+                        if evento['op'] == 'nuevo':
+                            pendientes[evento['msg']['id']] = evento['msg']
+                        else:
+                            pendientes.pop(evento['id'], None)
+                    except (ValueError, KeyError) as e:
+                        logging.warning(f"{SALIDA_FILE}: línea {n} ilegible ignorada ({e})")
+        except FileNotFoundError:
+            pass
+        return pendientes, n
+
+    @_con_lock
+    def encolar_salida(self, mensajes):
+        with self.transaccion():
+            for mensaje in mensajes:
+                self._encolar(SALIDA_FILE, json.dumps({'op': 'nuevo', 'msg': mensaje}, ensure_ascii=False) + '\n')
+
+    @_con_lock
+    def cerrar_salida(self, id_mensaje, resultado):
+        self._encolar(SALIDA_FILE, json.dumps({'op': 'fin', 'id': id_mensaje, 'resultado': resultado}) + '\n')
+
+    @_con_lock
+    def salida_pendiente(self):
+        return list(self._leer_salida()[0].values())
+
+    @_con_lock
+    def compactar_salida(self):
+        """Reescribe el diario de salida sólo con los mensajes pendientes. Devuelve cuántas líneas quitó."""
+        pendientes, n = self._leer_salida()
+        if n <= len(pendientes):
+            return 0
+        tmp_path = SALIDA_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps({'op': 'nuevo', 'msg': m}, ensure_ascii=False) + '\n' for m in pendientes.values())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, SALIDA_FILE)
+        return n - len(pendientes)
+
+    # Combos
+    def cargar_combos(self):
+        combos = []
+        if not os.path.exists(COMBOS_FILE):
+            return combos
+        with open(COMBOS_FILE, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                try:
+                    plataformas_str = (row.get('plataformas') or '').strip()
+                    combos.append({
+                        'titulo': (row.get('titulo') or '').strip(),
+                        'subnombre': (row.get('subnombre') or '').strip(),
+                        'precio': float((row.get('precio') or '0').strip() or 0),
+                        'plataformas': [p for p in plataformas_str.split('|') if p]
+                    })
+                except Exception as e:
+                    logging.exception(f"Fila combos inválida en {COMBOS_FILE}: {row} - {e}")
+        return combos
+
+    @_con_lock
+    def guardar_combos(self, combos):
+        combos = combos[:]
+        with open(COMBOS_FILE, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            # Cabecera para que Excel lo abra bien
+            writer.writerow(['titulo', 'subnombre', 'precio', 'plataformas'])
+            for c in combos:
+                plataformas = c.get('plataformas', []) or []
+                # Reemplazar '|' dentro de nombres por espacio para evitar colisiones
+                plataformas_str = '|'.join([p.replace('|', ' ') for p in plataformas])
+                writer.writerow([c.get('titulo', ''), c.get('subnombre', ''), f"{float(c.get('precio', 0.0)):.2f}", plataformas_str])
+
+    # Compras
+    @_con_lock
+    def registrar_compra_global(self, fila, plataforma=''):
+        # Índice y particiones se cargan (o construyen desde el CSV) antes de añadir la fila
+        indice = self._indice()
+        self._ventas.cargar()
+        self._encolar(COMPRAS_FILE, _linea_csv(fila), COMPRAS_HEADER)
+        # El índice se escribe después de la compra: si el proceso muere entre ambas
+        # escrituras, el índice queda más viejo que el CSV y se reconstruye al arrancar
+        id_compra, user_id, fecha, plan, correo = fila[:5]
+        entrada = self._agregar_al_indice(indice, id_compra, user_id, fecha, plan, correo)
+        if entrada:
+            self._encolar(COMPRAS_INDEX_FILE, _linea_csv(entrada))
+            self._al_escribir(deshacer=lambda: indice.pop(entrada[0], None))
+        self._ventas.agregar(fecha, user_id, id_compra, plataforma, plan, fila[6])
+
+    @_con_lock
+    def resumen_ventas(self, desde, hasta, plataforma=None):
+        return self._ventas.resumen(desde, hasta, plataforma)
+
+    @_con_lock
+    def filas_ventas(self):
+        """Todas las ventas como filas de ParticionesVentas.COLUMNAS, en orden de registro."""
+        return list(self._ventas.filas())
+
+    @_con_lock
+    def total_ventas(self):
+        """Cuántas filas de venta hay registradas (desde el manifiesto, sin leer las particiones)."""
+        return sum(info.get('items', 0) for info in self._ventas.cargar().values())
+
+    @staticmethod
+    def _agregar_al_indice(indice, id_compra, user_id, fecha, plan, correo):
+        """Añade la compra al dict si su ID aún no estaba. Devuelve la fila del índice o None."""
+        id_clean = _sanitize_id(id_compra)
+        if not id_clean or id_clean in indice:
+            return None
+        try:
+            user_id = int(str(user_id).strip())
+        except ValueError:
+            return None
+        indice[id_clean] = (user_id, fecha, plan, correo)
+        return [id_clean, user_id, fecha, plan, correo]
+
+    def _indice(self):
+        """Índice ID_Compra -> (usuario, fecha, plan, correo); lo carga o reconstruye una vez."""
+        if self._indice_compras is None:
+            with self._lock:
+                if self._indice_compras is None:
+                    self._indice_compras = self._cargar_indice_compras()
+        return self._indice_compras
+
+    def _cargar_indice_compras(self):
+        idx_path = Path(COMPRAS_INDEX_FILE)
+        compras_path = Path(COMPRAS_FILE)
+        vigente = idx_path.exists() and (
+            not compras_path.exists() or idx_path.stat().st_mtime >= compras_path.stat().st_mtime)
+        if vigente:
+            indice = {}
+            with idx_path.open('r', newline='', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if len(row) == 5:
+                        self._agregar_al_indice(indice, *row)
+            logging.info(f"Índice de compras cargado: {len(indice)} IDs")
+            return indice
+        return self.reconstruir_indice_compras()
+
+    @_con_lock
+    def reconstruir_indice_compras(self):
+        """Reconstruye COMPRAS_INDEX_FILE desde compras_global.csv y los historial_{id}.csv."""
+        indice = {}
+        filas = []
+        for row in self.iterar_compras_global():
+            row = list(row) + [''] * (5 - len(row))
+            entrada = self._agregar_al_indice(indice, row[0], row[1], row[2].strip(), row[3], row[4])
+            if entrada:
+                filas.append(entrada)
+        # Compras que sólo quedaron en el historial del usuario
+        for p in Path('.').glob('historial_*.csv'):
+            user_id = p.stem[len('historial_'):]
+            if not user_id.isdigit():
+                continue
+            for fecha, plan, correo, _, _, id_compra in self.historial_usuario(int(user_id)) or []:
+                entrada = self._agregar_al_indice(indice, id_compra, user_id, fecha, plan, correo)
+                if entrada:
+                    filas.append(entrada)
+        tmp_path = COMPRAS_INDEX_FILE + '.tmp'
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(filas)
+        os.replace(tmp_path, COMPRAS_INDEX_FILE)
+        self._indice_compras = indice
+        logging.info(f"Índice de compras reconstruido: {len(indice)} IDs")
+        return indice
+
+    @_con_lock
+    def registrar_historial(self, user_id, fila):
+        self._encolar(f'historial_{user_id}.csv', _linea_csv(fila), HISTORIAL_HEADER)
+
+    def historial_usuario(self, user_id):
+        """Filas normalizadas del historial del usuario (un iterador que lee el archivo de a
+        una línea), o None si no tiene historial."""
+        historial_path = Path(f'historial_{user_id}.csv')
+        if not historial_path.exists() or historial_path.stat().st_size == 0:
+            return None
+        return self._leer_historial(historial_path)
+
+    @staticmethod
+    def _leer_historial(historial_path):
+        with historial_path.open('rb') as f:
+            reader = csv.reader(_lineas_decodificadas(f))
+            header = next(reader, None)
+            yield from _normalizar_historial(header, reader)
+
+    def iterar_compras_global(self, incluir_script_dir=None):
+        """Recorre compras_global.csv (CWD y, salvo incluir_script_dir=False, carpeta del
+        script) y devuelve filas sin cabecera. Por defecto según `self.incluir_script_dir`."""
+        rutas = [Path(COMPRAS_FILE)]
+        if self.incluir_script_dir if incluir_script_dir is None else incluir_script_dir:
+            rutas.append(Path(__file__).resolve().parent / COMPRAS_FILE)
+        vistos = set()
+        for p in rutas:
+            try:
+                if not p.exists() or p.resolve() in vistos:
+                    continue
+                vistos.add(p.resolve())
+                for i, row in _leer_csv_tolerante(p):
+                    if not row:
+                        continue
+                    if i == 1 and (row[0] or "").strip().upper().startswith("ID"):
+                        continue
+                    yield row
+            except Exception as e:
+                logging.exception(f"iterar_compras_global: error leyendo {p}: {e}")
+
+    def buscar_compra(self, id_clean):
+        """(usuario, fecha, plan, correo) de la compra, o None. Consulta sólo el índice."""
+        return self._indice().get(id_clean)
+
+    def compra_pertenece(self, user_id, id_clean):
+        compra = self.buscar_compra(id_clean)
+        return compra is not None and compra[0] == user_id
+
+
+class SqliteStorage:
+    """Almacenamiento en SQLite (modo WAL). Una venta = una transacción de pocas filas."""
+
+    nombre = 'sqlite'
+
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS clientes (
+            user_id INTEGER PRIMARY KEY,
+            saldo REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stock (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            plataforma TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            correo TEXT NOT NULL,
+            pass TEXT NOT NULL,
+            precio TEXT NOT NULL,
+            perfiles TEXT,
+            perfil_actual TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_stock_cuenta ON stock(correo, plataforma, tipo);
+        CREATE TABLE IF NOT EXISTS combos (
+            posicion INTEGER PRIMARY KEY,
+            titulo TEXT NOT NULL,
+            subnombre TEXT NOT NULL,
+            precio REAL NOT NULL,
+            plataformas TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS compras (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_compra TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            plan TEXT NOT NULL,
+            correo TEXT NOT NULL,
+            pass TEXT NOT NULL,
+            precio TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_compras_id ON compras(id_compra);
+        CREATE INDEX IF NOT EXISTS idx_compras_usuario ON compras(user_id, fecha);
+        CREATE INDEX IF NOT EXISTS idx_compras_fecha ON compras(fecha);
+        CREATE TABLE IF NOT EXISTS movimientos_saldo (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            delta REAL NOT NULL,
+            saldo REAL,
+            motivo TEXT NOT NULL,
+            actor INTEGER,
+            id_compra TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_movimientos_usuario ON movimientos_saldo(user_id, id);
+        CREATE TABLE IF NOT EXISTS salida (
+            id TEXT PRIMARY KEY,
+            datos TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=None):
+        self.path = path or SQLITE_FILE
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.ESQUEMA)
+        columnas = {row[1] for row in self.conn.execute("PRAGMA table_info(compras)")}
+        if 'plataforma' not in columnas:
+            self.conn.execute("ALTER TABLE compras ADD COLUMN plataforma TEXT NOT NULL DEFAULT ''")
+        self._nivel = 0
+        self._confirmar = []  # acciones que corren después del COMMIT
+        # Una sola conexión compartida por los hilos de persistencia
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def transaccion(self):
+        """Agrupa todas las escrituras del bloque en un único COMMIT (admite anidamiento)."""
+        with self._lock:
+            if self._nivel == 0:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._nivel += 1
+            try:
+                yield
+            except BaseException:
+                self._nivel -= 1
+                if self._nivel == 0:
+                    self._confirmar.clear()
+                    self.conn.execute("ROLLBACK")
+                raise
+            self._nivel -= 1
+            if self._nivel == 0:
+                try:
+                    self.conn.execute("COMMIT")
+                except BaseException:
+                    self._confirmar.clear()
+                    raise
+                confirmar, self._confirmar = self._confirmar, []
+                for accion in confirmar:
+                    accion()
+
+    @_con_lock
+    def al_confirmar(self, accion):
+        """Corre `accion` después del COMMIT de la transacción en curso (ahora mismo si no hay una)."""
+        if self._nivel == 0:
+            accion()
+        else:
+            self._confirmar.append(accion)
+
+    # Clientes
+    @_con_lock
+    def cargar_clientes(self):
+        return {uid: saldo for uid, saldo in self.conn.execute("SELECT user_id, saldo FROM clientes")}
+
+    @_con_lock
+    def guardar_clientes(self, clientes):
+        with self.transaccion():
+            self.conn.execute("DELETE FROM clientes")
+            self.conn.executemany("INSERT INTO clientes(user_id, saldo) VALUES (?, ?)",
+                                  [(uid, round(saldo, 2)) for uid, saldo in list(clientes.items())])
+
+    @_con_lock
+    def registrar_movimiento_saldo(self, movimiento):
+        fecha, user_id, delta, saldo, motivo, actor, id_compra = movimiento
+        with self.transaccion():
+            if saldo == '':
+                self.conn.execute("DELETE FROM clientes WHERE user_id = ?", (user_id,))
+            else:
+                self.conn.execute(
+                    "INSERT INTO clientes(user_id, saldo) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET saldo = excluded.saldo",
+                    (user_id, float(saldo)))
+            self.conn.execute(
+                "INSERT INTO movimientos_saldo(fecha, user_id, delta, saldo, motivo, actor, id_compra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fecha, int(user_id), float(delta), float(saldo) if saldo != '' else None, motivo,
+                 int(actor) if str(actor).lstrip('-').isdigit() else None, id_compra))
+
+    def compactar_saldos(self):
+        # La tabla `clientes` ya es la foto; `movimientos_saldo` es sólo auditoría
+        return 0
+
+    @_con_lock
+    def movimientos_usuario(self, user_id, limite=20):
+        rows = self.conn.execute(
+            "SELECT fecha, user_id, delta, saldo, motivo, actor, id_compra FROM movimientos_saldo "
+            "WHERE user_id = ? ORDER BY id DESC LIMIT ?", (user_id, limite)).fetchall()
+        return [[fecha, str(uid), f"{delta:+.2f}", f"{saldo:.2f}" if saldo is not None else '',
+                 motivo, '' if actor is None else str(actor), id_compra]
+                for fecha, uid, delta, saldo, motivo, actor, id_compra in reversed(rows)]
+
+    # Stock
+    @staticmethod
+    def _a_columnas(fila):
+        fila = list(fila) + [''] * (5 - len(fila))
+        perfiles = fila[5] if len(fila) > 5 else None
+        perfil_actual = fila[6] if len(fila) > 6 else None
+        return (fila[0], fila[1], fila[2], fila[3], fila[4], perfiles, perfil_actual)
+
+    @_con_lock
+    def load_stock(self):
+        filas = []
+        for row in self.conn.execute(
+                "SELECT plataforma, tipo, correo, pass, precio, perfiles, perfil_actual FROM stock ORDER BY id"):
+            fila = list(row[:5])
+            if row[5] is not None:
+                fila += [row[5], row[6] if row[6] is not None else "1"]
+            filas.append(fila)
+        return filas
+
+    @_con_lock
+    def save_stock(self, stock_list):
+        with self.transaccion():
+            self.conn.execute("DELETE FROM stock")
+            self.conn.executemany(
+                "INSERT INTO stock(plataforma, tipo, correo, pass, precio, perfiles, perfil_actual) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [self._a_columnas(f) for f in list(stock_list) if len(f) >= 5])
+
+    def _id_fila(self, fila):
+        cur = self.conn.execute(
+            "SELECT id FROM stock WHERE correo = ? AND plataforma = ? AND tipo = ? AND pass = ? AND precio = ? "
+            "ORDER BY id LIMIT 1", tuple(fila[i] for i in (2, 0, 1, 3, 4)))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    @_con_lock
+    def registrar_stock(self, op, fila):
+        if op == 'add':
+            self.conn.execute(
+                "INSERT INTO stock(plataforma, tipo, correo, pass, precio, perfiles, perfil_actual) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._a_columnas(fila))
+            return
+        id_fila = self._id_fila(fila)
+        if id_fila is None:
+            logging.warning(f"SqliteStorage: fila de stock no encontrada para '{op}': {fila[:3]}")
+            return
+        if op == 'take' and len(fila) >= 7 and fila[5].isdigit() and int(fila[5]) > 0:
+            # Quedan perfiles -> sólo cambia el contador
+            self.conn.execute("UPDATE stock SET perfiles = ?, perfil_actual = ? WHERE id = ?",
+                              (fila[5], fila[6], id_fila))
+        else:
+            self.conn.execute("DELETE FROM stock WHERE id = ?", (id_fila,))
+
+    def compactar_stock(self):
+        # SQLite actualiza las filas en su sitio; no hay diario que plegar
+        return 0
+
+    # Cola de salida
+    @_con_lock
+    def encolar_salida(self, mensajes):
+        with self.transaccion():
+            self.conn.executemany("INSERT OR REPLACE INTO salida(id, datos) VALUES (?, ?)",
+                                  [(m['id'], json.dumps(m, ensure_ascii=False)) for m in mensajes])
+
+    @_con_lock
+    def cerrar_salida(self, id_mensaje, resultado):
+        self.conn.execute("DELETE FROM salida WHERE id = ?", (id_mensaje,))
+
+    @_con_lock
+    def salida_pendiente(self):
+        return [json.loads(datos) for (datos,) in self.conn.execute("SELECT datos FROM salida ORDER BY rowid")]
+
+    def compactar_salida(self):
+        # Los mensajes enviados se borran de la tabla al cerrarlos
+        return 0
+
+    # Combos
+    @_con_lock
+    def cargar_combos(self):
+        return [{'titulo': t, 'subnombre': s, 'precio': float(p), 'plataformas': [x for x in plats.split('|') if x]}
+                for t, s, p, plats in self.conn.execute(
+                    "SELECT titulo, subnombre, precio, plataformas FROM combos ORDER BY posicion")]
+
+    @_con_lock
+    def guardar_combos(self, combos):
+        with self.transaccion():
+            self.conn.execute("DELETE FROM combos")
+            self.conn.executemany(
+                "INSERT INTO combos(posicion, titulo, subnombre, precio, plataformas) VALUES (?, ?, ?, ?, ?)",
+                [(i, c.get('titulo', ''), c.get('subnombre', ''), float(c.get('precio', 0.0)),
+                  '|'.join(p.replace('|', ' ') for p in (c.get('plataformas') or [])))
+                 for i, c in enumerate(combos)])
+
+    # Compras
+    @_con_lock
+    def registrar_compra_global(self, fila, plataforma=''):
+        id_compra, user_id, fecha, plan, correo, password, precio = fila
+        self.conn.execute(
+            "INSERT INTO compras(id_compra, user_id, fecha, plan, correo, pass, precio, plataforma) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (id_compra, int(user_id), fecha, plan, correo, password, precio, plataforma or ''))
+
+    @_con_lock
+    def resumen_ventas(self, desde, hasta, plataforma=None):
+        # idx_compras_fecha acota la consulta al rango pedido
+        filtro, params = "fecha BETWEEN ? AND ?", [desde, hasta]
+        if plataforma:
+            filtro += " AND lower(plataforma) = ?"
+            params.append(plataforma.strip().lower())
+        compras, items, total = self.conn.execute(
+            f"SELECT COUNT(DISTINCT id_compra), COUNT(*), COALESCE(SUM(CAST(precio AS REAL)), 0) FROM compras WHERE {filtro}",
+            params).fetchone()
+        por_plataforma = {plat: [n, t] for plat, n, t in self.conn.execute(
+            f"SELECT plataforma, COUNT(*), SUM(CAST(precio AS REAL)) FROM compras WHERE {filtro} GROUP BY plataforma",
+            params)}
+        return {'compras': compras, 'items': items, 'total': total, 'por_plataforma': por_plataforma}
+
+    def registrar_historial(self, user_id, fila):
+        """No hace nada: en SQLite el historial del usuario es una consulta sobre la tabla
+        `compras` (historial_usuario), que log_compra_global llena en la misma venta."""
+
+    @_con_lock
+    def filas_ventas(self):
+        return self.conn.execute(
+            "SELECT fecha, user_id, id_compra, plataforma, plan, precio FROM compras ORDER BY id").fetchall()
+
+    @_con_lock
+    def total_ventas(self):
+        return self.conn.execute("SELECT COUNT(*) FROM compras").fetchone()[0]
+
+    @_con_lock
+    def historial_usuario(self, user_id):
+        rows = self.conn.execute(
+            "SELECT fecha, plan, correo, pass, precio, id_compra FROM compras WHERE user_id = ? ORDER BY fecha, id",
+            (user_id,)).fetchall()
+        return rows or None
+
+    @_con_lock
+    def buscar_compra(self, id_clean):
+        # idx_compras_id ya es el índice por ID_Compra
+        return self.conn.execute("SELECT user_id, fecha, plan, correo FROM compras WHERE id_compra = ? LIMIT 1",
+                                 (id_clean,)).fetchone()
+
+    @_con_lock
+    def compra_pertenece(self, user_id, id_clean):
+        cur = self.conn.execute("SELECT 1 FROM compras WHERE id_compra = ? AND user_id = ? LIMIT 1",
+                                (id_clean, user_id))
+        return cur.fetchone() is not None
+
+    @_con_lock
+    def importar_desde_csv(self, origen):
+        """Copia clientes, stock, combos, compras y la cola de salida desde un CsvStorage en una sola transacción."""
+        clientes_csv = origen.cargar_clientes()
+        movimientos = origen._leer_movimientos()
+        stock_csv = origen.load_stock()
+        combos_csv = origen.cargar_combos()
+        pendientes = origen.salida_pendiente()
+        compras = []
+        for row in origen.iterar_compras_global(incluir_script_dir=False):
+            row = list(row) + [''] * (7 - len(row))
+            try:
+                user_id = int(str(row[1]).strip())
+            except ValueError:
+                logging.warning(f"importar_desde_csv: compra con usuario inválido ignorada: {row}")
+                continue
+            compras.append((_sanitize_id(row[0]), user_id, row[2].strip(), row[3], row[4], row[5], row[6].strip(),
+                            _plataforma_de_plan(row[3])))
+        # Compras que sólo quedaron en el historial del usuario (como en CsvStorage.reconstruir_indice_compras)
+        vistas = {c[0] or (c[1], c[2], c[4]) for c in compras}  # ID_Compra o, sin ID, (usuario, fecha, correo)
+        solo_historial = 0
+        for p in Path('.').glob('historial_*.csv'):
+            user_id = p.stem[len('historial_'):]
+            if not user_id.isdigit():
+                continue
+            user_id = int(user_id)
+            for fecha, plan, correo, password, precio, id_compra in origen.historial_usuario(user_id) or ():
+                id_clean = _sanitize_id(id_compra)
+                clave = id_clean or (user_id, fecha, correo)
+                if clave in vistas:
+                    continue
+                vistas.add(clave)
+                compras.append((id_clean, user_id, fecha, plan, correo, password, precio, _plataforma_de_plan(plan)))
+                solo_historial += 1
+        if solo_historial:
+            logging.info(f"importar_desde_csv: {solo_historial} compras importadas desde historial_*.csv "
+                         f"(no estaban en {COMPRAS_FILE})")
+        with self.transaccion():
+            self.guardar_clientes(clientes_csv)
+            self.save_stock(stock_csv)
+            self.guardar_combos(combos_csv)
+            self.conn.execute("DELETE FROM compras")
+            self.conn.executemany(
+                "INSERT INTO compras(id_compra, user_id, fecha, plan, correo, pass, precio, plataforma) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                compras)
+            self.conn.execute("DELETE FROM movimientos_saldo")
+            self.conn.executemany(
+                "INSERT INTO movimientos_saldo(fecha, user_id, delta, saldo, motivo, actor, id_compra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(m[0], int(m[1]), float(m[2]), float(m[3]) if m[3] != '' else None, m[4],
+                  int(m[5]) if m[5].lstrip('-').isdigit() else None, m[6]) for m in movimientos])
+            self.encolar_salida(pendientes)
+        return {'clientes': len(clientes_csv), 'stock': len(stock_csv), 'combos': len(combos_csv),
+                'compras': len(compras), 'solo_historial': solo_historial, 'movimientos': len(movimientos),
+                'salida': len(pendientes)}
+
+
+def crear_storage(backend=None):
+    """Instancia el backend configurado en STORAGE_BACKEND ('csv' o 'sqlite')."""
+    backend = (backend or STORAGE_BACKEND).strip().lower()
+    if backend == 'sqlite':
+        return SqliteStorage()
+    if backend != 'csv':
+        logging.warning(f"STORAGE_BACKEND desconocido '{backend}', usando CSV.")
+    return CsvStorage()
+
+
+storage = crear_storage()
+
+
+def migrar_csv_a_sqlite():
+    """Importa los CSV actuales a SQLITE_FILE. Uso: python BotDeTelegram.py migrar-sqlite"""
+    destino = storage if isinstance(storage, SqliteStorage) else SqliteStorage()
+    resumen = destino.importar_desde_csv(CsvStorage())
+    logging.info(f"Migración a {destino.path} completada: {resumen}")
+    return resumen
+
+
+# --- Métricas ---
+# Contadores, gauges e histogramas en memoria que un Prometheus local lee de /metrics
+# (formato de texto 0.0.4, sin dependencias). Los handlers se cronometran al registrarlos
+# (`trazar_handlers`) y las funciones de persistencia con el decorador `cronometrado`,
+# por separado: así se ve si el tiempo de una compra se va en el handler o en el disco.
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _etiquetas_texto(etiquetas):
+    if not etiquetas:
+        return ''
+    pares = []
+    for nombre, valor in etiquetas:
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pares.append(f'{nombre}="{valor}"')
+    return '{' + ','.join(pares) + '}'
+
+
+class Metricas:
+    """Se actualiza desde el event loop y desde los hilos de persistencia: cada cambio toma `_lock`.
+    Los gauges se calculan al exportar con las funciones registradas en `gauge`."""
+
+    def __init__(self, buckets=METRICAS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._descripciones = {}  # nombre -> (tipo, ayuda)
+        self._contadores = defaultdict(float)  # (nombre, etiquetas) -> valor
+        self._histogramas = {}  # (nombre, etiquetas) -> [cuenta por bucket..., suma, total]
+        self._gauges = []
+
+    def describir(self, nombre, tipo, ayuda):
+        self._descripciones[nombre] = (tipo, ayuda)
+
+    def contar(self, nombre, cantidad=1, **etiquetas):
+        with self._lock:
+            self._contadores[(nombre, tuple(sorted(etiquetas.items())))] += cantidad
+
+    def observar(self, nombre, segundos, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        i = bisect.bisect_left(self.buckets, segundos)
+        with self._lock:
+            valores = self._histogramas.get(clave)
+            if valores is None:
+                valores = self._histogramas[clave] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                valores[i] += 1
+            valores[-2] += segundos
+            valores[-1] += 1
+
+    def gauge(self, funcion):
+        """funcion() devuelve (nombre, {etiquetas}, valor) por cada serie; se llama en cada exportación."""
+        self._gauges.append(funcion)
+        return funcion
+
+    def exportar(self):
+        series = defaultdict(list)
+        with self._lock:
+            for (nombre, etiquetas), valor in self._contadores.items():
+                series[nombre].append(f"{nombre}{_etiquetas_texto(etiquetas)} {valor:g}")
+            for (nombre, etiquetas), valores in self._histogramas.items():
+                acumulado = 0
+                for limite, cuenta in zip(self.buckets, valores):
+                    acumulado += cuenta
+                    series[nombre].append(f"{nombre}_bucket{_etiquetas_texto(etiquetas + (('le', f'{limite:g}'),))} {acumulado}")
+                series[nombre].append(f"{nombre}_bucket{_etiquetas_texto(etiquetas + (('le', '+Inf'),))} {valores[-1]}")
+                series[nombre].append(f"{nombre}_sum{_etiquetas_texto(etiquetas)} {valores[-2]:.6f}")
+                series[nombre].append(f"{nombre}_count{_etiquetas_texto(etiquetas)} {valores[-1]}")
+        for funcion in self._gauges:
+            try:
+                for nombre, etiquetas, valor in funcion():
+                    series[nombre].append(f"{nombre}{_etiquetas_texto(sorted(etiquetas.items()))} {valor:g}")
+            except Exception as e:
+                logging.exception(f"Métricas: error calculando {funcion.__name__}: {e}")
+        lineas = []
+        for nombre in sorted(series):
+            if nombre in self._descripciones:
+                tipo, ayuda = self._descripciones[nombre]
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} {tipo}")
+            lineas.extend(series[nombre])
+        return '\n'.join(lineas) + '\n'
+
+
+metricas = Metricas()
+metricas.describir('bot_handler_segundos', 'histogram', 'Duración de cada handler de Telegram.')
+metricas.describir('bot_handler_api_segundos', 'histogram', 'Tiempo de cada handler esperando a la Bot API.')
+metricas.describir('bot_handler_persistencia_segundos', 'histogram', 'Tiempo de cada handler en persistencia.')
+metricas.describir('bot_api_llamadas_total', 'counter', 'Llamadas a la Bot API hechas desde cada handler.')
+metricas.describir('bot_persistencia_segundos', 'histogram', 'Duración de cada función de persistencia.')
+metricas.describir('bot_compras_total', 'counter', 'Compras completadas (cuentas sueltas y combos).')
+metricas.describir('bot_stock_agotado_total', 'counter', 'Compras rechazadas porque el stock se agotó antes de entregar.')
+metricas.describir('bot_entregas_fallidas_total', 'counter', 'Mensajes de la cola de salida que no se pudieron entregar.')
+metricas.describir('bot_reportes_total', 'counter', 'Reportes de cuentas enviados al administrador.')
+metricas.describir('bot_recargas_total', 'counter', 'Recargas de saldo hechas por el administrador.')
+metricas.describir('bot_stock_unidades', 'gauge', 'Unidades disponibles por plataforma y categoría.')
+metricas.describir('bot_clientes', 'gauge', 'Clientes registrados.')
+
+
+@metricas.gauge
+def _metricas_de_estado():
+    # Se llama desde el event loop (servidor de /metrics): lee el índice y los clientes sin copiar
+    for plataforma, categorias in stock_index.conteos().items():
+        for categoria, unidades in categorias.items():
+            yield 'bot_stock_unidades', {'plataforma': plataforma, 'categoria': categoria}, unidades
+    yield 'bot_clientes', {}, len(clientes)
+
+
+class Traza:
+    """Desglose del update en curso: llamadas y tiempo en la Bot API y tiempo en persistencia.
+    Vive en `_traza_actual` (contextvar): la ven las llamadas a la API del mismo handler y
+    las funciones que `en_hilo` corre en el pool, que reciben una copia del contexto."""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self._lock = threading.Lock()  # la persistencia suma desde los hilos
+        self.api = defaultdict(lambda: [0, 0.0])  # método -> [llamadas, segundos]
+        self.persistencia = defaultdict(float)  # función -> segundos
+
+    def sumar_api(self, metodo, segundos):
+        with self._lock:
+            self.api[metodo][0] += 1
+            self.api[metodo][1] += segundos
+
+    def sumar_persistencia(self, funcion, segundos):
+        with self._lock:
+            self.persistencia[funcion] += segundos
+
+    @property
+    def api_segundos(self):
+        return sum(segundos for _, segundos in self.api.values())
+
+    @property
+    def api_llamadas(self):
+        return sum(n for n, _ in self.api.values())
+
+    @property
+    def persistencia_segundos(self):
+        return sum(self.persistencia.values())
+
+
+_traza_actual = contextvars.ContextVar('traza_actual', default=None)
+_en_persistencia = contextvars.ContextVar('en_persistencia', default=False)
+
+
+def cronometrado(func):
+    """Decorador: registra la duración de func en bot_persistencia_segundos{funcion=...} y la suma
+    a la traza del update en curso (sólo la llamada más externa: registrar_venta ya incluye
+    su persistir_stock y su log_compra)."""
+    nombre = getattr(func, '__name__', type(func).__name__)
+
+    @functools.wraps(func)
+    def envoltura(*args, **kwargs):
+        externa = not _en_persistencia.get()
+        token = _en_persistencia.set(True)
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            segundos = time.perf_counter() - t0
+            _en_persistencia.reset(token)
+            metricas.observar('bot_persistencia_segundos', segundos, funcion=nombre)
+            traza = _traza_actual.get()
+            if externa and traza is not None:
+                traza.sumar_persistencia(nombre, segundos)
+    envoltura._cronometrado = True
+    return envoltura
+
+
+class RequestTrazado(HTTPXRequest):
+    """HTTPXRequest que suma cada llamada a la Bot API (método y duración) a la traza del update."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            traza = _traza_actual.get()
+            if traza is not None:
+                traza.sumar_api(url.rsplit('/', 1)[-1], time.perf_counter() - t0)
+
+
+def _entrada_update(update):
+    """Comando o callback_data que disparó el update (el texto libre no se anota: puede ser una contraseña)."""
+    query = getattr(update, 'callback_query', None)
+    if query is not None:
+        return f"callback:{query.data}"
+    mensaje = getattr(update, 'effective_message', None)
+    texto = getattr(mensaje, 'text', None) or ''
+    if texto.startswith('/'):
+        return texto.split()[0]
+    return 'foto' if getattr(mensaje, 'photo', None) else 'mensaje'
+
+
+_log_lentos = None
+
+
+def _registrar_update_lento(update, handler, traza, total):
+    global _log_lentos
+    if _log_lentos is None:
+        _log_lentos = logging.getLogger('updates_lentos')
+        _log_lentos.propagate = False
+        _log_lentos.addHandler(logging.FileHandler(UPDATES_LENTOS_FILE, encoding='utf-8'))
+    usuario = getattr(update, 'effective_user', None)
+    api, persistencia = traza.api_segundos, traza.persistencia_segundos
+    _log_lentos.warning(json.dumps({
+        'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'usuario': usuario.id if usuario else None,
+        'handler': handler,
+        'entrada': _entrada_update(update),
+        'total_ms': round(total * 1000, 1),
+        'api_ms': round(api * 1000, 1),
+        'api_llamadas': traza.api_llamadas,
+        'persistencia_ms': round(persistencia * 1000, 1),
+        'resto_ms': round((total - api - persistencia) * 1000, 1),
+        'api': {metodo: [n, round(seg * 1000, 1)] for metodo, (n, seg) in traza.api.items()},
+        'persistencia': {funcion: round(seg * 1000, 1) for funcion, seg in traza.persistencia.items()},
+    }, ensure_ascii=False))
+
+
+def trazado(callback):
+    """Decorador de handlers: abre una Traza para el update, mide el tiempo total, el de la
+    Bot API y el de persistencia (bot_handler_*), y anota en UPDATES_LENTOS_FILE los que
+    pasan de UMBRAL_LENTO_MS."""
+    if getattr(callback, '_trazado', False):
+        return callback
+
+    @functools.wraps(callback)
+    async def envoltura(update, context):
+        traza = Traza()
+        token = _traza_actual.set(traza)
+        try:
+            return await callback(update, context)
+        finally:
+            _traza_actual.reset(token)
+            total = time.perf_counter() - traza.inicio
+            nombre = callback.__name__
+            metricas.observar('bot_handler_segundos', total, handler=nombre)
+            metricas.observar('bot_handler_api_segundos', traza.api_segundos, handler=nombre)
+            metricas.observar('bot_handler_persistencia_segundos', traza.persistencia_segundos, handler=nombre)
+            metricas.contar('bot_api_llamadas_total', traza.api_llamadas, handler=nombre)
+            if total * 1000 >= UMBRAL_LENTO_MS:
+                try:
+                    _registrar_update_lento(update, nombre, traza, total)
+                except Exception as e:
+                    logging.exception(f"No se pudo anotar el update lento de {nombre}: {e}")
+    envoltura._trazado = True
+    return envoltura
+
+
+def _handlers_de(handler):
+    """El handler y, si es un ConversationHandler, todos los que contiene."""
+    if isinstance(handler, ConversationHandler):
+        for interno in handler.entry_points + [h for hs in handler.states.values() for h in hs] + handler.fallbacks:
+            yield from _handlers_de(interno)
+    else:
+        yield handler
+
+
+def trazar_handlers(application):
+    """Aplica `trazado` al callback de cada handler registrado (también dentro de las conversaciones)."""
+    for grupo in application.handlers.values():
+        for registrado in grupo:
+            for handler in _handlers_de(registrado):
+                handler.callback = trazado(handler.callback)
+
+
+async def _atender_metricas(reader, writer):
+    """Servidor HTTP mínimo: GET /metrics devuelve `metricas.exportar()`; lo demás, 404."""
+    try:
+        peticion = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass  # cabeceras: no se usan
+        partes = peticion.decode('latin-1').split()
+        if len(partes) >= 2 and partes[0] == 'GET' and partes[1].split('?')[0] == '/metrics':
+            estado, tipo, cuerpo = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', metricas.exportar().encode('utf-8')
+        else:
+            estado, tipo, cuerpo = '404 Not Found', 'text/plain; charset=utf-8', b'Not Found\n'
+        writer.write(f"HTTP/1.1 {estado}\r\nContent-Type: {tipo}\r\nContent-Length: {len(cuerpo)}\r\n"
+                     f"Connection: close\r\n\r\n".encode('latin-1') + cuerpo)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def iniciar_servidor_metricas():
+    """Abre el servidor de /metrics (si METRICAS_PUERTO no es 0). Devuelve el servidor o None."""
+    if not METRICAS_PUERTO:
+        return None
+    try:
+        servidor = await asyncio.start_server(_atender_metricas, METRICAS_HOST, METRICAS_PUERTO)
+    except OSError as e:
+        logging.warning(f"No se pudo abrir /metrics en {METRICAS_HOST}:{METRICAS_PUERTO}: {e}")
+        return None
+    logging.info(f"Métricas en http://{METRICAS_HOST}:{METRICAS_PUERTO}/metrics")
+    return servidor
+
+
+# --- Concurrencia: procesamiento paralelo de updates ---
+# Con PROCESAR_EN_PARALELO los updates de usuarios distintos se atienden a la vez
+# (un send_document lento ya no frena a los demás). Los de un mismo usuario siguen
+# en orden. Las secciones críticas se protegen con `inventario_lock` (chequeo y
+# reserva de stock en memoria) y `lock_saldo(user_id)` (lectura y descuento de saldo).
+# Una venta guarda en disco sin `inventario_lock`: sus filas quedan ocupadas
+# (StockIndex.ocupar) hasta `terminar_venta`, y lo que toca filas ya en stock desde
+# fuera de una venta (borrar, limpiar) usa `inventario_exclusivo`.
+PROCESAR_EN_PARALELO = True
+MAX_UPDATES_CONCURRENTES = int(os.environ.get("BOT_MAX_UPDATES", "64"))
+
+inventario_lock = asyncio.Lock()
+# Se avisa cuando una venta termina de guardarse (sus filas se liberan) o termina un cambio exclusivo
+inventario_liberado = asyncio.Condition(inventario_lock)
+_exclusivos_esperando = 0
+_locks_saldo = weakref.WeakValueDictionary()
+
+
+@asynccontextmanager
+async def inventario_para_reservar():
+    """inventario_lock para elegir y descontar stock de una venta. Si un cambio exclusivo
+    está esperando, las reservas nuevas esperan a que termine (si no, nunca le tocaría)."""
+    async with inventario_lock:
+        await inventario_liberado.wait_for(lambda: not _exclusivos_esperando)
+        yield
+
+
+@asynccontextmanager
+async def inventario_exclusivo():
+    """inventario_lock sin ventas a medio guardar, para cambios que tocan filas ya en stock
+    (borrar, limpiar y guardar la foto desde memoria)."""
+    global _exclusivos_esperando
+    async with inventario_lock:
+        _exclusivos_esperando += 1
+        try:
+            await inventario_liberado.wait_for(lambda: not stock_index.ocupadas())
+        finally:
+            _exclusivos_esperando -= 1
+        try:
+            yield
+        finally:
+            inventario_liberado.notify_all()
+
+
+async def terminar_venta(previas, deshacer=False):
+    """Libera las filas que una venta ocupó al reservar; si no se pudo guardar (`deshacer`)
+    antes las devuelve como estaban. previas: [(fila, copia)] de la reserva."""
+    async with inventario_lock:
+        if deshacer:
+            stock_index.deshacer(previas)
+        stock_index.liberar(fila for fila, _ in previas)
+        inventario_liberado.notify_all()
+
+
+def lock_saldo(user_id):
+    """Lock asyncio del saldo de un usuario (se libera de memoria cuando nadie lo usa)."""
+    lock = _locks_saldo.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks_saldo[user_id] = lock
+    return lock
+
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    """Procesa updates en paralelo manteniendo el orden de llegada por usuario.
+    El turno del usuario se espera antes de ocupar un lugar del semáforo de PTB: las
+    updates en cola de un mismo usuario (doble toque, ráfagas) no ocupan lugares y sólo
+    las que pueden correr cuentan para MAX_UPDATES_CONCURRENTES."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = weakref.WeakValueDictionary()
+
+    async def process_update(self, update, coroutine):  # PTB lo marca @final; ver docstring de la clase
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        lock = self._locks.get(user.id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[user.id] = lock
+        async with lock:
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
 # --- Carga y guardado de Clientes ---
+@cronometrado
 def cargar_clientes():
-    """Carga los saldos de los clientes desde el archivo CSV."""
+    """Carga los saldos de los clientes desde el almacenamiento configurado."""
     global clientes
-    clientes = {}  # Reinicia para evitar acumulaciones
-    try:
-        with open(CSV_CLIENTES, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) == 2:
-                    try:
-                        clientes[int(row[0])] = float(row[1])
-                    except ValueError as e:
-                        logging.error(f"Error al parsear fila en {CSV_CLIENTES}: {row}. Error: {e}")
-        logging.info(f"Clientes cargados: {len(clientes)}")
-    except FileNotFoundError:
-        logging.warning(f"{CSV_CLIENTES} no existe. Se creará al guardar.")
-    except Exception as e:
-        logging.error(f"Error desconocido al cargar clientes: {e}")
+    clientes = Clientes(storage.cargar_clientes())  # Reinicia para evitar acumulaciones
+    logging.info(f"Clientes cargados: {len(clientes)}")
 
+@cronometrado
 def guardar_clientes():
-    """Guarda los saldos actuales de los clientes en el archivo CSV."""
-    with open(CSV_CLIENTES, 'w', newline='') as f:
-        writer = csv.writer(f)
-        for user, saldo in clientes.items():
-            writer.writerow([user, f"{saldo:.2f}"])
+    """Guarda los saldos de todos los clientes (reescritura completa)."""
+    storage.guardar_clientes(clientes)
+
+def movimiento_saldo(user_id, delta, motivo, actor=None, id_compra=''):
+    """Fila del ledger con el saldo que tiene ahora user_id ('' si fue dado de baja).
+    Se arma en el event loop, justo después del cambio, para que el saldo registrado
+    corresponda a este movimiento aunque la escritura se haga más tarde en un hilo.
+    motivo: 'alta', 'recarga', 'descuento', 'compra' o 'baja'; actor: quién lo hizo."""
+    saldo = clientes.get(user_id)
+    return [datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id, f"{delta:+.2f}",
+            f"{saldo:.2f}" if saldo is not None else '', motivo,
+            user_id if actor is None else actor, id_compra]
+
+# Altas (user_id -> fecha) aún sin escribir. El alta lleva un saldo absoluto de 0.00: si se
+# escribiera por su lado podría llegar al disco después de la primera recarga y, al releer el
+# ledger, dejar el saldo en 0. Por eso viaja delante del primer movimiento del usuario, en la
+# misma escritura, o la escribe `_registrar_alta` con el saldo del usuario bloqueado.
+_altas_pendientes = {}
+_tareas_alta = set()
+
+def _tomar_alta(user_id):
+    """Fila del alta pendiente del usuario (y la quita de pendientes), o None."""
+    fecha = _altas_pendientes.pop(user_id, None)
+    return None if fecha is None else [fecha, user_id, "+0.00", "0.00", 'alta', user_id, '']
+
+def movimientos_saldo(user_id, delta, motivo, actor=None, id_compra=''):
+    """Filas del ledger de un cambio de saldo: el movimiento y, delante, el alta pendiente del usuario."""
+    alta = _tomar_alta(user_id)
+    return ([alta] if alta else []) + [movimiento_saldo(user_id, delta, motivo, actor, id_compra)]
+
+def registrar_movimientos_saldo(movimientos):
+    """Escribe en orden las filas de `movimientos_saldo` (una sola escritura en el ledger)."""
+    with storage.transaccion():
+        for movimiento in movimientos:
+            storage.registrar_movimiento_saldo(movimiento)
+
+def guardar_saldo(user_id, delta=0.0, motivo='ajuste', actor=None, id_compra=''):
+    """Persiste el saldo de un solo cliente (o su baja si ya no está en `clientes`)
+    como un movimiento del ledger."""
+    registrar_movimientos_saldo(movimientos_saldo(user_id, delta, motivo, actor, id_compra))
+
+async def _registrar_alta(user_id):
+    """Escribe el alta si ningún movimiento la llevó antes. Con el saldo bloqueado no hay un
+    cambio a medio registrar, así que el saldo en memoria sigue siendo el 0.00 del alta."""
+    async with lock_saldo(user_id):
+        alta = _tomar_alta(user_id)
+        if alta is None:
+            return
+        try:
+            await en_hilo(registrar_movimientos_saldo, [alta])
+        except Exception as e:
+            logging.exception(f"Error registrando el alta de {user_id}: {e}")
+
+def _programar_alta(user_id):
+    try:
+        tarea = asyncio.get_running_loop().create_task(_registrar_alta(user_id))
+    except RuntimeError:
+        registrar_movimientos_saldo([_tomar_alta(user_id)])  # sin event loop (scripts): nada puede intercalarse
+    else:
+        _tareas_alta.add(tarea)
+        tarea.add_done_callback(_tareas_alta.discard)
+
+def reponer_alta(user_id, movimientos):
+    """Si la escritura de `movimientos` falló y llevaba el alta del usuario, la deja pendiente otra vez."""
+    if movimientos and movimientos[0][4] == 'alta' and user_id in clientes:
+        _altas_pendientes.setdefault(user_id, movimientos[0][0])
+        _programar_alta(user_id)
+
+async def registrar_altas_pendientes():
+    for user_id in list(_altas_pendientes):
+        await _registrar_alta(user_id)
 
 def inicializar_usuario(user_id):
     """Inicializa un usuario con saldo 0 si no existe."""
     if user_id not in clientes:
         clientes[user_id] = 0.0
-        guardar_clientes()
+        _altas_pendientes[user_id] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        _programar_alta(user_id)
         logging.info(f"Nuevo usuario inicializado: {user_id}")
 
 
 # --- Lógica de Stock y Precios Dinámicos ---
 
 def save_combos_csv():
-    """Guarda la lista `combos` en `COMBOS_FILE` (CSV). Plataformas separadas por '|'."""
+    """Guarda la lista `combos` (en COMBOS_FILE o en SQLite según el backend)."""
     try:
-        with open(COMBOS_FILE, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            # Cabecera para que Excel lo abra bien
-            writer.writerow(['titulo', 'subnombre', 'precio', 'plataformas'])
-            for c in combos:
-                titulo = c.get('titulo', '')
-                sub = c.get('subnombre', '')
-                precio = float(c.get('precio', 0.0))
-                plataformas = c.get('plataformas', []) or []
-                # Reemplazar '|' dentro de nombres por espacio para evitar colisiones
-                plataformas_str = '|'.join([p.replace('|', ' ') for p in plataformas])
-                writer.writerow([titulo, sub, f"{precio:.2f}", plataformas_str])
+        storage.guardar_combos(combos)
     except Exception as e:
-        logging.exception(f"Error guardando {COMBOS_FILE}: {e}")
+        logging.exception(f"Error guardando combos: {e}")
 
 def load_combos_csv():
-    """Carga `combos` desde COMBOS_FILE si existe. Rellena la lista global `combos`."""
+    """Carga `combos` desde el almacenamiento. Rellena la lista global `combos`."""
     global combos
-    combos = []
     try:
-        if not os.path.exists(COMBOS_FILE):
-            return
-        with open(COMBOS_FILE, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                try:
-                    titulo = (row.get('titulo') or '').strip()
-                    sub = (row.get('subnombre') or '').strip()
-                    precio = float((row.get('precio') or '0').strip() or 0)
-                    plataformas_str = (row.get('plataformas') or '').strip()
-                    plataformas = [p for p in plataformas_str.split('|') if p]
-                    combos.append({
-                        'titulo': titulo,
-                        'subnombre': sub,
-                        'precio': precio,
-                        'plataformas': plataformas
-                    })
-                except Exception as e:
-                    logging.exception(f"Fila combos inválida en {COMBOS_FILE}: {row} - {e}")
+        combos = storage.cargar_combos()
     except Exception as e:
-        logging.exception(f"Error cargando {COMBOS_FILE}: {e}")
+        combos = []
+        logging.exception(f"Error cargando combos: {e}")
 
+@cronometrado
 def load_stock():
-    """Carga todo el stock desde el archivo CSV, sin filtrar por número de campos.
+    """Carga todo el stock, sin filtrar por número de campos.
     Devuelve una lista de filas (cada fila es una lista de strings)."""
-    stock_data = []
-    try:
-        with open(STOCK_FILE, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                # Normalizar espacios en cada campo
-                if row:
-                    stock_data.append([c.strip() for c in row])
-    except FileNotFoundError:
-        logging.warning(f"{STOCK_FILE} no existe.")
-    except Exception as e:
-        logging.error(f"Error al cargar stock: {e}")
-    return stock_data
+    return storage.load_stock()
 
+@cronometrado
 def save_stock(stock_list):
-    """Sobreescribe el archivo de stock con la lista actual."""
+    """Sobreescribe el stock persistido con la lista actual."""
     try:
-        with open(STOCK_FILE, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerows(stock_list)
+        storage.save_stock(stock_list)
         logging.info("Stock guardado después de la eliminación.")
     except Exception as e:
         logging.error(f"Error al guardar stock: {e}")
 
-def cleanup_stock():
-    """Limpia entradas de stock inválidas o con perfiles a 0 y guarda si hay cambios."""
-    cuentas = load_stock()
+@cronometrado
+def persistir_stock(op, fila):
+    """Persiste una mutación de stock ya aplicada en `stock_index`.
+    op: 'add' (fila nueva), 'take' (se entregó una unidad de la fila) o 'del' (fila eliminada)."""
+    storage.registrar_stock(op, fila)
+
+def clasificar_tipo(tipo):
+    """Clasifica un tipo de cuenta en 'completa', 'perfil' u 'otro'."""
+    tipo_lower = (tipo or "").strip().lower()
+    if 'perfil' in tipo_lower and 'completa' not in tipo_lower:
+        return 'perfil'
+    if 'completa' in tipo_lower and 'perfil' not in tipo_lower:
+        return 'completa'
+    # Lógica de respaldo
+    if tipo_lower.startswith(('1 perfil', 'perfil')):
+        return 'perfil'
+    if tipo_lower.startswith(('cuenta', 'full', 'premium', 'basico', 'estandar', 'completa')):
+        return 'completa'
+    return 'otro'
+
+
+def id_stock(fila):
+    """ID estable de una fila de stock: hash de plataforma, tipo, correo, contraseña y precio,
+    que no cambian al entregar perfiles (sí cambian perfiles_disponibles y perfil_actual)."""
+    clave = '|'.join(str(c).strip() for c in fila[:5])
+    return hashlib.sha1(clave.encode('utf-8')).hexdigest()[:12]
+
+
+class StockIndex:
+    """Índice residente del stock.
+
+    Mantiene las filas de stock.csv en memoria (mismo formato que `load_stock`) y,
+    por cada (categoria, plataforma), el número de unidades disponibles, los precios
+    y los tipos en venta. Se carga una vez al arrancar y cada mutación lo actualiza
+    en sitio, de modo que navegar el catálogo no toca el disco.
+
+    Las filas se guardan por su `id_stock` (un dict conserva el orden de llegada), así
+    borrar una fila por ID es O(1). Dos filas idénticas se distinguen con '-2', '-3'...
+    Índices secundarios por correo y por plataforma (en minúsculas, mismo orden) sirven
+    a /buscar, a la detección de duplicados al agregar y a `tomar`/`reservar`.
+    """
+
+    def __init__(self):
+        self._por_id = {}
+        self._ids = {}  # id(fila) -> ID, para encontrar por identidad sin recalcular el hash
+        self._repetidos = {}  # ID base -> mayor sufijo usado
+        self._grupos = {}
+        self._por_correo = {}  # correo -> {ID: fila}
+        self._por_plataforma = {}  # plataforma -> {ID: fila}
+        self._correos = []  # claves de _por_correo ordenadas, para buscar por prefijo con bisect
+        self._ocupadas = {}  # id(fila) -> fila con una venta reservada que aún no llegó al disco
+
+    @property
+    def filas(self):
+        """Vista de las filas en orden (iterable y con len, sin copiar)."""
+        return self._por_id.values()
+
+    def cargar(self, filas=None):
+        """(Re)construye el índice a partir de `filas` o, si no se pasan, de STOCK_FILE."""
+        self._por_id = {}
+        self._ids = {}
+        self._repetidos = {}
+        self._grupos = {}
+        self._por_correo = {}
+        self._por_plataforma = {}
+        self._correos = []
+        for fila in (load_stock() if filas is None else filas):
+            self.agregar(fila)
+        logging.info(f"Stock indexado: {len(self._por_id)} filas, {len(self._grupos)} grupos")
+
+    def id_de(self, fila):
+        """ID con el que está indexada la fila (por identidad o, en su defecto, por igualdad), o None."""
+        sid = self._ids.get(id(fila))
+        if sid is not None and self._por_id.get(sid) is fila:
+            return sid
+        base = id_stock(fila)
+        for sid in [base] + [f"{base}-{n}" for n in range(2, self._repetidos.get(base, 1) + 1)]:
+            if self._por_id.get(sid) == fila:
+                return sid
+        return None
+
+    def por_id(self, sid):
+        return self._por_id.get(sid)
+
+    @staticmethod
+    def _claves(fila):
+        """(plataforma, correo) normalizados con los que se indexa la fila."""
+        plataforma = str(fila[0]).strip().lower() if len(fila) > 0 else ""
+        correo = str(fila[2]).strip().lower() if len(fila) > 2 else ""
+        return plataforma, correo
+
+    def _indexar(self, sid, fila):
+        plataforma, correo = self._claves(fila)
+        self._por_plataforma.setdefault(plataforma, {})[sid] = fila
+        if correo not in self._por_correo:
+            self._por_correo[correo] = {}
+            bisect.insort(self._correos, correo)
+        self._por_correo[correo][sid] = fila
+
+    def _desindexar(self, sid, fila):
+        plataforma, correo = self._claves(fila)
+        filas = self._por_plataforma.get(plataforma, {})
+        filas.pop(sid, None)
+        if not filas:
+            self._por_plataforma.pop(plataforma, None)
+        filas = self._por_correo.get(correo, {})
+        filas.pop(sid, None)
+        if not filas:
+            if self._por_correo.pop(correo, None) is not None:
+                del self._correos[bisect.bisect_left(self._correos, correo)]
+
+    def de_plataforma(self, plataforma):
+        """Filas de la plataforma en orden de llegada (vista, sin copiar)."""
+        return self._por_plataforma.get(plataforma.strip().lower(), {}).values()
+
+    def existe(self, plataforma, correo):
+        """True si ya hay en stock una cuenta con ese correo en esa plataforma."""
+        plataforma = plataforma.strip().lower()
+        return any(self._claves(fila)[0] == plataforma
+                   for fila in self._por_correo.get(correo.strip().lower(), {}).values())
+
+    def buscar(self, texto, limite=None):
+        """[(ID, fila)] cuyo correo o plataforma empieza por `texto` (sin distinguir mayúsculas).
+        Primero las coincidencias por correo, en orden alfabético; luego las de plataforma."""
+        texto = texto.strip().lower()
+        if not texto:
+            return []
+        encontradas = {}
+        i = bisect.bisect_left(self._correos, texto)
+        while i < len(self._correos) and self._correos[i].startswith(texto):
+            encontradas.update(self._por_correo[self._correos[i]])
+            if limite and len(encontradas) >= limite:
+                break
+            i += 1
+        for plataforma, filas in self._por_plataforma.items():
+            if limite and len(encontradas) >= limite:
+                break
+            if plataforma.startswith(texto):
+                encontradas.update(filas)
+        resultado = list(encontradas.items())
+        return resultado[:limite] if limite else resultado
+
+    @staticmethod
+    def _describir(fila):
+        """Devuelve (clave, tipo, precio, unidades) o None si la fila no aporta al catálogo."""
+        if not fila or len(fila) < 2:
+            return None
+        precio_str = fila[4] if len(fila) > 4 else fila[-1]
+        try:
+            precio = float(precio_str)
+        except (ValueError, TypeError):
+            return None
+        unidades = 1
+        if len(fila) >= 7:
+            try:
+                unidades = int(fila[5])
+            except (ValueError, TypeError):
+                return None
+        if unidades <= 0:
+            return None
+        tipo = fila[1].strip()
+        return (clasificar_tipo(tipo), fila[0].strip()), tipo, precio, unidades
+
+    def _acumular(self, fila, signo):
+        datos = self._describir(fila)
+        if datos is None:
+            return
+        clave, tipo, precio, unidades = datos
+        grupo = self._grupos.setdefault(clave, {'precios': Counter(), 'tipos': Counter(), 'disponibles': 0})
+        grupo['precios'][precio] += signo
+        grupo['tipos'][tipo] += signo
+        grupo['disponibles'] += signo * unidades
+        # Counter += no elimina claves a 0; limpiarlas para que min() sea correcto
+        grupo['precios'] = +grupo['precios']
+        grupo['tipos'] = +grupo['tipos']
+        if not grupo['precios']:
+            del self._grupos[clave]
+
+    def agregar(self, fila):
+        """Indexa la fila y devuelve su ID."""
+        sid = base = id_stock(fila)
+        n = 1
+        while sid in self._por_id:
+            n += 1
+            sid = f"{base}-{n}"
+        if n > self._repetidos.get(base, 1):
+            self._repetidos[base] = n
+        self._por_id[sid] = fila
+        self._ids[id(fila)] = sid
+        self._indexar(sid, fila)
+        self._acumular(fila, 1)
+        return sid
+
+    def quitar_id(self, sid):
+        """Elimina la fila con ese ID. Devuelve la fila o None si ya no estaba."""
+        fila = self._por_id.pop(sid, None)
+        if fila is not None:
+            self._ids.pop(id(fila), None)
+            self._desindexar(sid, fila)
+            self._acumular(fila, -1)
+        return fila
+
+    def quitar(self, fila):
+        """Elimina la fila (por identidad o, en su defecto, por igualdad). Devuelve True si existía."""
+        sid = self.id_de(fila)
+        return sid is not None and self.quitar_id(sid) is not None
+
+    def ocupar(self, filas):
+        """Marca filas con una venta reservada que todavía se está guardando: `primera`,
+        `tomar` y `reservar` no las ofrecen hasta `liberar`. Así nunca hay dos ventas a
+        medio guardar sobre la misma fila, sus eventos llegan al disco en orden y
+        `deshacer` puede devolverla tal como estaba."""
+        for fila in filas:
+            self._ocupadas[id(fila)] = fila
+
+    def liberar(self, filas):
+        for fila in filas:
+            self._ocupadas.pop(id(fila), None)
+
+    def ocupadas(self):
+        """Cuántas filas tienen una venta a medio guardar."""
+        return len(self._ocupadas)
+
+    def hay_ocupadas(self, plataforma, categoria=None):
+        """True si alguna fila ocupada es de la plataforma (y categoría): la venta que la ocupa
+        puede dejarle unidades o, si falla, devolverla; vale la pena esperarla."""
+        plataforma = plataforma.strip().lower()
+        return any(self._claves(fila)[0] == plataforma and (categoria is None or clasificar_tipo(fila[1]) == categoria)
+                   for fila in self._ocupadas.values())
+
+    def _libre(self, fila):
+        return id(fila) not in self._ocupadas
+
+    def tomar(self, plataforma, tipo, precio_buscado):
+        """Entrega la siguiente unidad que coincida con plataforma/tipo/precio y descuenta el stock.
+        Devuelve (fila, [plataforma, tipo, correo, password, precio, perfil_entregado]) o (None, None).
+        Si era el último perfil la fila sale del índice con perfiles_disponibles = '0'."""
+        tipo_l = tipo.strip().lower()
+        for fila in self.de_plataforma(plataforma):
+            if len(fila) < 5 or not self._libre(fila):
+                continue
+            try:
+                stock_precio = float(str(fila[4]).strip())
+            except (ValueError, TypeError):
+                continue
+            if fila[1].strip().lower() != tipo_l:
+                continue
+            if abs(stock_precio - precio_buscado) > 0.01:
+                continue
+            entrega = self._tomar_fila(fila)
+            if entrega is not None:
+                return fila, entrega
+        return None, None
+
+    @staticmethod
+    def _unidades(fila):
+        """Unidades que se pueden entregar de la fila (perfiles o 1 si es cuenta completa); 0 si no sirve."""
+        if len(fila) < 5:
+            return 0
+        try:
+            float(str(fila[4]).strip())
+            if len(fila) >= 7:
+                int(fila[6])
+                return max(int(fila[5]), 0)
+        except (ValueError, TypeError):
+            return 0
+        return 1
+
+    def _tomar_fila(self, fila):
+        """Descuenta una unidad de una fila ya elegida. Devuelve la entrega o None si no tiene unidades."""
+        if self._unidades(fila) <= 0:
+            return None
+        stock_precio = float(str(fila[4]).strip())
+        correo = fila[2]
+        password = fila[3]
+        if len(fila) >= 7:
+            perfiles_disponibles = int(fila[5])
+            perfil_actual = int(fila[6])
+            if perfiles_disponibles > 1:
+                self._acumular(fila, -1)
+                fila[5] = str(perfiles_disponibles - 1)
+                fila[6] = str(perfil_actual + 1)
+                self._acumular(fila, 1)
+            else:
+                # Último perfil: eliminar la fila
+                self.quitar(fila)
+                fila[5] = "0"
+            return [fila[0].strip(), fila[1].strip(), correo, password, stock_precio, perfil_actual]
+
+        # Cuenta completa -> se elimina la fila al entregar
+        self.quitar(fila)
+        return [fila[0].strip(), fila[1].strip(), correo, password, stock_precio, 0]
+
+    def entregar(self, fila):
+        """Descuenta una unidad de una fila obtenida con `primera`. Devuelve la entrega como `tomar`, o None."""
+        return self._tomar_fila(fila)
+
+    def reservar(self, plataformas):
+        """Reserva una unidad por cada plataforma (un combo) con todo o nada.
+        Primero elige las filas (por el índice de plataforma) sin tocar nada; si a alguna plataforma
+        le falta stock devuelve (None, plataforma) y el índice queda intacto. Si alcanza,
+        descuenta todo y devuelve (reservas, previas):
+          reservas: [(fila tras la entrega, entrega)] en el orden de `plataformas`
+          previas:  [(fila, copia antes de tocarla)] para `deshacer` si falla la persistencia."""
+        faltan = Counter(p.strip().lower() for p in plataformas)
+        elegidas = []  # (fila, unidades a tomar)
+        for clave in list(faltan):
+            for fila in self.de_plataforma(clave):
+                if not self._libre(fila):
+                    continue
+                n = min(self._unidades(fila), faltan[clave])
+                if n <= 0:
+                    continue
+                elegidas.append((fila, n))
+                faltan[clave] -= n
+                if not faltan[clave]:
+                    del faltan[clave]
+                    break
+        if faltan:
+            for plataforma in plataformas:
+                if plataforma.strip().lower() in faltan:
+                    return None, plataforma
+
+        previas = [(fila, list(fila)) for fila, _ in elegidas]
+        por_plataforma = defaultdict(list)
+        for fila, n in elegidas:
+            for _ in range(n):
+                entrega = self._tomar_fila(fila)
+                por_plataforma[fila[0].strip().lower()].append((list(fila), entrega))
+        reservas = [por_plataforma[p.strip().lower()].pop(0) for p in plataformas]
+        return reservas, previas
+
+    def deshacer(self, previas):
+        """Devuelve al índice las filas tal como estaban antes de `reservar`."""
+        for fila, copia in previas:
+            if self._por_id.get(self.id_de(fila)) is fila:
+                self._acumular(fila, -1)
+                fila[:] = copia
+                self._acumular(fila, 1)
+            else:
+                fila[:] = copia
+                self.agregar(fila)
+
+    def primera(self, categoria, plataforma):
+        """Primera fila vendible (y no ocupada) de la plataforma dentro de la categoría, o None."""
+        plataforma_l = plataforma.strip().lower()
+        if not any(c == categoria and p.lower() == plataforma_l for c, p in self._grupos):
+            return None
+        for fila in self.de_plataforma(plataforma):
+            if not self._libre(fila):
+                continue
+            datos = self._describir(fila)
+            if datos and datos[0][0] == categoria:
+                return fila
+        return None
+
+    def info_dinamica(self):
+        """Mismo formato que devolvía `get_dynamic_stock_info`: categoria -> plataforma -> {precio, tipos_disponibles}."""
+        info = defaultdict(dict)
+        for (categoria, plataforma), grupo in self._grupos.items():
+            if categoria not in ('completa', 'perfil'):
+                continue
+            info[categoria][plataforma] = {
+                'precio': min(grupo['precios']),
+                'tipos_disponibles': set(grupo['tipos']),
+            }
+        return info
+
+    def conteos(self):
+        """Unidades disponibles por plataforma -> categoria (perfiles sueltos o cuentas completas)."""
+        counts = defaultdict(lambda: defaultdict(int))
+        for (categoria, plataforma), grupo in self._grupos.items():
+            counts[plataforma][categoria] += grupo['disponibles']
+        return counts
+
+
+stock_index = StockIndex()
+
+
+def _limpiar_indice():
+    """Quita del índice las filas inválidas o con perfiles a 0. Devuelve (filas, hubo_cambios)."""
     changed = False
     cleaned = []
-    for row in cuentas:
+    for row in stock_index.filas:
         if not row or len(row) < 5:
             # ignorar filas malformadas
             continue
@@ -203,54 +2388,343 @@ def cleanup_stock():
                 continue
         # Caso normal: mantener fila
         cleaned.append(row)
+    if changed or len(cleaned) != len(stock_index.filas):
+        stock_index.cargar(cleaned)
+        return cleaned, True
+    return cleaned, False
+
+def cleanup_stock():
+    """Limpia entradas de stock inválidas o con perfiles a 0 y guarda si hay cambios."""
+    cleaned, changed = _limpiar_indice()
     if changed:
         save_stock(cleaned)
     return cleaned
 
 def get_dynamic_stock_info():
     """
-    Analiza el stock y devuelve un diccionario con los precios mínimos
-    agrupados por categoria (completa/perfil) -> plataforma.
-    Tolerante a filas con 5 o 7 campos.
+    Devuelve un diccionario con los precios mínimos agrupados por
+    categoria (completa/perfil) -> plataforma, leído del índice en memoria.
     """
-    stock_list = load_stock()
-    
-    stock_info = defaultdict(lambda: defaultdict(lambda: {'precio': float('inf'), 'tipos_disponibles': set()}))
+    return stock_index.info_dinamica()
+
+
+# --- Persistencia asíncrona ---
+# Las escrituras y lecturas de disco se ejecutan en un pool acotado de hilos para no
+# congelar el event loop: mientras se exporta un historial grande o se reescribe el
+# stock, los menús de los demás clientes siguen respondiendo.
+# Los datos en memoria (`clientes`, `stock_index`, `combos`) sólo se modifican desde el
+# event loop; los hilos reciben la estructura viva y la copian bajo el lock del storage,
+# así cada escritura refleja el estado más reciente y nunca una foto vieja.
+IO_WORKERS = 4
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="persistencia")
+
+
+async def en_hilo(func, *args, **kwargs):
+    """Ejecuta func(*args, **kwargs) en el pool de persistencia y espera su resultado.
+    Corre con una copia del contexto (la traza del update) y cronometrada si no lo estaba."""
+    loop = asyncio.get_running_loop()
+    if not getattr(func, '_cronometrado', False):
+        func = cronometrado(func)
+    contexto = contextvars.copy_context()
+    return await loop.run_in_executor(_io_pool, functools.partial(contexto.run, func, *args, **kwargs))
+
+
+async def load_stock_async():
+    return await en_hilo(load_stock)
+
+async def save_stock_async(stock_list):
+    await en_hilo(save_stock, stock_list)
+
+async def cleanup_stock_async():
+    # Con el inventario bloqueado y sin ventas a medio guardar: la foto no puede
+    # adelantarse a un evento aún sin registrar
+    async with inventario_exclusivo():
+        cleaned, changed = _limpiar_indice()
+        if changed:
+            await save_stock_async(cleaned)
+    return cleaned
 
-    for row in stock_list:
-        if len(row) < 2:
-            continue
-        platform = row[0]
-        tipo = row[1]
-        # precio normalmente en índice 4; si no existe, tomar el último campo
-        precio_str = row[4] if len(row) > 4 else row[-1]
+async def compactar_stock_async():
+    return await en_hilo(storage.compactar_stock)
+
+async def compactar_saldos_async():
+    return await en_hilo(storage.compactar_saldos)
+
+async def compactar_periodicamente():
+    """Tarea de fondo: pliega el diario de stock, el ledger de saldos y la cola de salida cada COMPACTACION_SEGUNDOS."""
+    while True:
+        await asyncio.sleep(COMPACTACION_SEGUNDOS)
         try:
-            precio = float(precio_str)
-        except (ValueError, TypeError):
-            logging.error(f"Precio inválido encontrado: {precio_str} para {platform} ({tipo})")
-            continue
-        
-        tipo_lower = tipo.lower()
-        plataforma_clave = platform.strip()
-        
-        categoria = 'otro'
-        if 'perfil' in tipo_lower and 'completa' not in tipo_lower:
-            categoria = 'perfil'
-        elif 'completa' in tipo_lower and 'perfil' not in tipo_lower:
-            categoria = 'completa'
-        else:
-            # Lógica de respaldo
-            if tipo_lower.startswith(('1 perfil', 'perfil')):
-                categoria = 'perfil'
-            elif tipo_lower.startswith(('cuenta', 'full', 'premium', 'basico', 'estandar', 'completa')):
-                categoria = 'completa'
-        
-        if categoria in ['completa', 'perfil']:
-            if precio < stock_info[categoria][plataforma_clave]['precio']:
-                 stock_info[categoria][plataforma_clave]['precio'] = precio
-            stock_info[categoria][plataforma_clave]['tipos_disponibles'].add(tipo.strip())
-        
-    return stock_info
+            plegados = await compactar_stock_async()
+            if plegados:
+                logging.info(f"Diario de stock compactado: {plegados} eventos")
+            plegados = await compactar_saldos_async()
+            if plegados:
+                logging.info(f"Ledger de saldos compactado: {plegados} movimientos")
+            plegados = await en_hilo(storage.compactar_salida)
+            if plegados:
+                logging.info(f"Cola de salida compactada: {plegados} líneas")
+        except Exception as e:
+            logging.exception(f"Error en la compactación periódica: {e}")
+
+async def persistir_stock_async(op, fila):
+    await en_hilo(persistir_stock, op, fila)
+
+async def guardar_clientes_async():
+    await en_hilo(guardar_clientes)
+
+async def guardar_saldo_async(user_id, delta=0.0, motivo='ajuste', actor=None, id_compra=''):
+    movimientos = movimientos_saldo(user_id, delta, motivo, actor, id_compra)
+    try:
+        await en_hilo(registrar_movimientos_saldo, movimientos)
+    except Exception:
+        reponer_alta(user_id, movimientos)
+        raise
+
+async def save_combos_async():
+    await en_hilo(save_combos_csv)
+
+async def log_compra_async(user_id, plan, correo, password, precio, id_compra, plataforma=''):
+    await en_hilo(log_compra, user_id, plan, correo, password, precio, id_compra, plataforma=plataforma)
+
+async def validar_id_compra_async(user_id, id_compra):
+    return await en_hilo(validar_id_compra, user_id, id_compra)
+
+
+@cronometrado
+def registrar_venta(user_id, eventos_stock, compras, movimientos=(), entregas=()):
+    """Persiste una venta ya aplicada en memoria (stock descontado y saldo cobrado):
+    eventos de stock, movimiento de saldo, registro de compras y los mensajes de entrega
+    (cola de salida) en una sola transacción: no queda un cobro sin su entrega pendiente.
+    compras: lista de (plan, correo, password, precio, id_compra, plataforma)."""
+    with storage.transaccion():
+        if entregas:
+            storage.encolar_salida(list(entregas))
+        for op, fila in eventos_stock:
+            persistir_stock(op, fila)
+        if movimientos:
+            registrar_movimientos_saldo(movimientos)
+        for plan, correo, password, precio, id_compra, plataforma in compras:
+            log_compra(user_id, plan, correo, password, precio, id_compra, plataforma=plataforma)
+
+async def registrar_venta_async(user_id, eventos_stock, compras, cargo=0.0, entregas=()):
+    """cargo: total ya descontado de `clientes[user_id]` (se registra como movimiento 'compra').
+    entregas: mensajes de `mensaje_salida`; si no lanzó (la venta quedó guardada) hay que
+    pasarlos a `salida.despachar`. Si lanzó no se despachan: no hay venta que entregar."""
+    movimientos = movimientos_saldo(user_id, -cargo, 'compra', user_id, compras[0][4]) if compras else ()
+    try:
+        await en_hilo(registrar_venta, user_id, eventos_stock, compras, movimientos, entregas)
+    except Exception:
+        reponer_alta(user_id, movimientos)
+        raise
+
+
+# --- Caché de file_id de Telegram ---
+class FileIdCache:
+    """Guarda los file_id de archivos ya subidos a Telegram (clave -> file_id) en FILE_IDS_FILE.
+    Enviar un file_id no vuelve a subir el archivo; si Telegram lo rechaza se descarta y se sube de nuevo."""
+
+    def __init__(self, path=None):
+        self.path = path or FILE_IDS_FILE
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def _cargar(self):
+        if self._ids is None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._ids = json.load(f)
+            except FileNotFoundError:
+                self._ids = {}
+            except Exception as e:
+                logging.warning(f"{self.path} ilegible, se empieza vacío: {e}")
+                self._ids = {}
+        return self._ids
+
+    def get(self, clave):
+        return self._cargar().get(clave)
+
+    def _escribir(self):
+        with self._lock:
+            datos = dict(self._ids)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(datos, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+
+    async def guardar(self, clave, file_id):
+        ids = self._cargar()
+        if ids.get(clave) == file_id:
+            return
+        ids[clave] = file_id
+        await en_hilo(self._escribir)
+
+    async def descartar(self, clave):
+        if self._cargar().pop(clave, None) is not None:
+            await en_hilo(self._escribir)
+
+
+file_ids = FileIdCache()
+
+
+def clave_archivo(path):
+    """Clave de caché de un archivo local: ruta + mtime, así un archivo reemplazado se vuelve a subir."""
+    path = Path(path).resolve()
+    return f"{path}|{path.stat().st_mtime_ns}"
+
+
+async def enviar_foto_cacheada(bot, chat_id, image_path, **kwargs):
+    """send_photo de un archivo local usando su file_id si ya se subió antes.
+    Sólo sube el archivo la primera vez (o si Telegram rechaza el file_id guardado)."""
+    clave = clave_archivo(image_path)
+    file_id = file_ids.get(clave)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            if 'file' not in str(e).lower():
+                raise  # p. ej. un caption mal formado: no es culpa del file_id
+            logging.warning(f"file_id rechazado para {image_path} ({e}); se vuelve a subir.")
+            await file_ids.descartar(clave)
+    contenido = await en_hilo(Path(image_path).read_bytes)
+    mensaje = await bot.send_photo(chat_id=chat_id, photo=contenido, filename=Path(image_path).name, **kwargs)
+    if mensaje.photo:
+        await file_ids.guardar(clave, mensaje.photo[-1].file_id)
+    return mensaje
+
+# --- Material adjunto por cuenta/perfil ---
+# Cada archivo se guarda una sola vez en MATERIAL_DIR con su sha256 como nombre y
+# MATERIAL_REGISTRY_FILE asocia "correo|perfil" -> blob. El file_id de Telegram se guarda
+# por blob en `file_ids`, así la entrega no lee el disco salvo que Telegram rechace el id.
+MATERIAL_TIPOS = ('photo', 'document', 'video', 'animation', 'audio', 'voice')
+
+
+class MaterialStore:
+    """Registro de material adjunto por (correo, perfil) con blobs direccionados por contenido."""
+
+    def __init__(self, registro=None, carpeta=None):
+        self.registro = registro or MATERIAL_REGISTRY_FILE
+        self.carpeta = Path(carpeta or MATERIAL_DIR)
+        self._entradas = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def clave(correo, perfil):
+        return f"{(correo or '').strip().lower()}|{int(perfil)}"
+
+    def _cargar(self):
+        if self._entradas is None:
+            try:
+                with open(self.registro, 'r', encoding='utf-8') as f:
+                    self._entradas = json.load(f)
+            except FileNotFoundError:
+                self._entradas = {}
+            except Exception as e:
+                logging.warning(f"{self.registro} ilegible, se empieza vacío: {e}")
+                self._entradas = {}
+        return self._entradas
+
+    def get(self, correo, perfil):
+        return self._cargar().get(self.clave(correo, perfil))
+
+    def ruta_blob(self, entrada):
+        return self.carpeta / f"{entrada['sha256']}{entrada.get('ext', '')}"
+
+    def _escribir_blob(self, sha, ext, contenido):
+        self.carpeta.mkdir(exist_ok=True)
+        ruta = self.carpeta / f"{sha}{ext}"
+        if not ruta.exists():  # mismo contenido = mismo archivo, se guarda una vez
+            tmp_path = ruta.with_suffix(ruta.suffix + '.tmp')
+            tmp_path.write_bytes(contenido)
+            os.replace(tmp_path, ruta)
+
+    def _escribir_registro(self):
+        with self._lock:
+            datos = dict(self._entradas)
+            tmp_path = self.registro + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(datos, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.registro)
+
+    async def registrar(self, correo, perfiles, tipo, contenido, ext='', nombre=None, file_id=None):
+        """Guarda `contenido` una vez y lo asocia a los perfiles indicados de la cuenta."""
+        sha = hashlib.sha256(contenido).hexdigest()
+        await en_hilo(self._escribir_blob, sha, ext, contenido)
+        entradas = self._cargar()
+        for perfil in perfiles:
+            entradas[self.clave(correo, perfil)] = {'sha256': sha, 'ext': ext, 'tipo': tipo, 'nombre': nombre}
+        await en_hilo(self._escribir_registro)
+        if file_id:
+            await file_ids.guardar(f"material:{sha}:{tipo}", file_id)
+        return sha
+
+    async def enviar(self, bot, chat_id, correo, perfil, caption=None):
+        """Envía el material de (correo, perfil) por file_id; sube el blob sólo si hace falta.
+        Devuelve False si la cuenta no tiene material."""
+        entrada = self.get(correo, perfil)
+        if entrada is None:
+            entrada = await self._importar_legacy(correo, perfil)
+            if entrada is None:
+                return False
+        tipo = entrada.get('tipo') if entrada.get('tipo') in MATERIAL_TIPOS else 'document'
+        enviar = getattr(bot, f"send_{tipo}")
+        clave_id = f"material:{entrada['sha256']}:{tipo}"
+        extra = {'caption': caption} if caption and tipo != 'voice' else {}
+        file_id = file_ids.get(clave_id)
+        if file_id:
+            try:
+                await enviar(chat_id, file_id, **extra)
+                return True
+            except BadRequest as e:
+                if 'file' not in str(e).lower():
+                    raise
+                logging.warning(f"file_id de material rechazado ({e}); se vuelve a subir el blob.")
+                await file_ids.descartar(clave_id)
+        contenido = await en_hilo(self.ruta_blob(entrada).read_bytes)
+        nombre = entrada.get('nombre') or f"material{entrada.get('ext', '')}"
+        mensaje = await enviar(chat_id, contenido, filename=nombre, **extra)
+        nuevo_id = _file_id_de_mensaje(mensaje, tipo)
+        if nuevo_id:
+            await file_ids.guardar(clave_id, nuevo_id)
+        return True
+
+    async def _importar_legacy(self, correo, perfil):
+        """Material guardado con el esquema anterior (material_{correo}_perfil{n}.ext): se pasa al registro."""
+        candidatos = await en_hilo(lambda: sorted(Path('.').glob(f"material_{correo}_perfil{perfil}.*")))
+        if not candidatos:
+            return None
+        ruta = candidatos[0]
+        contenido = await en_hilo(ruta.read_bytes)
+        tipo = 'photo' if ruta.suffix.lower() in ('.jpg', '.jpeg', '.png') else 'document'
+        await self.registrar(correo, [perfil], tipo, contenido, ext=ruta.suffix, nombre=ruta.name)
+        logging.info(f"Material legado importado al registro: {ruta}")
+        return self.get(correo, perfil)
+
+
+def _file_id_de_mensaje(mensaje, tipo):
+    adjunto = getattr(mensaje, tipo, None)
+    if tipo == 'photo':
+        adjunto = adjunto[-1] if adjunto else None
+    return getattr(adjunto, 'file_id', None)
+
+
+def adjunto_de_mensaje(message):
+    """(tipo, objeto, ext, nombre) del adjunto de un mensaje, o None. Para fotos toma la más grande."""
+    if message.photo:
+        return 'photo', message.photo[-1], '.jpg', None
+    for tipo in ('animation', 'video', 'audio', 'voice', 'document'):  # un GIF trae también .document
+        adjunto = getattr(message, tipo, None)
+        if adjunto:
+            nombre = getattr(adjunto, 'file_name', None)
+            ext = os.path.splitext(nombre or "")[1]
+            if not ext and getattr(adjunto, 'mime_type', None):
+                ext = mimetypes.guess_extension(adjunto.mime_type) or ''
+            return tipo, adjunto, ext or '.bin', nombre
+    return None
+
+
+material_store = MaterialStore()
+
 
 
 # --- Flujo para agregar cuentas (Conversación de Admin) - CON VALIDACIONES ---
@@ -333,67 +2807,6 @@ async def venta_tipo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Ingresa el correo de la cuenta:")
         return AGREGAR_CORREO
 
-async def recargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """/recargar <ID_USUARIO> <monto> (Admin) o Instrucciones (Usuario)."""
-    user_id = update.message.from_user.id
-
-    # Usuario normal -> instrucciones de recarga con WhatsApp, cuenta y su ID
-    if not is_admin(user_id):
-        inicializar_usuario(user_id)
-        back_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
-
-        whatsapp = ADMIN_WHATSAPP or "(no configurado)"
-        bank = BANK_ACCOUNT or "(no configurada)"
-        min_text = f"${MIN_RECARGA:.2f}"
-
-        texto = (
-            f"💰 Tu saldo actual es: ${clientes.get(user_id, 0):.2f}\n\n"
-            "Para recargar realiza una transferencia o depósito y envía el comprobante por WhatsApp.\n\n"
-            f"📲 WhatsApp (envía comprobante): {whatsapp}\n"
-            f"🏦 Cuenta / Referencia: {bank}\n\n"
-            f"🔎 Tu ID de cliente (indícalo en el comprobante/WhatsApp): `{user_id}`\n"
-            f"⚠️ Mínimo de recarga: {min_text} pesos.\n\n"
-            "Después de enviar el comprobante por WhatsApp con tu ID de cliente, procesaremos la recarga."
-        )
-
-        await update.message.reply_text(
-            texto,
-            reply_markup=back_keyboard,
-            parse_mode="Markdown"
-        )
-        return
-
-    # Lógica de simulación de recarga para el ADMIN
-    if not context.args or len(context.args) != 2:
-        await update.message.reply_text("❌ Uso Admin: /recargar <ID_USUARIO> <monto>")
-        return
-
-    try:
-        target_id = int(context.args[0])
-        monto = float(context.args[1])
-
-        if monto <= 0:
-            await update.message.reply_text("❌ El monto debe ser positivo.")
-            return
-
-        inicializar_usuario(target_id)
-        clientes[target_id] += monto
-        guardar_clientes()
-
-        await update.message.reply_text(f"✅ Recarga exitosa a ID {target_id} de ${monto:.2f}. Saldo actual: ${clientes[target_id]:.2f}")
-
-        try:
-            await context.bot.send_message(
-                chat_id=target_id,
-                text=f"🎉 Tu saldo ha sido recargado con ${monto:.2f} por el administrador. Saldo actual: ${clientes[target_id]:.2f}",
-                parse_mode="Markdown"
-            )
-        except Exception:
-            logging.warning(f"No se pudo enviar notificación al usuario {target_id}.")
-
-    except ValueError:
-        await update.message.reply_text("❌ ID de usuario o Monto inválido. Ambos deben ser números (el monto puede ser decimal).")
-
 async def venta_perfiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Paso 1.5: Recibe el número de perfiles si se seleccionó 'Perfil'."""
     user_id = update.message.from_user.id
@@ -467,7 +2880,12 @@ async def venta_correo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not correo:
         await update.message.reply_text("❌ El correo de la cuenta no puede estar vacío. Intenta nuevamente:")
         return AGREGAR_CORREO
-        
+    if stock_index.existe(tmp_venta[user_id]['Plataforma'], correo):
+        await update.message.reply_text(
+            f"❌ Ya hay una cuenta de {tmp_venta[user_id]['Plataforma']} con el correo {correo} en stock. "
+            "Ingresa otro correo o usa /cancel:")
+        return AGREGAR_CORREO
+
     tmp_venta[user_id]['correo'] = correo
     await update.message.reply_text("Ingresa la contraseña de la cuenta:")
     return AGREGAR_PASS
@@ -523,33 +2941,166 @@ async def venta_precio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         perfiles = 1
 
+    nueva_fila = [data['Plataforma'], tipo, data['correo'], data['pass'], f"{data['precio']:.2f}", str(perfiles), "1"]
     try:
-        with open(STOCK_FILE, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([data['Plataforma'], tipo, data['correo'], data['pass'], f"{data['precio']:.2f}", perfiles, 1])
+        async with inventario_lock:
+            if stock_index.existe(data['Plataforma'], data['correo']):
+                # Pudo entrar por /importarstock mientras se completaba el flujo
+                tmp_venta.pop(user_id, None)
+                await update.message.reply_text(
+                    f"❌ La cuenta {data['correo']} de {data['Plataforma']} ya está en stock. No se agregó de nuevo.")
+                return ConversationHandler.END
+            stock_index.agregar(nueva_fila)
+            await persistir_stock_async('add', list(nueva_fila))
     except Exception as e:
-        logging.exception(f"Error escribiendo en {STOCK_FILE}: {e}")
+        stock_index.quitar(nueva_fila)
+        logging.exception(f"Error guardando la cuenta en stock: {e}")
         await update.message.reply_text("❌ Error al guardar la cuenta en stock. Intenta de nuevo más tarde.")
         return ConversationHandler.END
 
-    # Confirmación y fin del flujo (sin preguntar por material)
+    # Confirmación; la cuenta ya está en stock. Paso opcional: material adjunto
+    # (guardar_material_perfil lo registra para todos sus perfiles)
+    data['perfiles'] = perfiles
     await update.message.reply_text(
-        f"✅ Se añadió una cuenta de {data['Plataforma']} ({tipo}) con {perfiles} perfil(es) disponibles. Precio: ${data['precio']:.2f}.\n\nRegistro completado.",
+        f"✅ Se añadió una cuenta de {data['Plataforma']} ({tipo}) con {perfiles} perfil(es) disponibles. Precio: ${data['precio']:.2f}.",
         parse_mode="Markdown"
     )
-
-    # Limpiar tmp y terminar la conversación
-    tmp_venta.pop(user_id, None)
-    return ConversationHandler.END
-
-    await update.message.reply_text(
-        f"✅ Se añadió una cuenta de {data['Plataforma']} ({tipo}) con {perfiles} perfiles disponibles, precio ${data['precio']:.2f} cada uno.",
-        parse_mode="Markdown"
-    )
-    # Preguntar por material adjunto
     await update.message.reply_text("¿Quieres agregar material adjunto (foto/documento) para esta cuenta? Envía el archivo o escribe 'no' para terminar.")
     return AGREGAR_MATERIAL
 
+# --- Importación masiva de stock (/importarstock) ---
+IMPORTAR_STOCK_MAX_BYTES = 5 * 1024 * 1024
+IMPORTAR_STOCK_MAX_RECHAZOS = 20  # cuántos rechazos se detallan en la respuesta
+
+
+def _parsear_stock_importado(lineas, indice):
+    """Valida en una sola pasada líneas `plataforma,tipo,correo,pass,precio[,perfiles]`
+    (cualquier iterable de líneas: un archivo, un io.StringIO...).
+    Las cuentas (plataforma + correo) que ya están en `indice` o se repiten en el bloque
+    cuentan como duplicadas.
+    Devuelve (filas nuevas en el formato de /addventa, duplicadas, [(n_linea, motivo)])."""
+    filas, duplicadas, rechazadas = [], 0, []
+    vistas = set()
+    lector = csv.reader(lineas)
+    for row in lector:
+        n = lector.line_num  # línea del archivo (un campo entre comillas puede ocupar varias)
+        row = [c.strip() for c in row]
+        if not any(row) or row[0].startswith('#'):
+            continue
+        if n == 1 and row[0].lower() == 'plataforma':
+            continue  # cabecera
+        if len(row) not in (5, 6):
+            rechazadas.append((n, f"se esperaban 5 o 6 columnas y hay {len(row)}"))
+            continue
+        plataforma, tipo, correo, password, precio_text = row[:5]
+        if not (plataforma and tipo and correo and password):
+            rechazadas.append((n, "plataforma, tipo, correo y contraseña son obligatorios"))
+            continue
+        categoria = clasificar_tipo(tipo)
+        if categoria == 'otro':
+            rechazadas.append((n, f"tipo '{tipo}' no es completa ni perfil"))
+            continue
+        try:
+            precio = float(precio_text.replace(',', '.'))
+        except ValueError:
+            precio = 0.0
+        if precio <= 0:
+            rechazadas.append((n, f"precio inválido '{precio_text}'"))
+            continue
+        perfiles = 1
+        if categoria == 'perfil':
+            # Como en /addventa: el número de perfiles va en el tipo, "Perfil (4)"
+            en_tipo = re.search(r'(\d+)', tipo)
+            perfiles_text = row[5] if len(row) == 6 and row[5] else (en_tipo.group(1) if en_tipo else '1')
+            if not perfiles_text.isdigit() or int(perfiles_text) <= 0:
+                rechazadas.append((n, f"perfiles inválidos '{perfiles_text}'"))
+                continue
+            perfiles = int(perfiles_text)
+            if en_tipo and int(en_tipo.group(1)) != perfiles:
+                rechazadas.append((n, f"el tipo '{tipo}' dice {en_tipo.group(1)} perfil(es) y la columna perfiles {perfiles}"))
+                continue
+            if not en_tipo:
+                tipo = f"{tipo} ({perfiles})"
+        clave = (plataforma.lower(), correo.lower())
+        if clave in vistas or indice.existe(plataforma, correo):
+            duplicadas += 1
+            continue
+        vistas.add(clave)
+        filas.append([plataforma, tipo, correo, password, f"{precio:.2f}", str(perfiles), "1"])
+    return filas, duplicadas, rechazadas
+
+
+def persistir_stock_importado(filas):
+    """Registra todas las filas importadas en una sola transacción (un fsync / un commit)."""
+    with storage.transaccion():
+        for fila in filas:
+            persistir_stock('add', fila)
+
+
+def _decodificar_importacion(datos):
+    try:
+        return datos.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return datos.decode('latin-1')  # CSV guardado desde Excel
+
+
+async def importar_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/importarstock (Admin) - Agrega muchas cuentas de una vez.
+    Acepta las líneas `plataforma,tipo,correo,pass,precio[,perfiles]` pegadas debajo del comando,
+    un documento CSV enviado con /importarstock como pie, o /importarstock respondiendo a ese CSV.
+    Se omiten las cuentas (plataforma + correo) que ya están en stock y todo se guarda junto."""
+    message = update.message
+    if not is_admin(message.from_user.id):
+        await message.reply_text("❌ Solo el administrador puede importar stock.")
+        return
+
+    documento = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if documento:
+        if documento.file_size and documento.file_size > IMPORTAR_STOCK_MAX_BYTES:
+            await message.reply_text(f"❌ El archivo pasa de {IMPORTAR_STOCK_MAX_BYTES // (1024 * 1024)} MB.")
+            return
+        archivo = await documento.get_file()
+        texto = _decodificar_importacion(bytes(await archivo.download_as_bytearray()))
+    else:
+        # El bloque pegado va en las líneas siguientes al comando
+        texto = (message.text or '').partition('\n')[2]
+    if not texto.strip():
+        await message.reply_text(
+            "❌ Uso: /importarstock seguido de una línea por cuenta:\n"
+            "plataforma,tipo,correo,pass,precio[,perfiles]\n\n"
+            "Ej:\n/importarstock\nNetflix,Perfil,correo@x.com,clave,35,4\nDisney,Completa,otro@x.com,clave,80\n\n"
+            "También puedes enviar un CSV con /importarstock en el pie del documento.")
+        return
+
+    async with inventario_lock:
+        # El texto ya está entero en memoria (a lo sumo IMPORTAR_STOCK_MAX_BYTES); StringIO lo
+        # recorre línea a línea sin armar otra lista y respeta los campos entre comillas con saltos
+        filas, duplicadas, rechazadas = _parsear_stock_importado(io.StringIO(texto, newline=''), stock_index)
+        if filas:
+            for fila in filas:
+                stock_index.agregar(fila)
+            try:
+                await en_hilo(persistir_stock_importado, [list(fila) for fila in filas])
+            except Exception as e:
+                for fila in filas:
+                    stock_index.quitar(fila)
+                logging.exception(f"Error guardando el stock importado: {e}")
+                await message.reply_text("❌ Error al guardar el stock importado. No se agregó ninguna cuenta.")
+                return
+
+    unidades = sum(int(fila[5]) for fila in filas)
+    resumen = (f"📥 Importación de stock\n"
+               f"✅ Aceptadas: {len(filas)} cuentas ({unidades} unidades)\n"
+               f"♻️ Duplicadas (omitidas): {duplicadas}\n"
+               f"❌ Rechazadas: {len(rechazadas)}")
+    if rechazadas:
+        resumen += "\n\n" + "\n".join(f"Línea {n}: {motivo}" for n, motivo in rechazadas[:IMPORTAR_STOCK_MAX_RECHAZOS])
+        if len(rechazadas) > IMPORTAR_STOCK_MAX_RECHAZOS:
+            resumen += f"\n… y {len(rechazadas) - IMPORTAR_STOCK_MAX_RECHAZOS} más."
+    logging.info(f"Stock importado: {len(filas)} cuentas, {duplicadas} duplicadas, {len(rechazadas)} rechazadas")
+    await message.reply_text(resumen)
+
+
 async def guardar_material_perfil(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     logging.info(f"guardar_material_perfil llamado por user_id={user_id}")
@@ -567,41 +3118,27 @@ async def guardar_material_perfil(update: Update, context: ContextTypes.DEFAULT_
         return ConversationHandler.END
 
     correo = data.get('correo', 'unknown')
-    tipo = data.get('tipo', '')
-    import re
-    match = re.search(r'(\d+)', tipo)
-    perfiles = int(match.group(1)) if match else 1
+    perfiles = data.get('perfiles', 1)  # los mismos que venta_precio puso en stock
 
-    # Debug: registrar qué tiene el mensaje
-    has_photo = bool(getattr(update.message, "photo", None))
-    has_document = bool(getattr(update.message, "document", None))
-    logging.info(f"guardar_material_perfil: has_photo={has_photo}, has_document={has_document}, text_present={bool(text)}")
+    adjunto = adjunto_de_mensaje(update.message)
+    logging.info(f"guardar_material_perfil: adjunto={adjunto[0] if adjunto else None}, text_present={bool(text)}")
 
-    if not has_photo and not has_document:
-        await update.message.reply_text("❌ Envía una foto o documento válido, o escribe 'no' para omitir.")
+    if not adjunto:
+        await update.message.reply_text("❌ Envía una foto, documento, video o audio válido, o escribe 'no' para omitir.")
         return AGREGAR_MATERIAL
 
-    # Guardar el archivo para cada perfil (si hay N perfiles, copiar el mismo archivo N veces)
-    for i in range(1, perfiles + 1):
-        try:
-            if has_document:
-                doc = update.message.document
-                file = await doc.get_file()
-                ext = os.path.splitext(doc.file_name or "")[1] or ".bin"
-                filename = f"material_{correo}_perfil{i}{ext}"
-                await file.download_to_drive(filename)
-                logging.info(f"Material guardado: {filename}")
-            elif has_photo:
-                # tomar la foto de mayor tamaño
-                photo = update.message.photo[-1]
-                file = await photo.get_file()
-                filename = f"material_{correo}_perfil{i}.jpg"
-                await file.download_to_drive(filename)
-                logging.info(f"Material guardado: {filename}")
-        except Exception as e:
-            logging.exception(f"Error descargando material (perfil {i}): {e}")
-            await update.message.reply_text("❌ Error al descargar el material. Intenta nuevamente.")
-            return AGREGAR_MATERIAL
+    # Se descarga una sola vez y todos los perfiles apuntan al mismo blob
+    tipo_adjunto, archivo, ext, nombre = adjunto
+    try:
+        file = await archivo.get_file()
+        contenido = bytes(await file.download_as_bytearray())
+        sha = await material_store.registrar(correo, range(1, perfiles + 1), tipo_adjunto, contenido,
+                                             ext=ext, nombre=nombre, file_id=archivo.file_id)
+        logging.info(f"Material guardado: {sha[:12]}{ext} ({tipo_adjunto}) para {correo}, {perfiles} perfil(es)")
+    except Exception as e:
+        logging.exception(f"Error descargando material: {e}")
+        await update.message.reply_text("❌ Error al descargar el material. Intenta nuevamente.")
+        return AGREGAR_MATERIAL
 
     await update.message.reply_text(f"✅ Material guardado para {perfiles} perfil(es). Registro finalizado.")
     tmp_venta.pop(user_id, None)
@@ -616,10 +3153,9 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id in tmp_reporte:
         tmp_reporte.pop(user_id)
         
-    # Limpiar estado de borrado si está activo
-    context.user_data.pop('awaiting_delete_index', None)
-    context.user_data.pop('filtered_stock', None)
-    context.user_data.pop('stock_to_delete', None)
+    # Limpiar estado de borrado de combos si está activo
+    context.user_data.pop('awaiting_delete_combo_index', None)
+    context.user_data.pop('combo_list_for_delete', None)
         
     await update.message.reply_text("❌ Proceso cancelado.")
     return ConversationHandler.END
@@ -653,7 +3189,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/comandos - Muestra esta lista.\n"
         "/stock - Ver el inventario detallado de cuentas.\n"
         "/addventa <Plataforma> - Iniciar el flujo para agregar una cuenta al stock.\n"
+        "/importarstock - Agrega muchas cuentas de una vez (líneas o CSV: plataforma,tipo,correo,pass,precio[,perfiles]).\n"
         "/borrarventa - Iniciar el flujo para eliminar una cuenta del stock o combos.\n"
+        "/buscar <texto> - Busca cuentas en stock por el inicio del correo o de la plataforma.\n"
         "/recargar <ID> <monto> - Recarga saldo a un usuario.\n"
         "/quitarsaldo <ID> <monto> - Descuenta saldo a un usuario.\n"
         "/consultarsaldo <ID> - Consulta el saldo de un usuario específico.\n"
@@ -661,9 +3199,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/cancel - Cancela un flujo de conversación (e.g., /addventa, /borrarventa o Reporte).\n"
         "/addcombo - Inicia el flujo para agregar un nuevo combo de cuentas.\n"
         "/combos - Muestra los combos disponibles para compra.\n"
-        "/verclientes - Muestra la lista de clientes con su ID y saldo.\n"
+        "/verclientes [saldo|id] [tamaño] - Lista paginada de clientes con su ID y saldo.\n"
         "/responder <ID> <mensaje> - Responde a reportes o envía mensajes a clientes.\n"
         "/eliminarcliente <ID> - Elimina un cliente del registro.\n"
+        "/movimientos <ID> - Muestra los últimos movimientos de saldo de un cliente.\n"
+        "/ventas <desde> <hasta> [plataforma] - Totales de ventas en un rango de fechas.\n"
+        "/estadisticas [días] - Ingresos, ventas y ticket promedio por plataforma, plan y día.\n"
+        "/difundir <mensaje> - Envía un mensaje a todos los clientes (estado / cancelar).\n"
        
     )
     cliente_comandos = (
@@ -708,40 +3250,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Si el texto cabe en caption, intentar enviarlo como caption.
             use_caption = len(bienvenida_text) <= MAX_CAPTION
 
-            with open(image_path, "rb") as img:
+            # La imagen se sube una sola vez; después se reenvía por su file_id
+            chat_id = update.message.chat_id if getattr(update, "message", None) else user_id
+            try:
+                if use_caption:
+                    await enviar_foto_cacheada(context.bot, chat_id, image_path, caption=bienvenida_text, parse_mode="Markdown")
+                else:
+                    # enviar foto sin caption y luego el texto
+                    await enviar_foto_cacheada(context.bot, chat_id, image_path)
+                    await context.bot.send_message(chat_id=chat_id, text=bienvenida_text, parse_mode="Markdown")
+            except Exception as e_photo:
+                logging.warning(f"Fallo send_photo: {e_photo}. Intentando enviar como documento sin caption largo...")
+                # En caso de fallo al enviar como photo, enviamos como documento.
                 try:
-                    if getattr(update, "message", None):
-                        if use_caption:
-                            await update.message.reply_photo(photo=img, caption=bienvenida_text, parse_mode="Markdown")
-                        else:
-                            # enviar foto sin caption y luego el texto
-                            await update.message.reply_photo(photo=img)
-                            await update.message.reply_text(bienvenida_text, parse_mode="Markdown")
-                    else:
-                        if use_caption:
-                            await context.bot.send_photo(chat_id=user_id, photo=img, caption=bienvenida_text, parse_mode="Markdown")
-                        else:
-                            await context.bot.send_photo(chat_id=user_id, photo=img)
-                            await context.bot.send_message(chat_id=user_id, text=bienvenida_text, parse_mode="Markdown")
-                except Exception as e_photo:
-                    logging.warning(f"Fallo send_photo: {e_photo}. Intentando enviar como documento sin caption largo...")
-                    # En caso de fallo al enviar como photo, enviamos como documento.
-                    with open(image_path, "rb") as doc:
-                        try:
-                            if getattr(update, "message", None):
-                                # nunca usar caption largo; enviamos documento sin caption y texto aparte
-                                await update.message.reply_document(document=doc)
-                                await update.message.reply_text(bienvenida_text, parse_mode="Markdown")
-                            else:
-                                await context.bot.send_document(chat_id=user_id, document=doc)
-                                await context.bot.send_message(chat_id=user_id, text=bienvenida_text, parse_mode="Markdown")
-                        except Exception as e_doc:
-                            logging.exception(f"Fallo al enviar documento de bienvenida: {e_doc}")
-                            # último recurso: solo enviar texto
-                            if getattr(update, "message", None):
-                                await update.message.reply_text(bienvenida_text, parse_mode="Markdown")
-                            else:
-                                await context.bot.send_message(chat_id=user_id, text=bienvenida_text, parse_mode="Markdown")
+                    # nunca usar caption largo; enviamos documento sin caption y texto aparte
+                    doc = await en_hilo(image_path.read_bytes)
+                    await context.bot.send_document(chat_id=chat_id, document=doc, filename=image_path.name)
+                    await context.bot.send_message(chat_id=chat_id, text=bienvenida_text, parse_mode="Markdown")
+                except Exception as e_doc:
+                    logging.exception(f"Fallo al enviar documento de bienvenida: {e_doc}")
+                    # último recurso: solo enviar texto
+                    await context.bot.send_message(chat_id=chat_id, text=bienvenida_text, parse_mode="Markdown")
         else:
             logging.warning(f"Start: imagen no encontrada en {image_path} (WELCOME_IMAGE='{WELCOME_IMAGE}')")
             if getattr(update, "message", None):
@@ -783,56 +3312,10 @@ async def consultar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             f"✅ Saldo del usuario ID {target_id}: ${target_saldo:.2f}", 
             parse_mode="Markdown"
-        )
-        
-    except ValueError:
-        await update.message.reply_text("❌ ID de usuario inválido. Debe ser un número entero.")
-
-async def recargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """/recargar <ID_USUARIO> <monto> (Admin) o Instrucciones (Usuario)."""
-    user_id = update.message.from_user.id
-    
-    if not is_admin(user_id):
-        inicializar_usuario(user_id)
-        back_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
-        await update.message.reply_text(
-            f"💰 Tu saldo actual es: ${clientes.get(user_id, 0):.2f}\n\n"
-            f"Para recargar, contacta al administrador e indica tu ID de usuario: {user_id}.",
-            reply_markup=back_keyboard,
-            parse_mode="Markdown"
-        )
-        return
-
-    # Lógica de simulación de recarga para el ADMIN
-    if not context.args or len(context.args) != 2:
-        await update.message.reply_text("❌ Uso Admin: /recargar <ID_USUARIO> <monto>")
-        return
-
-    try:
-        target_id = int(context.args[0])
-        monto = float(context.args[1])
-        
-        if monto <= 0:
-            await update.message.reply_text("❌ El monto debe ser positivo.")
-            return
-
-        inicializar_usuario(target_id)
-        clientes[target_id] += monto
-        guardar_clientes()
-        
-        await update.message.reply_text(f"✅ Recarga exitosa a ID {target_id} de ${monto:.2f}. Saldo actual: ${clientes[target_id]:.2f}")
+        )
         
-        try:
-            await context.bot.send_message(
-                chat_id=target_id, 
-                text=f"🎉 Tu saldo ha sido recargado con ${monto:.2f} por el administrador. Saldo actual: ${clientes[target_id]:.2f}",
-                parse_mode="Markdown"
-            )
-        except Exception:
-             logging.warning(f"No se pudo enviar notificación al usuario {target_id}.")
-            
     except ValueError:
-        await update.message.reply_text("❌ ID de usuario o Monto inválido. Ambos deben ser números (el monto puede ser decimal).")
+        await update.message.reply_text("❌ ID de usuario inválido. Debe ser un número entero.")
 
 async def quitar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/quitarsaldo <ID_USUARIO> <monto> (Admin)"""
@@ -856,19 +3339,21 @@ async def quitar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         inicializar_usuario(target_id)
         
-        clientes[target_id] = max(0, clientes[target_id] - monto)
-        guardar_clientes()
-        
-        await update.message.reply_text(f"✅ Se han descontado ${monto:.2f} a ID {target_id}. Saldo actual: ${clientes[target_id]:.2f}")
+        async with lock_saldo(target_id):
+            saldo_anterior = clientes[target_id]
+            clientes[target_id] = max(0, saldo_anterior - monto)
+            # Si el movimiento no se pudo guardar, el saldo vuelve a lo que era
+            try:
+                await guardar_saldo_async(target_id, clientes[target_id] - saldo_anterior, 'descuento', user_id)
+            except Exception as e:
+                logging.exception(f"Error guardando el descuento de ${monto:.2f} a {target_id}: {e}")
+                clientes[target_id] = saldo_anterior
+                await update.message.reply_text("❌ No se pudo guardar el descuento. El saldo no cambió; intenta de nuevo.")
+                return
+            saldo_actual = clientes[target_id]
         
-        try:
-            await context.bot.send_message(
-                chat_id=target_id, 
-                text=f"⚠️ Se ha descontado ${monto:.2f} de tu saldo por el administrador. Saldo actual: ${clientes[target_id]:.2f}",
-                parse_mode="Markdown"
-            )
-        except Exception:
-             logging.warning(f"No se pudo enviar notificación al usuario {target_id}.")
+        await update.message.reply_text(f"✅ Se han descontado ${monto:.2f} a ID {target_id}. Saldo actual: ${saldo_actual:.2f}")
+        await notificar(target_id, f"⚠️ Se ha descontado ${monto:.2f} de tu saldo por el administrador. Saldo actual: ${saldo_actual:.2f}", "Markdown")
             
     except ValueError:
         await update.message.reply_text("❌ ID de usuario o Monto inválido. Ambos deben ser números (el monto puede ser decimal).")
@@ -885,7 +3370,9 @@ async def comandos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/comandos - Muestra esta lista.\n"
         "/stock - Ver el inventario detallado de cuentas.\n"
         "/addventa <Plataforma> - Iniciar el flujo para agregar una cuenta al stock.\n"
+        "/importarstock - Agrega muchas cuentas de una vez (líneas o CSV: plataforma,tipo,correo,pass,precio[,perfiles]).\n"
         "/borrarventa - Iniciar el flujo para eliminar una cuenta del stock o combos.\n"
+        "/buscar <texto> - Busca cuentas en stock por el inicio del correo o de la plataforma.\n"
         "/recargar <ID> <monto> - Recarga saldo a un usuario.\n"
         "/quitarsaldo <ID> <monto> - Descuenta saldo a un usuario.\n"
         "/consultarsaldo <ID> - Consulta el saldo de un usuario específico.\n"
@@ -893,9 +3380,13 @@ async def comandos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/cancel - Cancela un flujo de conversación (e.g., /addventa, /borrarventa o Reporte).\n"
         "/addcombo - Inicia el flujo para agregar un nuevo combo de cuentas.\n"
         "/combos - Muestra los combos disponibles para compra.\n"
-        "/verclientes - Muestra la lista de clientes con su ID y saldo.\n"
+        "/verclientes [saldo|id] [tamaño] - Lista paginada de clientes con su ID y saldo.\n"
         "/responder <ID> <mensaje> - Responde a reportes o envía mensajes a clientes.\n"
         "/eliminarcliente <ID> - Elimina un cliente del registro.\n"
+        "/movimientos <ID> - Muestra los últimos movimientos de saldo de un cliente.\n"
+        "/ventas <desde> <hasta> [plataforma] - Totales de ventas en un rango de fechas.\n"
+        "/estadisticas [días] - Ingresos, ventas y ticket promedio por plataforma, plan y día.\n"
+        "/difundir <mensaje> - Envía un mensaje a todos los clientes (estado / cancelar).\n"
   
     )
     cliente_comandos = (
@@ -922,44 +3413,11 @@ async def stock_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Solo el administrador puede ver el inventario.")
         return
 
-    cleaned_stock = cleanup_stock()
+    await cleanup_stock_async()
     stock_info = get_dynamic_stock_info()
 
-    # Contar por plataforma y categoría
-    counts = defaultdict(lambda: defaultdict(int))  # counts[platform][categoria] = cantidad
-    for row in cleaned_stock:
-        if len(row) < 2:
-            continue
-        platform = row[0].strip()
-        tipo = row[1].strip()
-        tipo_lower = tipo.lower()
-        categoria = 'otro'
-        if 'perfil' in tipo_lower and 'completa' not in tipo_lower:
-            categoria = 'perfil'
-        elif 'completa' in tipo_lower and 'perfil' not in tipo_lower:
-            categoria = 'completa'
-        else:
-            if tipo_lower.startswith(('1 perfil', 'perfil')):
-                categoria = 'perfil'
-            elif tipo_lower.startswith(('cuenta', 'full', 'premium', 'basico', 'estandar', 'completa')):
-                categoria = 'completa'
-            else:
-                categoria = 'otro'
-
-        if categoria == 'perfil':
-            # sumar perfiles_disponibles si existe
-            if len(row) >= 7:
-                try:
-                    perfiles_disponibles = int(row[5])
-                    counts[platform]['perfil'] += max(0, perfiles_disponibles)
-                except (ValueError, TypeError):
-                    counts[platform]['perfil'] += 0
-            else:
-                counts[platform]['perfil'] += 1
-        elif categoria == 'completa':
-            counts[platform]['completa'] += 1
-        else:
-            counts[platform]['otro'] += 1
+    # Unidades por plataforma y categoría (perfiles sueltos o cuentas completas), desde el índice
+    counts = stock_index.conteos()  # counts[platform][categoria] = cantidad
 
     if not counts:
         await update.message.reply_text("📦 El inventario está vacío.")
@@ -995,119 +3453,297 @@ async def stock_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(message, parse_mode="Markdown")
 
-def log_compra_global(user_id, plan, correo, password, precio, id_compra):
-    """Registra la compra en el archivo de historial global.
+def log_compra_global(user_id, plan, correo, password, precio, id_compra, plataforma=''):
+    """Registra la compra en el historial global.
     Mantiene ID_Compra en la primera columna y usa 'Fecha de entrega' como nombre de columna.
+    La plataforma no va en compras_global.csv; sólo alimenta /ventas y /estadisticas.
     """
-    file_exists = os.path.exists(COMPRAS_FILE)
-    with open(COMPRAS_FILE, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        if not file_exists or os.path.getsize(COMPRAS_FILE) == 0:
-            writer.writerow(['ID_Compra', 'ID_Usuario', 'Fecha de entrega', 'Plan', 'Correo', 'Contraseña', 'Precio'])
-        fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        writer.writerow([id_compra, user_id, fecha, plan, correo, password, f"{precio:.2f}"])
+    fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    storage.registrar_compra_global([id_compra, user_id, fecha, plan, correo, password, f"{precio:.2f}"],
+                                    plataforma=plataforma)
+    # Se cuenta cuando la venta quedó guardada: una transacción que falla no suma
+    storage.al_confirmar(functools.partial(estadisticas.registrar, fecha, plataforma, plan, precio, id_compra))
     logging.info(f"Compra global registrada: {id_compra} para usuario {user_id}")
 
-def log_compra(user_id, plan, correo, password, precio, id_compra):
-    """Registra la compra del usuario en su archivo de historial con el orden:
+@cronometrado
+def log_compra(user_id, plan, correo, password, precio, id_compra, plataforma=''):
+    """Registra la compra del usuario en su historial con el orden:
        Fecha de entrega, Plan, Correo, Contraseña, Precio, ID_Compra
     """
-    historial_file = f'historial_{user_id}.csv'
     fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-    file_exists = os.path.exists(historial_file)
-    with open(historial_file, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        if not file_exists or os.path.getsize(historial_file) == 0:
-            writer.writerow(['Fecha de entrega', 'Plan', 'Correo', 'Contraseña', 'Precio', 'ID_Compra'])
-        writer.writerow([fecha, plan, correo, password, f"{precio:.2f}", id_compra])
+    storage.registrar_historial(user_id, [fecha, plan, correo, password, f"{precio:.2f}", id_compra])
+    # Después de que la fila llegó al disco: una exportación que se arme antes y lea el
+    # archivo viejo queda con la versión anterior y no se guarda en la caché
+    storage.al_confirmar(functools.partial(historial_cache.invalidar, user_id))
     logging.info(f"Compra registrada in historial_{user_id}.csv: {plan}")
 
     # También registrar en el historial global
-    log_compra_global(user_id, plan, correo, password, precio, id_compra)
+    log_compra_global(user_id, plan, correo, password, precio, id_compra, plataforma=plataforma)
+
+# --- Estadísticas de ventas ---
+class EstadisticasVentas:
+    """Contadores acumulados de ventas por plataforma, por plan y por día.
+
+    Cada cubeta es [unidades, ingresos, compras]: una fila de compra suma una unidad,
+    y las filas seguidas con el mismo ID_Compra (ítems de un combo) cuentan como una
+    sola compra, que es lo que se usa para el ticket promedio. Se alimentan desde
+    log_compra_global cuando la venta se confirma y se guardan en ESTADISTICAS_FILE cada
+    ESTADISTICAS_GUARDAR_SEGUNDOS; `reconstruir` las vuelve a calcular desde las compras
+    registradas, y `al_dia` lo hace al arrancar si la foto no cubre todas las ventas."""
+
+    DIMENSIONES = ('plataforma', 'plan', 'dia')
+
+    def __init__(self, path=None):
+        self.path = path or ESTADISTICAS_FILE
+        self._lock = threading.Lock()
+        self._vaciar()
+
+    def _vaciar(self):
+        self.datos = {dim: {} for dim in self.DIMENSIONES}
+        self.datos['total'] = [0, 0.0, 0]
+        self._ultimo_id = {}
+        self._cambios = False
+
+    def _sumar(self, dim, clave, precio, id_compra):
+        cubeta = self.datos['total'] if dim == 'total' else self.datos[dim].setdefault(clave, [0, 0.0, 0])
+        cubeta[0] += 1
+        cubeta[1] = round(cubeta[1] + precio, 2)
+        if self._ultimo_id.get((dim, clave)) != id_compra:
+            cubeta[2] += 1
+            self._ultimo_id[(dim, clave)] = id_compra
+
+    def registrar(self, fecha, plataforma, plan, precio, id_compra):
+        try:
+            precio = float(precio)
+        except (TypeError, ValueError):
+            precio = 0.0
+        dia = _clave_fecha(fecha)[:10] or 'sin fecha'
+        with self._lock:
+            self._sumar('total', None, precio, id_compra)
+            self._sumar('plataforma', plataforma or '(sin plataforma)', precio, id_compra)
+            self._sumar('plan', plan or '(sin plan)', precio, id_compra)
+            self._sumar('dia', dia, precio, id_compra)
+            self._cambios = True
+
+    def cargar(self):
+        """Carga ESTADISTICAS_FILE. Devuelve False si no existe (hace falta reconstruir)."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.warning(f"{self.path} ilegible: {e}")
+            return False
+        with self._lock:
+            self._vaciar()
+            self.datos.update(datos)
+        return True
+
+    def guardar(self, forzar=False):
+        with self._lock:
+            if not (self._cambios or forzar):
+                return False
+            datos = json.dumps(self.datos, ensure_ascii=False)
+            self._cambios = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(datos)
+        os.replace(tmp_path, self.path)
+        return True
+
+    def reconstruir(self):
+        """Backfill: recalcula todos los contadores desde las ventas registradas
+        (las particiones de ventas/ en CSV, la tabla `compras` en SQLite)."""
+        with self._lock:
+            self._vaciar()
+        n = 0
+        for fecha, _, id_compra, plataforma, plan, precio in storage.filas_ventas():
+            self.registrar(fecha, plataforma, plan, precio, id_compra)
+            n += 1
+        self.guardar(forzar=True)
+        logging.info(f"Estadísticas reconstruidas desde {n} filas de compras")
+        return n
+
+    def al_dia(self):
+        """Carga ESTADISTICAS_FILE y, si falta o cuenta menos filas de las que hay registradas
+        (caída antes del último guardado), reconstruye desde las ventas."""
+        if self.cargar():
+            contadas, registradas = self.datos['total'][0], storage.total_ventas()
+            if contadas == registradas:
+                return
+            logging.warning(f"{self.path} cuenta {contadas} filas de compras y hay {registradas}: se reconstruye")
+        self.reconstruir()
+
+    def resumen(self, dim, limite=None):
+        """[(clave, unidades, ingresos, compras, ticket_promedio)] ordenado por ingresos (o por día)."""
+        with self._lock:
+            filas = [(clave, u, i, c, i / c if c else 0.0) for clave, (u, i, c) in self.datos[dim].items()]
+        if dim == 'dia':
+            filas.sort(key=lambda f: f[0], reverse=True)
+        else:
+            filas.sort(key=lambda f: f[2], reverse=True)
+        return filas[:limite] if limite else filas
 
-def validar_id_compra(user_id: int, id_compra: str) -> bool:
-    """Verifica si el ID de compra pertenece a user_id.
-    Busca tanto en COMPRAS_FILE (formato global) como en historial_{user}.csv (cualquier columna).
-    """
-    id_clean = _sanitize_id(id_compra)
-    if not id_clean:
-        logging.info("validar_id_compra: id vacío después de sanitizar.")
-        return False
 
-    script_dir = Path(__file__).resolve().parent
-    posibles_global = [Path(COMPRAS_FILE), script_dir / COMPRAS_FILE]
-    posibles_hist = [Path(f"historial_{user_id}.csv"), script_dir / f"historial_{user_id}.csv"]
-    encodings_to_try = ["utf-8-sig", "utf-8", "cp1252", "latin-1"]
+estadisticas = EstadisticasVentas()
 
-    def _read_csv_try(path: Path):
-        for enc in encodings_to_try:
-            try:
-                with path.open('r', newline='', encoding=enc) as f:
-                    reader = csv.reader(f)
-                    for i, row in enumerate(reader, start=1):
-                        yield enc, i, row
-                return
-            except UnicodeDecodeError:
-                continue
-            except Exception:
-                return
+
+def reconstruir_estadisticas():
+    """Uso: python BotDeTelegram.py reconstruir-estadisticas"""
+    return estadisticas.reconstruir()
+
+
+async def estadisticas_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/estadisticas [días] - Ingresos, unidades y ticket promedio por plataforma, plan y día (solo Admin).
+    /estadisticas reconstruir - Recalcula los contadores desde las compras registradas."""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ Solo el administrador puede usar este comando.")
+        return
+
+    dias = 7
+    if context.args:
+        if context.args[0].lower() == 'reconstruir':
+            n = await en_hilo(estadisticas.reconstruir)
+            await update.message.reply_text(f"✅ Estadísticas reconstruidas a partir de {n} filas de compras.")
+            return
         try:
-            with path.open('r', newline='', encoding=encodings_to_try[-1], errors='replace') as f:
-                reader = csv.reader(f)
-                for i, row in enumerate(reader, start=1):
-                    yield encodings_to_try[-1], i, row
-        except Exception:
+            dias = max(1, int(context.args[0]))
+        except ValueError:
+            await update.message.reply_text("❌ Uso: /estadisticas [días] o /estadisticas reconstruir")
             return
 
-    # Buscar en archivo global (asume ID_Compra en col 0 y ID_Usuario en col 1)
-    for p in posibles_global:
+    unidades, ingresos, compras = estadisticas.datos['total']
+    lineas = [
+        "📈 Estadísticas de ventas",
+        "",
+        f"💰 Ingresos: ${ingresos:.2f} — 🧾 Compras: {compras} — 📦 Cuentas: {unidades}",
+        f"🎟️ Ticket promedio: ${(ingresos / compras if compras else 0.0):.2f}",
+        "",
+        "Por plataforma:",
+    ]
+    for clave, u, i, c, ticket in estadisticas.resumen('plataforma'):
+        lineas.append(f"▪️ {clave}: ${i:.2f} | {u} cuentas | ticket ${ticket:.2f}")
+    lineas += ["", "Top planes:"]
+    for clave, u, i, c, ticket in estadisticas.resumen('plan', limite=10):
+        lineas.append(f"▪️ {clave}: ${i:.2f} | {u} cuentas")
+    lineas += ["", f"Últimos {dias} días con ventas:"]
+    for clave, u, i, c, ticket in estadisticas.resumen('dia', limite=dias):
+        lineas.append(f"▪️ {clave}: ${i:.2f} | {c} compras | ticket ${ticket:.2f}")
+    await update.message.reply_text("\n".join(lineas))
+
+
+async def guardar_estadisticas_periodicamente():
+    """Tarea de fondo: guarda los contadores cada ESTADISTICAS_GUARDAR_SEGUNDOS si cambiaron."""
+    while True:
+        await asyncio.sleep(ESTADISTICAS_GUARDAR_SEGUNDOS)
         try:
-            if not p.exists():
-                continue
-            for enc, i, row in _read_csv_try(p):
-                if not row:
-                    continue
-                first = (row[0] or "").strip().upper()
-                if i == 1 and first.startswith("ID"):
-                    continue
-                row_id_raw = row[0] if len(row) > 0 else ""
-                row_id = _sanitize_id(row_id_raw)
-                row_user = None
-                if len(row) > 1:
-                    try:
-                        row_user = int(str(row[1]).strip())
-                    except Exception:
-                        row_user = None
-                if row_id == id_clean and row_user == user_id:
-                    logging.info(f"validar_id_compra: encontrado en {p} -> {row}")
-                    return True
-        except Exception:
-            logging.exception(f"validar_id_compra: error leyendo {p}")
+            await en_hilo(estadisticas.guardar)
+        except Exception as e:
+            logging.exception(f"Error guardando estadísticas: {e}")
 
-    # Buscar en historial por usuario: la ID puede estar en cualquier columna
-    for p in posibles_hist:
+
+_FECHA_ORDENABLE = re.compile(r"\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?$")
+
+def _clave_fecha(fecha_str):
+    """Clave de orden de una fecha del historial. Las que ya vienen en el formato de
+    log_compra se ordenan como texto sin parsear; sólo las viejas pasan por strptime."""
+    fecha_str = (fecha_str or "").strip()
+    if _FECHA_ORDENABLE.match(fecha_str):
+        return fecha_str
+    for fmt in ("%d/%m/%Y", "%d/%m/%Y %H:%M:%S"):
         try:
-            if not p.exists():
-                continue
-            for enc, i, row in _read_csv_try(p):
-                if not row:
-                    continue
-                for col in row:
-                    if _sanitize_id(col) == id_clean:
-                        logging.info(f"validar_id_compra: encontrado en historial {p} linea {i} -> {row}")
-                        return True
-        except Exception:
-            logging.exception(f"validar_id_compra: error leyendo historial {p}")
+            return datetime.strptime(fecha_str, fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    return ""  # sin fecha legible: al principio, como antes
 
-    logging.info(f"validar_id_compra: ID {id_compra} no encontrado para user {user_id}")
-    return False
+
+class HistorialCache:
+    """Exportaciones de /historial ya renderizadas (bytes del CSV) por usuario.
+    log_compra invalida la del usuario cuando la compra ya está en disco; la versión evita
+    guardar una exportación que se armó con el archivo anterior a esa compra. Guarda como máximo `maximo` usuarios."""
+
+    def __init__(self, maximo=200):
+        self.maximo = maximo
+        self._exportes = OrderedDict()
+        self._versiones = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def version(self, user_id):
+        return self._versiones[user_id]
+
+    def get(self, user_id):
+        with self._lock:
+            contenido = self._exportes.get(user_id)
+            if contenido is not None:
+                self._exportes.move_to_end(user_id)
+            return contenido
+
+    def guardar(self, user_id, version, contenido):
+        with self._lock:
+            if self._versiones[user_id] != version:
+                return
+            self._exportes[user_id] = contenido
+            self._exportes.move_to_end(user_id)
+            while len(self._exportes) > self.maximo:
+                self._exportes.popitem(last=False)
+
+    def invalidar(self, user_id):
+        with self._lock:
+            self._versiones[user_id] += 1
+            self._exportes.pop(user_id, None)
+
+
+historial_cache = HistorialCache()
+
+
+@cronometrado
+def _exportar_historial(target_id):
+    """CSV del historial de target_id ordenado por fecha, como bytes (sin archivo temporal).
+    Devuelve None si no hay compras. Se ejecuta en un hilo; usa y llena `historial_cache`."""
+    contenido = historial_cache.get(target_id)
+    if contenido is not None:
+        return contenido
+    version = historial_cache.version(target_id)
+    filas = storage.historial_usuario(target_id)
+    if filas is None:
+        return None
+    # log_compra agrega en orden cronológico: las filas van al buffer a medida que se leen.
+    # Sólo un historial viejo con fechas desordenadas se vuelve a leer entero para ordenarlo.
+    texto = _csv_historial_en_orden(filas)
+    if texto is None:
+        texto = _csv_historial_en_orden(sorted(storage.historial_usuario(target_id) or (),
+                                               key=lambda fila: _clave_fecha(fila[0])))
+    if not texto:
+        return None
+    contenido = texto.encode('utf-8')
+    historial_cache.guardar(target_id, version, contenido)
+    return contenido
+
+
+def _csv_historial_en_orden(filas):
+    """Escribe las filas en un CSV en memoria mientras lleguen ordenadas por fecha.
+    Devuelve el texto, '' si no hubo filas o None si una llegó antes que la anterior."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(HISTORIAL_HEADER)
+    anterior = None
+    for fila in filas:
+        clave = _clave_fecha(fila[0])
+        if anterior is not None and clave < anterior:
+            return None
+        writer.writerow(fila)
+        anterior = clave
+    return buf.getvalue() if anterior is not None else ''
 
 async def historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/historial [ID] - Envía al usuario su historial o, si es admin y pasa ID, el historial de ese usuario.
-    Genera un CSV temporal con columnas ordenadas:
+    Envía un CSV con columnas ordenadas:
       Fecha de entrega, Plan, Correo, Contraseña, Precio, ID_Compra
-    y filas ordenadas por fecha ascendente.
+    y filas ordenadas por fecha ascendente. El CSV se arma en memoria y queda en caché
+    hasta la próxima compra del usuario.
     """
     requester = update.message.from_user.id
     target_id = requester
@@ -1119,94 +3755,16 @@ async def historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ ID inválido. Uso: /historial <ID_USUARIO> (solo admin)")
             return
 
-    historial_path = Path(f'historial_{target_id}.csv')
-    if not historial_path.exists() or historial_path.stat().st_size == 0:
+    # Lectura, ordenado y armado del CSV se hacen en el pool de persistencia
+    contenido = await en_hilo(_exportar_historial, target_id)
+    if contenido is None:
         if requester == target_id:
             await update.message.reply_text("❌ Aún no tienes compras registradas en tu historial.")
         else:
             await update.message.reply_text(f"❌ El usuario `{target_id}` no tiene historial o el archivo no existe.", parse_mode="Markdown")
         return
 
-    # Leer y parsear con fallback de encoding
-    rows = []
-    header = None
-    try:
-        with historial_path.open('r', newline='', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for i, row in enumerate(reader):
-                if i == 0:
-                    header = row
-                else:
-                    rows.append(row)
-    except Exception:
-        with historial_path.open('r', newline='', encoding='latin-1', errors='replace') as f:
-            reader = csv.reader(f)
-            header = next(reader, None)
-            rows = list(reader)
-
-    def _index_of_any(hdr, candidates):
-        if not hdr:
-            return None
-        low = [c.lower().strip() for c in hdr]
-        for cand in candidates:
-            for j, val in enumerate(low):
-                if cand in val:
-                    return j
-        return None
-
-    fecha_idx = _index_of_any(header, ['fecha', 'fecha de entrega', 'date'])
-    plan_idx = _index_of_any(header, ['plan'])
-    correo_idx = _index_of_any(header, ['correo', 'email'])
-    pass_idx = _index_of_any(header, ['contraseña', 'password', 'pass'])
-    precio_idx = _index_of_any(header, ['precio', 'price'])
-    id_idx = _index_of_any(header, ['id_compra', 'id', 'id de compra'])
-
-    # Fallbacks por posiciones si no se encuentran
-    if header is None and rows:
-        if len(rows[0]) == 6:
-            fecha_idx, plan_idx, correo_idx, pass_idx, precio_idx, id_idx = range(6)
-
-    normalized = []
-    for r in rows:
-        def safe_get(idx):
-            return r[idx].strip() if idx is not None and idx < len(r) else ''
-        fecha_str = safe_get(fecha_idx) or safe_get(1) or safe_get(0)
-        plan = safe_get(plan_idx) or safe_get(2) or ''
-        correo = safe_get(correo_idx) or safe_get(3) or ''
-        passwd = safe_get(pass_idx) or safe_get(4) or ''
-        precio = safe_get(precio_idx) or safe_get(5) or ''
-        idc = safe_get(id_idx) or ''
-        fecha_obj = None
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y", "%d/%m/%Y %H:%M:%S"):
-            try:
-                fecha_obj = datetime.strptime(fecha_str, fmt)
-                break
-            except Exception:
-                continue
-        if fecha_obj is None:
-            fecha_obj = datetime.min
-        normalized.append((fecha_obj, fecha_str, plan, correo, passwd, precio, idc))
-
-    normalized.sort(key=lambda x: x[0])
-
-    # Crear CSV temporal ordenado
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.csv', prefix=f'historial_{target_id}_', mode='w', newline='', encoding='utf-8')
-    tmp_name = tmp.name
-    try:
-        with tmp:
-            writer = csv.writer(tmp)
-            writer.writerow(['Fecha de entrega', 'Plan', 'Correo', 'Contraseña', 'Precio', 'ID_Compra'])
-            for item in normalized:
-                fecha_str = item[1] or item[0].strftime('%Y-%m-%d %H:%M:%S')
-                writer.writerow([fecha_str, item[2], item[3], item[4], item[5], item[6]])
-
-        with open(tmp_name, 'rb') as f:
-            await update.message.reply_document(document=f, filename=f"historial_compras_{target_id}.csv", caption=f"📂 Historial de compras de {target_id}")
-    finally:
-        try:
-            os.unlink(tmp_name)
-        except Exception:
-            pass
+    await update.message.reply_document(document=contenido, filename=f"historial_compras_{target_id}.csv", caption=f"📂 Historial de compras de {target_id}")
 
 def entregar_cuenta(plataforma: str, tipo: str, precio_buscado: float):
     """Entrega el siguiente perfil/disponible y actualiza el stock.
@@ -1215,60 +3773,14 @@ def entregar_cuenta(plataforma: str, tipo: str, precio_buscado: float):
       - perfil:   [plataforma, tipo, correo, pass, precio, perfiles_disponibles, perfil_actual]
     Devuelve [plataforma, tipo, correo, password, precio, perfil_entregado]
     perfil_entregado == 0 -> cuenta completa; >0 -> número de perfil entregado.
+    La selección y el descuento se hacen sobre `stock_index`; la fila agotada se elimina
+    en el mismo paso, por lo que ya no hace falta un `cleanup_stock` posterior.
     """
-    cuentas = load_stock()
-    for i, row in enumerate(cuentas):
-        if len(row) < 5:
-            continue
-
-        stock_plataforma = row[0].strip()
-        stock_tipo = row[1].strip()
-        correo = row[2] if len(row) > 2 else ''
-        password = row[3] if len(row) > 3 else ''
-        # Precio protegido y normalizado
-        try:
-            stock_precio = float(str(row[4]).strip())
-        except (ValueError, TypeError):
-            continue
-
-        # Coincidencia de plataforma/tipo/precio (tolerancia pequeña)
-        if stock_plataforma.strip().lower() != plataforma.strip().lower():
-            continue
-        if stock_tipo.strip().lower() != tipo.strip().lower():
-            continue
-        if abs(stock_precio - precio_buscado) > 0.01:
-            continue
-
-        # Caso: cuenta por perfil (con campos 5 y 6)
-        if len(row) >= 7:
-            try:
-                perfiles_disponibles = int(row[5])
-                perfil_actual = int(row[6])
-            except (ValueError, TypeError):
-                # Datos corruptos -> saltar fila
-                continue
-
-            perfil_entregado = perfil_actual
-            if perfiles_disponibles > 1:
-                # CORRECCIÓN: usar 'perfiles_disponibles' (no 'perfil_disponibles')
-                cuentas[i][5] = str(perfiles_disponibles - 1)
-                cuentas[i][6] = str(perfil_actual + 1)
-            else:
-                # Último perfil: eliminar la fila
-                del cuentas[i]
-            save_stock(cuentas)
-            # Hacer limpieza adicional por si hay filas con perfiles <=0
-            cleanup_stock()
-            return [stock_plataforma, stock_tipo, correo, password, stock_precio, perfil_entregado]
-
-        # Caso: cuenta completa (no perfiles) -> eliminar la fila al entregar
-        else:
-            del cuentas[i]
-            save_stock(cuentas)
-            cleanup_stock()
-            return [stock_plataforma, stock_tipo, correo, password, stock_precio, 0]
-
-    return None
+    fila, entrega = stock_index.tomar(plataforma, tipo, precio_buscado)
+    if entrega is None:
+        return None
+    persistir_stock('take', fila)
+    return entrega
 
 
 # --- Flujo de Borrado de Stock (Admin) ---
@@ -1316,32 +3828,21 @@ async def borrar_stock_menu_callback(update: Update, context: ContextTypes.DEFAU
         await query.edit_message_text("❌ Solo el administrador puede borrar stock.")
         return
 
-    stock_list = load_stock()
-    if not stock_list:
+    if not stock_index.filas:
         await query.edit_message_text("📦 El inventario está vacío. No hay nada para borrar.",
                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver", callback_data="empezar")]]))
         return
 
-    # Agrupar por categoría
-    stock_by_category = defaultdict(list)
-    for row in stock_list:
-        tipo_lower = (row[1] if len(row) > 1 else "").lower()
-        if 'completa' in tipo_lower and 'perfil' not in tipo_lower:
-            stock_by_category['completa'].append(row)
-        elif 'perfil' in tipo_lower:
-            stock_by_category['perfil'].append(row)
-        else:
-            stock_by_category['otro'].append(row)
-
-    context.user_data['stock_to_delete'] = stock_list
+    # Contar por categoría (las listas se arman por página desde `stock_index`, sin copiar el stock a la sesión)
+    por_categoria = Counter(_categoria_borrado(row) for row in stock_index.filas)
 
     keyboard = []
-    if stock_by_category['completa']:
-        keyboard.append([InlineKeyboardButton(f"🥇 Cuentas Completas ({len(stock_by_category['completa'])})", callback_data="borrar_completa")])
-    if stock_by_category['perfil']:
-        keyboard.append([InlineKeyboardButton(f"👥 Cuentas por Perfil ({len(stock_by_category['perfil'])})", callback_data="borrar_perfil")])
-    if stock_by_category['otro']:
-        keyboard.append([InlineKeyboardButton(f"❓ Otros Tipos ({len(stock_by_category['otro'])})", callback_data="borrar_otro")])
+    if por_categoria['completa']:
+        keyboard.append([InlineKeyboardButton(f"🥇 Cuentas Completas ({por_categoria['completa']})", callback_data="borrar_completa")])
+    if por_categoria['perfil']:
+        keyboard.append([InlineKeyboardButton(f"👥 Cuentas por Perfil ({por_categoria['perfil']})", callback_data="borrar_perfil")])
+    if por_categoria['otro']:
+        keyboard.append([InlineKeyboardButton(f"❓ Otros Tipos ({por_categoria['otro']})", callback_data="borrar_otro")])
 
     keyboard.append([InlineKeyboardButton("⬅️ Volver", callback_data="borrar_venta_menu")])
     await query.edit_message_text("🗑️ Selecciona la categoría de stock que deseas eliminar:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
@@ -1405,68 +3906,154 @@ async def vaciar_combos_callback(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     combos.clear()
-    save_combos_csv()
+    await save_combos_async()
     await query.edit_message_text("✅ Se han eliminado todos los combos (lista vaciada).", parse_mode="Markdown")
 
+BORRAR_STOCK_POR_PAGINA = 10
+
+
+def _categoria_borrado(row):
+    """'completa', 'perfil' u 'otro' según el tipo, como se agrupa en /borrarventa."""
+    tipo = (row[1] if len(row) > 1 else "").lower()
+    if 'completa' in tipo and 'perfil' not in tipo:
+        return 'completa'
+    if 'perfil' in tipo:
+        return 'perfil'
+    return 'otro'
+
+
+def _describir_fila_borrado(row):
+    platform = row[0] if len(row) > 0 else 'N/A'
+    tipo = row[1] if len(row) > 1 else 'N/A'
+    correo = row[2] if len(row) > 2 else 'N/A'
+    try:
+        precio_f = float(row[4] if len(row) > 4 else 0)
+    except (ValueError, TypeError):
+        precio_f = 0.0
+    return f"{platform} ({tipo}) - ${precio_f:.2f} - Correo: {correo}"
+
+
+def _pagina_borrado(categoria, pagina):
+    """Texto y teclado de una página de /borrarventa: un botón por cuenta con su ID de stock."""
+    ids = [sid for sid, row in stock_index._por_id.items() if _categoria_borrado(row) == categoria]
+    if not ids:
+        return None, None
+    paginas = (len(ids) + BORRAR_STOCK_POR_PAGINA - 1) // BORRAR_STOCK_POR_PAGINA
+    pagina = max(0, min(pagina, paginas - 1))
+    inicio = pagina * BORRAR_STOCK_POR_PAGINA
+    ids_pagina = ids[inicio:inicio + BORRAR_STOCK_POR_PAGINA]
+
+    texto = f"🗑️ Stock Disponible para Borrar ({categoria.capitalize()}) — página {pagina + 1}/{paginas}:\n\n"
+    botones = []
+    for i, sid in enumerate(ids_pagina, inicio + 1):
+        texto += f"{i}. {_describir_fila_borrado(stock_index.por_id(sid))}\n"
+        botones.append(InlineKeyboardButton(f"🗑️ {i}", callback_data=f"borrarstock_ver_{categoria}_{pagina}_{sid}"))
+    texto += "\n👉 Toca el número de la cuenta que deseas eliminar."
+
+    keyboard = [botones[i:i + 5] for i in range(0, len(botones), 5)]
+    navegacion = []
+    if pagina > 0:
+        navegacion.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"borrar_{categoria}_{pagina - 1}"))
+    if pagina < paginas - 1:
+        navegacion.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"borrar_{categoria}_{pagina + 1}"))
+    if navegacion:
+        keyboard.append(navegacion)
+    keyboard.append([InlineKeyboardButton("⬅️ Volver a Categorías", callback_data="borrar_stock")])
+    return texto, InlineKeyboardMarkup(keyboard)
+
+
 async def mostrar_lista_borrar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Muestra la lista de stock filtrada por categoría (callback 'borrar_{completa|perfil|otro}')."""
+    """Muestra una página del stock de una categoría (callback 'borrar_{completa|perfil|otro}[_página]')."""
     query = update.callback_query
     await query.answer()
-    data = query.data.replace('borrar_', '')  # 'completa'|'perfil'|'otro'
-    stock_list = context.user_data.get('stock_to_delete')
+    if not is_admin(query.from_user.id):
+        await query.edit_message_text("❌ Solo el administrador puede borrar stock.")
+        return
+    _, categoria, *resto = query.data.split('_')
+    pagina = int(resto[0]) if resto else 0
 
-    if not stock_list:
+    texto, reply_markup = _pagina_borrado(categoria, pagina)
+    if texto is None:
         await query.edit_message_text(
-            "❌ Error: Stock no encontrado en la sesión. Usa /borrarventa de nuevo.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
+            f"❌ No hay stock de tipo '{categoria}' para eliminar.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver", callback_data="borrar_venta_menu")]])
         )
         return
+    await query.edit_message_text(texto, reply_markup=reply_markup)
 
-    filtered_stock = []
-    for row in stock_list:
-        if not row or len(row) < 2:
-            continue
-        tipo = (row[1] or "").lower()
-        if data == 'completa' and 'completa' in tipo and 'perfil' not in tipo:
-            filtered_stock.append(row)
-        elif data == 'perfil' and 'perfil' in tipo:
-            filtered_stock.append(row)
-        elif data == 'otro' and 'completa' not in tipo and 'perfil' not in tipo:
-            filtered_stock.append(row)
-
-    if not filtered_stock:
+
+async def borrar_stock_item_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """'borrarstock_ver_{cat}_{pág}_{id}' pide confirmación; 'borrarstock_ok_...' elimina la fila por su ID."""
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(query.from_user.id):
+        await query.edit_message_text("❌ Solo el administrador puede borrar stock.")
+        return
+    _, accion, categoria, pagina, sid = query.data.split('_', 4)
+    volver = InlineKeyboardButton("⬅️ Volver a la lista", callback_data=f"borrar_{categoria}_{pagina}")
+
+    if accion == 'ver':
+        row = stock_index.por_id(sid)
+        if row is None:
+            await query.edit_message_text("❌ Esa cuenta ya no está en el stock (se vendió o se eliminó).",
+                                          reply_markup=InlineKeyboardMarkup([[volver]]))
+            return
         await query.edit_message_text(
-            f"❌ No hay stock de tipo '{data}' para eliminar.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver", callback_data="borrar_venta_menu")]])
-        )
+            f"🗑️ ¿Eliminar esta cuenta del stock?\n\n{_describir_fila_borrado(row)}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Sí, eliminar", callback_data=f"borrarstock_ok_{categoria}_{pagina}_{sid}")],
+                [volver]]))
         return
 
-    context.user_data['filtered_stock'] = filtered_stock
+    # Sin ventas a medio guardar: una que fallara devolvería la fila recién eliminada
+    async with inventario_exclusivo():
+        row = stock_index.quitar_id(sid)
+        if row is not None:
+            await persistir_stock_async('del', list(row))
+    if row is None:
+        aviso = "❌ Esa cuenta ya no está en el stock (se vendió o se eliminó)."
+    else:
+        aviso = f"✅ Cuenta eliminada: {_describir_fila_borrado(row)}"
+    texto, reply_markup = _pagina_borrado(categoria, int(pagina))
+    if texto is None:
+        await query.edit_message_text(f"{aviso}\n\nNo queda stock de tipo '{categoria}'.",
+                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver", callback_data="borrar_stock")]]))
+    else:
+        await query.edit_message_text(f"{aviso}\n\n{texto}", reply_markup=reply_markup)
 
-    message = f"🗑️ Stock Disponible para Borrar ({data.capitalize()}):\n\n"
-    for i, row in enumerate(filtered_stock):
-        platform = row[0] if len(row) > 0 else 'N/A'
-        tipo = row[1] if len(row) > 1 else 'N/A'
-        correo = row[2] if len(row) > 2 else 'N/A'
-        precio = row[4] if len(row) > 4 else (row[-2] if len(row) >= 2 else '0')
-        try:
-            precio_f = float(precio)
-        except (ValueError, TypeError):
-            precio_f = 0.0
-        message += f"{i+1}. {platform} ({tipo}) - ${precio_f:.2f} - Correo: {correo}\n"
 
-    message += f"\n👉 Envía el número (1 a {len(filtered_stock)}) de la cuenta que deseas eliminar, o /cancel."
+BUSCAR_STOCK_MAX_RESULTADOS = 20
 
-    keyboard = [[InlineKeyboardButton("⬅️ Volver a Categorías", callback_data="borrar_venta_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.edit_message_text(message, reply_markup=reply_markup, parse_mode="Markdown")
-    context.user_data['awaiting_delete_index'] = True
+async def buscar_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/buscar <texto> (Admin) - Cuentas en stock cuyo correo o plataforma empieza por el texto,
+    con un botón para eliminar cada una."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo el administrador puede buscar en el stock.")
+        return
+    texto = " ".join(context.args).strip() if context.args else ""
+    if not texto:
+        await update.message.reply_text("❌ Uso: /buscar <correo o plataforma>\nEj: /buscar juan  ·  /buscar netf")
+        return
+
+    resultados = stock_index.buscar(texto, BUSCAR_STOCK_MAX_RESULTADOS + 1)
+    if not resultados:
+        await update.message.reply_text(f"🔎 No hay cuentas en stock que empiecen por '{texto}'.")
+        return
+    mensaje = f"🔎 Stock que empieza por '{texto}':\n\n"
+    botones = []
+    for i, (sid, row) in enumerate(resultados[:BUSCAR_STOCK_MAX_RESULTADOS], 1):
+        mensaje += f"{i}. {_describir_fila_borrado(row)}\n"
+        botones.append(InlineKeyboardButton(f"🗑️ {i}", callback_data=f"borrarstock_ver_{_categoria_borrado(row)}_0_{sid}"))
+    if len(resultados) > BUSCAR_STOCK_MAX_RESULTADOS:
+        mensaje += f"\n… mostrando las primeras {BUSCAR_STOCK_MAX_RESULTADOS}; afina la búsqueda para ver el resto."
+    keyboard = [botones[i:i + 5] for i in range(0, len(botones), 5)]
+    await update.message.reply_text(mensaje, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-# Modificar borrar_stock_por_indice para manejar también eliminación de combos cuando corresponde
 async def borrar_stock_por_indice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Maneja la eliminación por índice tanto para stock como para combos (admin)."""
+    """Maneja la eliminación de combos por número (admin). El stock se borra con los botones
+    de la lista paginada (borrar_stock_item_callback)."""
     user_id = update.message.from_user.id
     if not is_admin(user_id):
         return
@@ -1501,7 +4088,7 @@ async def borrar_stock_por_indice(update: Update, context: ContextTypes.DEFAULT_
                 break
 
         if removed:
-            save_combos_csv()
+            await save_combos_async()
             await update.message.reply_text(f"✅ Combo eliminado: *{target.get('titulo','Sin título')}*.", parse_mode="Markdown")
         else:
             await update.message.reply_text("❌ Error: no se pudo encontrar el combo exacto. La lista pudo cambiar. Intenta de nuevo.")
@@ -1511,57 +4098,56 @@ async def borrar_stock_por_indice(update: Update, context: ContextTypes.DEFAULT_
         context.user_data.pop('combo_list_for_delete', None)
         return
 
-    # 2) Flujo original: eliminación de stock por índice
-    if not context.user_data.get('awaiting_delete_index'):
-        return
-
-    try:
-        index_to_delete = int(text) - 1
-    except ValueError:
-        await update.message.reply_text("❌ Por favor, ingresa un número válido.")
-        return
-
-    filtered_stock = context.user_data.get('filtered_stock')
-    if not filtered_stock:
-        await update.message.reply_text("❌ Error en la sesión de borrado. Usa /borrarventa para empezar de nuevo.")
-        context.user_data.pop('awaiting_delete_index', None)
-        return
-
-    if index_to_delete < 0 or index_to_delete >= len(filtered_stock):
-        await update.message.reply_text(f"❌ Número fuera de rango. Debe ser entre 1 y {len(filtered_stock)}.")
-        return
 
-    item_to_delete = filtered_stock[index_to_delete]
-    all_stock = load_stock()
-    found = False
-    for i, row in enumerate(all_stock):
-        if row == item_to_delete:
-            del all_stock[i]
-            found = True
-            break
+# --- Flujo de Compra: Selección de Categoría, Plataforma y Tipo ---
+TOKEN_COMPRA_TTL = int(os.environ.get("BOT_TOKEN_COMPRA_TTL", "86400"))  # segundos que vale un botón de compra
+TOKEN_COMPRA_MAXIMO = 50000
+
+
+class TokensCallback:
+    """Tokens cortos y opacos para callback_data: 'cp_<token>' en vez de codificar la clave en el texto.
+    Cada token apunta a una clave (p. ej. (categoria, plataforma)) y vence a los `ttl` segundos;
+    la misma clave reutiliza su token y le renueva el plazo, así el registro crece con las claves
+    vivas y no con cada menú mostrado. Solo se usa desde el event loop."""
+
+    def __init__(self, ttl=TOKEN_COMPRA_TTL, maximo=TOKEN_COMPRA_MAXIMO):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._claves = OrderedDict()  # token -> (vence, clave), en orden de vencimiento
+        self._tokens = {}  # clave -> token
+
+    def _purgar(self, ahora):
+        while self._claves:
+            token, (vence, clave) = next(iter(self._claves.items()))
+            if vence > ahora and len(self._claves) <= self.maximo:
+                break
+            self._claves.popitem(last=False)
+            self._tokens.pop(clave, None)
+
+    def token(self, clave):
+        """Token (8 caracteres [A-Za-z0-9_-]) para la clave."""
+        ahora = time.monotonic()
+        token = self._tokens.get(clave)
+        if token is None:
+            token = secrets.token_urlsafe(6)
+            while token in self._claves:
+                token = secrets.token_urlsafe(6)
+            self._tokens[clave] = token
+        self._claves[token] = (ahora + self.ttl, clave)
+        self._claves.move_to_end(token)
+        self._purgar(ahora)
+        return token
+
+    def resolver(self, token):
+        """Clave del token, o None si no existe o ya venció."""
+        entrada = self._claves.get(token)
+        if entrada is None or entrada[0] <= time.monotonic():
+            return None
+        return entrada[1]
 
-    if found:
-        platform = item_to_delete[0] if len(item_to_delete) > 0 else ''
-        tipo = item_to_delete[1] if len(item_to_delete) > 1 else ''
-        correo = item_to_delete[2] if len(item_to_delete) > 2 else ''
-        save_stock(all_stock)
-        await update.message.reply_text(
-            f"✅ Cuenta eliminada:\n*{platform}* ({tipo}) - Correo: {correo}\n\nUsa /borrarventa para seguir eliminando o /start para ir al menú principal.",
-            parse_mode="Markdown"
-        )
-    else:
-        await update.message.reply_text(
-            "❌ Error: No se pudo encontrar la cuenta exacta en el archivo principal. El stock puede estar desincronizado. Intenta /borrarventa de nuevo.",
-            parse_mode="Markdown"
-        )
 
-    # limpiar estado
-    context.user_data.pop('awaiting_delete_index', None)
-    context.user_data.pop('filtered_stock', None)
-    context.user_data.pop('stock_to_delete', None)
-    
+tokens_compra = TokensCallback()
 
-# --- Flujo de Compra: Selección de Categoría, Plataforma y Tipo ---
 
 async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -1653,8 +4239,8 @@ async def show_plataformas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = []
     for platform, data in sorted(platforms_in_category.items()):
         precio_min = data['precio']
-        clean_platform = platform.replace(' ', '~')
-        keyboard.append([InlineKeyboardButton(f"▶️ {platform} (Desde ${precio_min:.2f})", callback_data=f"select_{category}_{clean_platform}")])
+        token = tokens_compra.token((category, platform))
+        keyboard.append([InlineKeyboardButton(f"▶️ {platform} (Desde ${precio_min:.2f})", callback_data=f"cp_{token}")])
     keyboard.append([InlineKeyboardButton("⬅️ Volver a Categorías", callback_data="show_categories")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     texto = f"✅ {category.capitalize()} Disponibles:\n\nSelecciona una plataforma:"
@@ -1671,178 +4257,35 @@ async def show_plataformas(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_platform_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Todas las compras son directas: al seleccionar una plataforma, se compra el primer stock disponible.
-    No se muestran submenús de tipos/perfiles.
+    No se muestran submenús de tipos/perfiles. El botón trae un token de `tokens_compra`.
     """
     query = update.callback_query
-    await query.answer()
-
-    parts = query.data.split('_')
-    category = parts[1]
-    platform_parts = parts[2:]
-    platform = "_".join(platform_parts).replace('~', ' ')
-
-    # Buscar el primer stock disponible de la plataforma y categoría seleccionada
-    all_stock = load_stock()
-    for row in all_stock:
-        # Protección contra filas cortas o malformadas
-        if not row or len(row) < 2:
-            logging.debug(f"handle_platform_selection: fila inválida ignorada: {row}")
-            continue
-
-        stock_platform = row[0].strip() if len(row) > 0 else ''
-        stock_tipo = row[1].strip() if len(row) > 1 else ''
-        precio_str = row[4] if len(row) > 4 else row[-1]
-        try:
-            stock_precio = float(str(precio_str).strip())
-        except (ValueError, TypeError):
-            continue
-
-        tipo_lower = stock_tipo.lower()
-        plataforma_clave = stock_platform.strip()
-        
-        categoria = 'otro'
-        if 'perfil' in tipo_lower and 'completa' not in tipo_lower:
-            categoria = 'perfil'
-        elif 'completa' in tipo_lower and 'perfil' not in tipo_lower:
-            categoria = 'completa'
-        else:
-            # Lógica de respaldo
-            if tipo_lower.startswith(('1 perfil', 'perfil')):
-                categoria = 'perfil'
-            elif tipo_lower.startswith(('cuenta', 'full', 'premium', 'basico', 'estandar', 'completa')):
-                categoria = 'completa'
-
-        if stock_platform.strip().lower() == platform.strip().lower() and categoria == category:
-            try:
-                clean_platform = platform.replace('~', ' ')
-                clean_type = stock_tipo.replace('~', ' ')
-                callback_data = f"buy_{category}_{clean_platform}_{clean_type}_{stock_precio}"
-
-                # Construir fake_update compatible: incluir callback_query, effective_user y message
-                fake_query = SimpleNamespace()
-                fake_query.data = callback_data
-                fake_query.from_user = query.from_user
-                fake_query.answer = query.answer
-                fake_query.message = query.message
-
-                fake_update = SimpleNamespace()
-                fake_update.callback_query = fake_query
-                fake_update.effective_user = query.from_user  # necesario para show_main_menu y otros
-                fake_update.message = query.message  # por si alguna función usa update.message
-
-                await handle_compra_final(fake_update, context, callback_data=callback_data)
-                return
-            except (ValueError, TypeError) as e:
-                logging.debug(f"handle_platform_selection: precio inválido en fila {row}: {e}")
-                continue
-
-    # Si no hay stock
-    await query.edit_message_text(
-        f"❌ No hay stock disponible para {platform} en este momento.",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver a Categorías", callback_data="show_categories")]])
-    )
-
-
-async def handle_compra_final(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data=None):
-    query = update.callback_query
-    # RESPONDER AL CALLBACK PARA QUE EL CLIENTE DEJE DE CARGAR
     try:
         await query.answer()
     except Exception as e:
-        logging.debug(f"Ignored query.answer() error in handle_compra_final: {e}")
-
-    if callback_data is None:
-        callback_data = query.data
-
-    # 1. Validar saldo
-    user_id = query.from_user.id
-    inicializar_usuario(user_id)
-    
-    parts = callback_data.split('_')
-    
-    # Protección: validar estructura mínima del callback_data
-    if len(parts) < 4:
-        logging.error(f"Callback data malformado: {callback_data}")
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="❌ Error interno: datos de compra inválidos. Intenta de nuevo.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
-        )
-        return
+        logging.debug(f"handle_platform_selection: query.answer falló: {e}")
 
-    category = parts[1]
-    price_str = parts[-1] 
-    
-    try:
-        precio_final = float(price_str)
-    except ValueError:
-        logging.error(f"Precio inválido en callback_data: {callback_data}")
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="❌ Error en el precio. Compra cancelada.", 
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
-        )
-        return
-
-    prev_balance = clientes.get(user_id, 0.0)
-    if prev_balance < precio_final:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"❌ Saldo insuficiente. Necesitas ${precio_final:.2f} y solo tienes ${prev_balance:.2f}.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💰 Recargar saldo", callback_data="mostrar_recarga")], [InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]]),
-            parse_mode="Markdown"
-        )
-        return
-
-    # 2. Entregar Cuenta y Descontar Stock
-    # Extraer campos esperados con protección de índices
-    clean_platform = parts[-3] if len(parts) >= 3 else ''
-    clean_type = parts[-2] if len(parts) >= 2 else ''
-
-    # Normalizar para uso en mensajes y para entregar_cuenta
-    platform = clean_platform.replace('~', ' ')
-    stock_type = clean_type.replace('~', ' ')
-
-    logging.info(f"Compra solicitada por user {user_id}: categoria={category}, platform={platform}, type={stock_type}, precio={precio_final:.2f}")
-
-    cuenta_data = entregar_cuenta(platform, stock_type, precio_final)
-
-    if not cuenta_data:
-        # Usar variables garantizadas para evitar NameError
-        safe_platform = platform or clean_platform.replace('~', ' ')
-        safe_stock_type = stock_type or clean_type.replace('~', ' ')
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"❌ Lo sentimos, el stock de {safe_platform} ({safe_stock_type}) se agotó justo antes de completar tu compra.",
+    clave = tokens_compra.resolver(query.data.partition('_')[2])
+    if clave is None:
+        # Token vencido o botón 'select_' de un menú anterior
+        await query.edit_message_text(
+            "⌛ Este menú ya venció. Vuelve a elegir la categoría para ver el stock actual.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver a Categorías", callback_data="show_categories")]])
         )
-        return 
-
-    # 3. Finalizar Transacción
-    _, plan_entregado, correo, password, _, perfil_entregado = cuenta_data
-
-    # Descontar saldo 
-    clientes[user_id] -= precio_final 
-    guardar_clientes()
-    remaining = clientes[user_id]
-
-    # Generar ID de Compra
-    id_compra = str(uuid.uuid4()).split('-')[0].upper() # Genera un ID corto y aleatorio
-
-    # Log de la compra
-    log_compra(user_id, plan_entregado, correo, password, precio_final, id_compra)
+        return
+    category, platform = clave
+    await handle_compra_final(update, context, category, platform)
 
-    # 4. Enviar cuenta al usuario (NUEVO MENSAJE)
-    logging.info(f"Entrega preparada: cuenta_data={cuenta_data}, user_id={user_id}, precio={precio_final:.2f}, saldo_restante={remaining:.2f}, id_compra={id_compra}")
 
-    # Perfil / dispositivos
+def _textos_perfil(perfil_entregado):
+    """(perfil, dispositivos) para los mensajes de entrega; 0 = cuenta completa."""
     if perfil_entregado == 0:
-        perfil_text = "Cuenta Completa"
-        dispositivos_text = "Todos los dispositivos"
-    else:
-        perfil_text = f"Perfil {perfil_entregado}"
-        dispositivos_text = "1 dispositivo"
+        return "Cuenta Completa", "Todos los dispositivos"
+    return f"Perfil {perfil_entregado}", "1 dispositivo"
 
+def _mensaje_entrega(platform, correo, password, perfil_entregado, precio_final, id_compra, remaining):
+    """Texto de entrega de una cuenta suelta y el texto del perfil (para el material)."""
+    perfil_text, dispositivos_text = _textos_perfil(perfil_entregado)
     mensaje_entrega = (
         "🎉 ¡Tu cuenta ha sido entregada! 🎉\n"
         "--------------------------------------\n"
@@ -1859,39 +4302,108 @@ async def handle_compra_final(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"💳 Saldo restante: ${remaining:.2f}\n\n"
         "Guarda este ID para cualquier reporte. ¡Disfruta!\n"
     )
+    return mensaje_entrega, perfil_text
+
+async def handle_compra_final(update: Update, context: ContextTypes.DEFAULT_TYPE, category, platform):
+    """Compra la primera cuenta disponible de `platform` en `category` ('completa' o 'perfil').
+    El tipo y el precio se toman de esa fila con el inventario bloqueado, sin volver a buscarla."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    inicializar_usuario(user_id)
+    logging.info(f"Compra solicitada por user {user_id}: categoria={category}, platform={platform}")
+
+    # Saldo bloqueado durante toda la compra e inventario durante el chequeo y la reserva: con
+    # updates concurrentes nunca se vende dos veces el mismo perfil ni se gasta dos veces el saldo
+    cuenta_data = None
+    precio_final = None
+    async with lock_saldo(user_id):
+        prev_balance = clientes.get(user_id, 0.0)
+        # El inventario se bloquea sólo para elegir y descontar la fila; ésta queda ocupada
+        # (ninguna otra venta la toma) mientras la venta se guarda sin el lock
+        async with inventario_para_reservar():
+            fila = stock_index.primera(category, platform)
+            # Si lo que queda está ocupado por ventas que se están guardando, se espera a que terminen
+            while fila is None and stock_index.hay_ocupadas(platform, category):
+                await inventario_liberado.wait()
+                fila = stock_index.primera(category, platform)
+            if fila is not None:
+                precio_final = float(str(fila[4]).strip())
+                if prev_balance >= precio_final:
+                    previas = [(fila, list(fila))]
+                    cuenta_data = stock_index.entregar(fila)
+                    if cuenta_data:
+                        stock_index.ocupar([fila])
+        if cuenta_data:
+            _, plan_entregado, correo, password, _, perfil_entregado = cuenta_data
+
+            # Descontar saldo
+            clientes[user_id] -= precio_final
+
+            # Generar ID de Compra
+            id_compra = str(uuid.uuid4()).split('-')[0].upper() # Genera un ID corto y aleatorio
+            remaining = clientes[user_id]
+
+            # 3. Mensajes de entrega: se guardan en la cola de salida junto con la venta,
+            # así si Telegram falla después del cobro la entrega se reintenta (aun tras un reinicio)
+            mensaje_entrega, perfil_text = _mensaje_entrega(platform, correo, password, perfil_entregado,
+                                                            precio_final, id_compra, remaining)
+            # La cuenta completa usa el material del perfil 1
+            entregas = [mensaje_salida(user_id, mensaje_entrega, "Markdown"),
+                        mensaje_salida(user_id, tipo='material', correo=correo, perfil=perfil_entregado or 1,
+                                       caption=f"Material para tu {perfil_text}")]
+
+            # Stock, saldo, log de la compra y entregas en una sola transacción, fuera del event loop
+            # y sin el inventario bloqueado. Si no se pudo guardar, se devuelven stock y saldo: la
+            # cuenta no se entrega. Si se cancela a mitad de la escritura no se sabe si llegó al
+            # disco: la fila sólo se libera, sin devolverla.
+            fallo = False
+            try:
+                await registrar_venta_async(
+                    user_id, [('take', list(fila))],
+                    [(plan_entregado, correo, password, precio_final, id_compra, platform)], precio_final,
+                    entregas)
+            except Exception as e:
+                logging.exception(f"Error persistiendo la compra {id_compra} de {user_id}: {e}")
+                fallo = True
+            finally:
+                await terminar_venta(previas, deshacer=fallo)
+            if fallo:
+                clientes[user_id] += precio_final
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    text="❌ No se pudo completar la compra. No se descontó saldo; intenta de nuevo.",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
+                )
+                return
+            # 4. Enviar cuenta y material al usuario: sólo ahora que la venta está guardada.
+            # Los trabajadores de la cola de salida lo hacen en orden (con reintentos y
+            # avisando al admin si no se puede)
+            salida.despachar(entregas)
 
-    # Intentar enviar el mensaje principal con manejo de errores
-    try:
+        if precio_final is not None and prev_balance < precio_final:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"❌ Saldo insuficiente. Necesitas ${precio_final:.2f} y solo tienes ${prev_balance:.2f}.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💰 Recargar saldo", callback_data="mostrar_recarga")], [InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]]),
+                parse_mode="Markdown"
+            )
+            return
+
+    if not cuenta_data:
+        metricas.contar('bot_stock_agotado_total', tipo='cuenta')
         await context.bot.send_message(
             chat_id=user_id,
-            text=mensaje_entrega,
-            parse_mode="Markdown"
+            text=f"❌ Lo sentimos, el stock de {platform} ({category.capitalize()}) se agotó justo antes de completar tu compra.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver a Categorías", callback_data="show_categories")]])
         )
-    except Exception as e:
-        logging.exception(f"Error enviando mensaje de entrega al usuario {user_id}: {e}")
-        # Notificar al admin por si falla el envío al cliente
-        try:
-            await context.bot.send_message(chat_id=ADMIN_ID, text=f"⚠️ Error enviando entrega a {user_id}: {e}")
-        except Exception:
-            logging.exception("No se pudo notificar al admin sobre el fallo de entrega.")
+        return 
 
-    # Envío de material adjunto (si existe) — usar with y captura de errores
-    material_filename = f"material_{correo}_perfil{perfil_entregado}.jpg"  # o .pdf, .png, etc.
-    if os.path.exists(material_filename):
-        try:
-            with open(material_filename, 'rb') as f:
-                await context.bot.send_document(
-                    chat_id=user_id,
-                    document=f,
-                    caption=f"Material para tu {perfil_text}"
-                )
-        except Exception as e:
-            logging.exception(f"No se pudo enviar material '{material_filename}' a {user_id}: {e}")
-            # continuar con el flujo, no abortar
+    logging.info(f"Entrega encolada: cuenta_data={cuenta_data}, user_id={user_id}, precio={precio_final:.2f}, saldo_restante={remaining:.2f}, id_compra={id_compra}")
+    metricas.contar('bot_compras_total', tipo='cuenta')
 
-    # 5. Abrir automáticamente el menú principal (NUEVO MENSAJE)
-    await show_main_menu(update, context, welcome_msg="✅ Compra exitosa. ¿Qué deseas hacer ahora?")
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, welcome_msg="Elige una opción:"):
+    # 5. Abrir automáticamente el menú principal (NUEVO MENSAJE, debajo de la entrega)
+    await show_main_menu(update, context, welcome_msg="✅ Compra exitosa. ¿Qué deseas hacer ahora?", nuevo_mensaje=True)
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, welcome_msg="Elige una opción:", nuevo_mensaje=False):
     user = update.effective_user
     if not user:
         return
@@ -1907,8 +4419,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, wel
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    # Si viene de un callback_query, editar; si no, enviar nuevo mensaje
-    if getattr(update, "callback_query", None):
+    # Si viene de un callback_query, editar; si no (o si se pide), enviar nuevo mensaje
+    if getattr(update, "callback_query", None) and not nuevo_mensaje:
         try:
             await update.callback_query.edit_message_text(welcome_msg, reply_markup=reply_markup, parse_mode="Markdown")
         except Exception:
@@ -1959,13 +4471,21 @@ async def recargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ El monto debe ser positivo.")
                 return
             inicializar_usuario(target_id)
-            clientes[target_id] += monto
-            guardar_clientes()
-            await update.message.reply_text(f"✅ Recarga exitosa a ID {target_id} de ${monto:.2f}. Saldo actual: ${clientes[target_id]:.2f}")
-            try:
-                await context.bot.send_message(chat_id=target_id, text=f"🎉 Tu saldo ha sido recargado con ${monto:.2f} por el administrador. Saldo actual: ${clientes[target_id]:.2f}", parse_mode="Markdown")
-            except Exception:
-                logging.warning(f"No se pudo enviar notificación al usuario {target_id}.")
+            async with lock_saldo(target_id):
+                saldo_anterior = clientes[target_id]
+                clientes[target_id] += monto
+                # Si el movimiento no se pudo guardar, el saldo vuelve a lo que era
+                try:
+                    await guardar_saldo_async(target_id, monto, 'recarga', user_id)
+                except Exception as e:
+                    logging.exception(f"Error guardando la recarga de ${monto:.2f} a {target_id}: {e}")
+                    clientes[target_id] = saldo_anterior
+                    await update.message.reply_text("❌ No se pudo guardar la recarga. El saldo no cambió; intenta de nuevo.")
+                    return
+                saldo_actual = clientes[target_id]
+            metricas.contar('bot_recargas_total')
+            await update.message.reply_text(f"✅ Recarga exitosa a ID {target_id} de ${monto:.2f}. Saldo actual: ${saldo_actual:.2f}")
+            await notificar(target_id, f"🎉 Tu saldo ha sido recargado con ${monto:.2f} por el administrador. Saldo actual: ${saldo_actual:.2f}", "Markdown")
         except ValueError:
             await update.message.reply_text("❌ ID de usuario o Monto inválido. Ambos deben ser números.")
         return
@@ -2045,104 +4565,17 @@ def _sanitize_id(id_str: str) -> str:
     cleaned = "".join(ch for ch in s if ch in allowed)
     return cleaned.upper()
 
+@cronometrado
 def validar_id_compra(user_id: int, id_compra: str) -> bool:
-    """Verifica si el ID de compra pertenece a user_id.
-    Intenta leer los CSV probando varias codificaciones para evitar UnicodeDecodeError.
-    Busca en compras_global.csv (CWD y carpeta del script) y en historial_{user_id}.csv."""
+    """Verifica si el ID de compra pertenece a user_id con una búsqueda directa en el índice
+    de compras (COMPRAS_INDEX_FILE, o el índice de la tabla `compras` en SQLite)."""
     id_clean = _sanitize_id(id_compra)
     if not id_clean:
         logging.info("validar_id_compra: id vacío después de sanitizar.")
         return False
 
-    script_dir = Path(__file__).resolve().parent
-
-    posibles_global = [
-        Path(COMPRAS_FILE),              # ruta relativa al CWD
-        script_dir / COMPRAS_FILE        # ruta en la carpeta del script
-    ]
-
-    posibles_hist = [
-        Path(f"historial_{user_id}.csv"),
-        script_dir / f"historial_{user_id}.csv"
-    ]
-
-    encodings_to_try = ["utf-8-sig", "utf-8", "cp1252", "latin-1"]
-
-    def _read_csv_try(path: Path):
-        """Generator: intenta abrir path usando varias codificaciones y devuelve filas."""
-        for enc in encodings_to_try:
-            try:
-                with path.open('r', newline='', encoding=enc) as f:
-                    logging.debug(f"validar_id_compra: leyendo {path} con encoding={enc}")
-                    reader = csv.reader(f)
-                    for i, row in enumerate(reader, start=1):
-                        yield enc, i, row
-                return
-            except UnicodeDecodeError as ude:
-                logging.warning(f"validar_id_compra: fallo decoding {path} with {enc}: {ude}")
-                continue
-            except Exception as e:
-                logging.exception(f"validar_id_compra: error abriendo {path} con {enc}: {e}")
-                return
-        # último intento: abrir con replacement para evitar excepciones
-        try:
-            with path.open('r', newline='', encoding=encodings_to_try[-1], errors='replace') as f:
-                logging.warning(f"validar_id_compra: usando fallback errors='replace' para {path}")
-                reader = csv.reader(f)
-                for i, row in enumerate(reader, start=1):
-                    yield encodings_to_try[-1], i, row
-        except Exception as e:
-            logging.exception(f"validar_id_compra: fallback fallo abriendo {path}: {e}")
-            return
-
-    logging.info(f"validar_id_compra: buscando ID {id_clean} para user {user_id} en rutas: {posibles_global + posibles_hist}")
-
-    # Buscar en archivos globales
-    for p in posibles_global:
-        try:
-            if not p.exists():
-                logging.debug(f"validar_id_compra: {p} no existe, saltando.")
-                continue
-            for enc, i, row in _read_csv_try(p):
-                if not row:
-                    continue
-                # Saltar cabecera si detectada
-                first = (row[0] or "").strip().upper()
-                if i == 1 and first.startswith("ID"):
-                    continue
-                row_id_raw = row[0] if len(row) > 0 else ""
-                row_id = _sanitize_id(row_id_raw)
-                row_user = None
-                if len(row) > 1:
-                    try:
-                        row_user = int(str(row[1]).strip())
-                    except Exception:
-                        row_user = None
-                logging.debug(f"validar_id_compra: {p} (enc={enc}) linea {i}: id_raw={row_id_raw!r} -> {row_id!r}, user_col={row_user}")
-                if row_id == id_clean and row_user == user_id:
-                    logging.info(f"validar_id_compra: encontrado en {p} (enc={enc}) -> {row}")
-                    return True
-        except Exception as e:
-            logging.exception(f"validar_id_compra: error leyendo {p}: {e}")
-
-    # Respaldo: buscar en historial_{user_id}.csv
-    for p in posibles_hist:
-        try:
-            if not p.exists():
-                logging.debug(f"validar_id_compra: historial {p} no existe, saltando.")
-                continue
-            for enc, i, row in _read_csv_try(p):
-                if not row:
-                    continue
-                # No asumir formato fijo de cabecera; comprobación igual
-                row_id_raw = row[0] if len(row) > 0 else ""
-                row_id = _sanitize_id(row_id_raw)
-                logging.debug(f"validar_id_compra (hist {p}) (enc={enc}): linea {i}: id_raw={row_id_raw!r} -> {row_id!r}")
-                if row_id == id_clean:
-                    logging.info(f"validar_id_compra: encontrado en historial {p} (enc={enc}) -> {row}")
-                    return True
-        except Exception as e:
-            logging.exception(f"validar_id_compra: error leyendo historial {p}: {e}")
+    if storage.compra_pertenece(user_id, id_clean):
+        return True
 
     logging.info(f"validar_id_compra: ID {id_compra} ({id_clean}) no encontrado para user {user_id}")
     return False
@@ -2218,7 +4651,7 @@ async def reporte_id_compra_recibida(update: Update, context: ContextTypes.DEFAU
 
     # VALIDACIÓN CLAVE
     try:
-        if not validar_id_compra(user_id, id_compra):
+        if not await validar_id_compra_async(user_id, id_compra):
             await update.message.reply_text(
                 f"❌ ID de Compra inválido: El ID `{raw}` no se encuentra en tu historial de compras o no te pertenece. "
                 "Verifica que el ID sea correcto e inténtalo de nuevo, o /cancel.",
@@ -2352,15 +4785,14 @@ async def reporte_descripcion_recibida(update: Update, context: ContextTypes.DEF
         "El administrador debe revisar esta cuenta. Los reportes tardan de 3-4 días máximo."
     )
 
+    # El reporte (y la foto) llegan al admin por la cola de salida
+    avisos = [mensaje_salida(ADMIN_ID, reporte_msg, "Markdown")]
+    if foto_id:
+        avisos.append(mensaje_salida(ADMIN_ID, f"🆔 ID de Compra: {data.get('id_compra','')}\n📝 Descripción: {descripcion}",
+                                     "Markdown", tipo='foto', foto=foto_id))
     try:
-        await context.bot.send_message(chat_id=ADMIN_ID, text=reporte_msg, parse_mode="Markdown")
-        if foto_id:
-            await context.bot.send_photo(
-                chat_id=ADMIN_ID,
-                photo=foto_id,
-                caption=f"🆔 ID de Compra: {data.get('id_compra','')}\n📝 Descripción: {descripcion}",
-                parse_mode="Markdown"
-            )
+        await salida.encolar(*avisos)
+        metricas.contar('bot_reportes_total')
         await update.message.reply_text(
             "✅ Reporte enviado al administrador. Nos pondremos en contacto contigo pronto.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
@@ -2513,9 +4945,9 @@ async def addcombo_plataformas(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Agrega otra plataforma o escribe 'listo' para terminar:")
 
 # Helper: plataformas únicas en stock
-def get_stock_platforms():
+async def get_stock_platforms():
     """Devuelve las plataformas únicas actualmente en stock, ordenadas."""
-    cuentas = cleanup_stock()
+    cuentas = await cleanup_stock_async()
     plataformas = []
     for row in cuentas:
         if row and len(row) > 0:
@@ -2550,7 +4982,7 @@ async def addcombo_platform_callback(update: Update, context: ContextTypes.DEFAU
         accion = "añadida"
 
     # Reconstruir teclado con marcas ✅ para seleccionadas
-    plataformas = get_stock_platforms()
+    plataformas = await get_stock_platforms()
     keyboard = []
     for plat in plataformas:
         label = plat
@@ -2607,7 +5039,7 @@ async def addcombo_finish_callback(update: Update, context: ContextTypes.DEFAULT
         return ADD_COMBO_PLATAFORMAS
 
     combos.append(combo)
-    save_combos_csv()  # Persistir al crear por botones
+    await save_combos_async()  # Persistir al crear por botones
 
     texto_confirm = f"✅ Combo creado:\n*{combo.get('titulo','Sin título')}* ({combo.get('subnombre','')})\nPrecio: ${combo.get('precio',0.0):.2f}\nPlataformas: {', '.join(plataformas)}"
     try:
@@ -2671,6 +5103,31 @@ async def show_combos_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(mensaje, reply_markup=reply_markup, parse_mode="Markdown")
 
 # Handler para mostrar combos en el menú principal
+def _mensaje_entrega_combo(combo, id_compra, precio_combo, entregados, remaining):
+    """Texto de entrega de un combo: cada ítem con perfil y dispositivos (sin mostrar "Tipo")."""
+    mensaje = (
+        f"🎉 ¡Compra del combo *{combo.get('titulo','Combo')}* realizada!\n"
+        f"🆔 ID de Compra: `{id_compra}`\n"
+        f"💲 Precio total: ${precio_combo:.2f}\n\n"
+        "📦 Cuentas entregadas:\n"
+    )
+    for entrega in entregados:
+        plat_entregado, plan_entregado, correo, password, _, perfil_entregado = entrega
+        perfil_text, dispositivos_text = _textos_perfil(perfil_entregado)
+        mensaje += (
+            f"• {plat_entregado} — {perfil_text}\n"
+            f"   Dispositivos: {dispositivos_text}\n"
+            f"   Correo: `{correo}`\n"
+            f"   Contraseña: `{password}`\n\n"
+        )
+
+    # Añadir garantía, descuento y saldo restante
+    mensaje += f"🛡️ Garantía: {GARANTIA_DIAS} días\n\n"
+    mensaje += f"🔻 Se descontó: ${precio_combo:.2f}\n"
+    mensaje += f"💳 Saldo restante: ${remaining:.2f}\n\n"
+    mensaje += "¡Gracias por tu compra! Guarda el ID de compra para cualquier reporte."
+    return mensaje
+
 async def handle_comprar_combo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Procesa la compra de un combo identificado por callback_data `comprar_combo_{i}`."""
     query = update.callback_query
@@ -2708,134 +5165,110 @@ async def handle_comprar_combo(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = query.from_user.id
     inicializar_usuario(user_id)
 
-    prev_balance = clientes.get(user_id, 0.0)
-    if prev_balance < precio_combo:
-        await query.edit_message_text(f"❌ Saldo insuficiente. Necesitas ${precio_combo:.2f} y tienes ${prev_balance:.2f}.")
-        return
+    # Mismo esquema de bloqueo que handle_compra_final: saldo del usuario + reserva del inventario
+    async with lock_saldo(user_id):
+        prev_balance = clientes.get(user_id, 0.0)
+        if prev_balance < precio_combo:
+            await query.edit_message_text(f"❌ Saldo insuficiente. Necesitas ${precio_combo:.2f} y tienes ${prev_balance:.2f}.")
+            return
 
-    simulated = load_stock()
-    selects = []  # (plataforma, tipo, precio) elegidos
-    for plat in plataformas:
-        plat_lower = plat.strip().lower()
-        found = False
-        for i, row in enumerate(simulated):
-            if not row or len(row) < 5:
-                continue
-            row_platform = (row[0] or "").strip().lower()
-            if row_platform != plat_lower:
-                continue
-            if len(row) >= 7:
-                try:
-                    perfiles_disponibles = int(row[5])
-                except Exception:
-                    continue
-                if perfiles_disponibles <= 0:
-                    continue
-                precio = 0.0
-                try:
-                    precio = float(str(row[4]).strip())
-                except Exception:
-                    pass
-                selects.append((row[0].strip(), row[1].strip(), precio))
-                if perfiles_disponibles > 1:
-                    simulated[i][5] = str(perfiles_disponibles - 1)
-                    if len(simulated[i]) > 6 and simulated[i][6].isdigit():
-                        simulated[i][6] = str(int(simulated[i][6]) + 1)
-                    else:
-                        while len(simulated[i]) < 7:
-                            simulated[i].append("1")
-                        simulated[i][6] = "2"
-                else:
-                    del simulated[i]
-                found = True
-                break
-            else:
-                precio = 0.0
-                try:
-                    precio = float(str(row[4]).strip())
-                except Exception:
-                    pass
-                selects.append((row[0].strip(), row[1].strip(), precio))
-                del simulated[i]
-                found = True
-                break
-        if not found:
-            no_stock_text = f"❌ Lo siento, ya no hay stock de *{plat}* para completar este combo."
+        async with inventario_para_reservar():
+            # Selección y descuento de todas las cuentas del combo en un solo paso:
+            # si falta stock de alguna plataforma no se toca ninguna
+            reservas, previas = stock_index.reservar(plataformas)
+            # Si lo que falta está ocupado por ventas que se están guardando, se espera a que terminen
+            while reservas is None and stock_index.hay_ocupadas(previas):
+                await inventario_liberado.wait()
+                reservas, previas = stock_index.reservar(plataformas)
+            if reservas is not None:
+                stock_index.ocupar(fila for fila, _ in previas)
+        if reservas is None:
+            metricas.contar('bot_stock_agotado_total', tipo='combo')
+            no_stock_text = f"❌ Lo siento, ya no hay stock de *{previas}* para completar este combo."
             back_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al Menú", callback_data="empezar")]])
             await query.edit_message_text(no_stock_text, reply_markup=back_markup, parse_mode="Markdown")
             return
 
-    entregados = []
-    for platform, tipo, precio_item in selects:
-        res = entregar_cuenta(platform, tipo, precio_item)
-        if not res:
-            await query.edit_message_text("❌ No se pudo completar la compra por cambio de stock. Intenta de nuevo.")
+        entregados = [entrega for _, entrega in reservas]
+        clientes[user_id] -= precio_combo
+
+        id_compra = str(uuid.uuid4()).split('-')[0].upper()
+        n_items = len(entregados)
+        precio_por_item = round(precio_combo / n_items, 2) if n_items else 0.0
+
+        compras = []
+        for entrega in entregados:
+            plat_entregado, plan_entregado, correo, password, _, perfil_entregado = entrega
+            # registrar incluyendo la plataforma en el plan para claridad en logs
+            compras.append((f"{combo.get('titulo','Combo')} - {plat_entregado} - {plan_entregado}", correo, password, precio_por_item, id_compra, plat_entregado))
+        remaining = clientes[user_id]
+        entregas = [mensaje_salida(user_id, _mensaje_entrega_combo(combo, id_compra, precio_combo, entregados, remaining), "Markdown"),
+                    mensaje_salida(ADMIN_ID, f"✅ Combo vendido: {combo.get('titulo')} a {user_id} | ID {id_compra}")]
+
+        # Stock, saldo, compras y entregas del combo en una sola transacción, fuera del event loop
+        # y sin el inventario bloqueado. Si no se pudo guardar, se devuelven stock y saldo: el combo no se entrega.
+        fallo = False
+        try:
+            await registrar_venta_async(user_id, [('take', fila) for fila, _ in reservas], compras, precio_combo, entregas)
+        except Exception as e:
+            logging.exception(f"Error persistiendo el combo {id_compra} de {user_id}: {e}")
+            fallo = True
+        finally:
+            await terminar_venta(previas, deshacer=fallo)
+        if fallo:
+            clientes[user_id] += precio_combo
+            await query.edit_message_text("❌ No se pudo completar la compra del combo. No se descontó saldo; intenta de nuevo.")
             return
-        entregados.append(res)
-
-    # Descontar saldo total y persistir
-    clientes[user_id] -= precio_combo
-    guardar_clientes()
-    remaining = clientes[user_id]
-
-    id_compra = str(uuid.uuid4()).split('-')[0].upper()
-    n_items = len(entregados)
-    precio_por_item = round(precio_combo / n_items, 2) if n_items else 0.0
-
-    for entrega in entregados:
-        plat_entregado, plan_entregado, correo, password, _, perfil_entregado = entrega
-        # registrar incluyendo la plataforma en el plan para claridad en logs
-        log_compra(user_id, f"{combo.get('titulo','Combo')} - {plat_entregado} - {plan_entregado}", correo, password, precio_por_item, id_compra)
-
-    # Construir mensaje de entrega: mostrar cada ítem con perfil y dispositivos (sin mostrar "Tipo")
-    mensaje = (
-        f"🎉 ¡Compra del combo *{combo.get('titulo','Combo')}* realizada!\n"
-        f"🆔 ID de Compra: `{id_compra}`\n"
-        f"💲 Precio total: ${precio_combo:.2f}\n\n"
-        "📦 Cuentas entregadas:\n"
-    )
-    for entrega in entregados:
-        plat_entregado, plan_entregado, correo, password, _, perfil_entregado = entrega
-
-        if perfil_entregado == 0:
-            perfil_text = "Cuenta Completa"
-            dispositivos_text = "Todos los dispositivos"
-        else:
-            perfil_text = f"Perfil {perfil_entregado}"
-            dispositivos_text = "1 dispositivo"
-
-        mensaje += (
-            f"• {plat_entregado} — {perfil_text}\n"
-            f"   Dispositivos: {dispositivos_text}\n"
-            f"   Correo: `{correo}`\n"
-            f"   Contraseña: `{password}`\n\n"
-        )
-
-    # Añadir garantía, descuento y saldo restante
-    mensaje += f"🛡️ Garantía: {GARANTIA_DIAS} días\n\n"
-    mensaje += f"🔻 Se descontó: ${precio_combo:.2f}\n"
-    mensaje += f"💳 Saldo restante: ${remaining:.2f}\n\n"
-    mensaje += "¡Gracias por tu compra! Guarda el ID de compra para cualquier reporte."
 
+    # La entrega y el aviso al admin los envía la cola de salida
+    salida.despachar(entregas)
+    metricas.contar('bot_compras_total', tipo='combo')
     try:
-        await context.bot.send_message(chat_id=user_id, text=mensaje, parse_mode="Markdown")
-        try:
-            await query.edit_message_text("✅ Compra realizada. Revisa tu chat privado para los detalles.")
-        except Exception:
-            pass
+        await query.edit_message_text("✅ Compra realizada. Revisa tu chat privado para los detalles.")
     except Exception:
-        try:
-            await query.edit_message_text("✅ Compra realizada. Revisa tu chat privado para los detalles.")
-        except Exception:
-            pass
+        pass
 
-    try:
-        await context.bot.send_message(chat_id=ADMIN_ID, text=f"✅ Combo vendido: {combo.get('titulo')} a {user_id} | ID {id_compra}")
-    except Exception:
-        logging.debug("No se pudo notificar al admin sobre la venta del combo.")
+def _exportar_clientes(filas):
+    """CSV de clientes (ID_Usuario, Saldo) escrito por bloques de 1000 filas directo al
+    buffer binario que se sube, sin armar el texto completo aparte. Se ejecuta en un hilo."""
+    archivo = io.BytesIO()
+    texto = io.TextIOWrapper(archivo, encoding='utf-8', newline='')
+    writer = csv.writer(texto)
+    writer.writerow(['ID_Usuario', 'Saldo'])
+    for inicio in range(0, len(filas), 1000):
+        writer.writerows((user_id, f"{saldo:.2f}") for user_id, saldo in filas[inicio:inicio + 1000])
+    texto.flush()
+    texto.detach()
+    archivo.seek(0)
+    return archivo
+
+def _pagina_clientes(orden, numero, tamano):
+    """Texto y teclado de una página de /verclientes."""
+    total_paginas = max(1, -(-len(clientes) // tamano))
+    numero = min(max(0, numero), total_paginas - 1)
+    mensaje = (f"🗂️ *Lista de clientes* (por {'saldo' if orden == 'saldo' else 'ID'})\n"
+               f"{len(clientes)} clientes | Saldo total: ${clientes.saldo_total:.2f}\n"
+               f"Página {numero + 1}/{total_paginas}\n\n")
+    for cid, saldo in clientes.pagina(orden, numero, tamano):
+        mensaje += f"ID: `{cid}` | Saldo: ${saldo:.2f}\n"
+
+    navegacion = []
+    if numero > 0:
+        navegacion.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"verclientes_{orden}_{tamano}_{numero - 1}"))
+    if numero < total_paginas - 1:
+        navegacion.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"verclientes_{orden}_{tamano}_{numero + 1}"))
+    otro_orden = 'id' if orden == 'saldo' else 'saldo'
+    keyboard = [
+        navegacion,
+        [InlineKeyboardButton(f"🔃 Ordenar por {'ID' if otro_orden == 'id' else 'saldo'}",
+                              callback_data=f"verclientes_{otro_orden}_{tamano}_0")],
+        [InlineKeyboardButton("📥 Descargar CSV", callback_data="verclientes_csv")],
+    ]
+    return mensaje, InlineKeyboardMarkup([fila for fila in keyboard if fila])
 
 async def ver_clientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """/verclientes - Muestra la lista de clientes con su ID y saldo (solo Admin)."""
+    """/verclientes [saldo|id] [tamaño] - Lista paginada de clientes con su ID y saldo (solo Admin).
+    Por defecto ordena por saldo (mayor primero) con CLIENTES_POR_PAGINA por página."""
     user_id = update.message.from_user.id
     if not is_admin(user_id):
         await update.message.reply_text("❌ Solo el administrador puede usar este comando.")
@@ -2845,10 +5278,45 @@ async def ver_clientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No hay clientes registrados.")
         return
 
-    mensaje = "🗂️ *Lista de clientes:*\n\n"
-    for cid, saldo in clientes.items():
-        mensaje += f"ID: `{cid}` | Saldo: ${saldo:.2f}\n"
-    await update.message.reply_text(mensaje, parse_mode="Markdown")
+    orden, tamano = 'saldo', CLIENTES_POR_PAGINA
+    for arg in context.args or []:
+        if arg.lower() in ('saldo', 'id'):
+            orden = arg.lower()
+        elif arg.isdigit():
+            tamano = min(max(1, int(arg)), CLIENTES_POR_PAGINA_MAX)
+        else:
+            await update.message.reply_text("❌ Uso: /verclientes [saldo|id] [tamaño de página]")
+            return
+
+    mensaje, reply_markup = _pagina_clientes(orden, 0, tamano)
+    await update.message.reply_text(mensaje, parse_mode="Markdown", reply_markup=reply_markup)
+
+async def ver_clientes_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Botones de /verclientes: 'verclientes_{orden}_{tamaño}_{página}' y 'verclientes_csv'."""
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer("❌ Solo el administrador.", show_alert=True)
+        return
+
+    if query.data == 'verclientes_csv':
+        await query.answer("Generando CSV...")
+        filas = clientes.ordenados('id')  # copia en el event loop; el CSV se escribe en un hilo
+        archivo = await en_hilo(_exportar_clientes, filas)
+        try:
+            await context.bot.send_document(chat_id=query.message.chat_id, document=archivo,
+                                            filename="clientes.csv", caption=f"📂 {len(filas)} clientes")
+        finally:
+            archivo.close()
+        return
+
+    await query.answer()
+    _, orden, tamano, numero = query.data.split('_')
+    mensaje, reply_markup = _pagina_clientes(orden, int(numero), int(tamano))
+    try:
+        await query.edit_message_text(mensaje, parse_mode="Markdown", reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            raise
 
 # Persistir inmediatamente cuando se crea un combo (texto)
 async def addcombo_plataformas(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2856,7 +5324,7 @@ async def addcombo_plataformas(update: Update, context: ContextTypes.DEFAULT_TYP
     if texto.lower() == 'listo':
         combo = context.user_data.get('nuevo_combo', {})
         combos.append(combo)
-        save_combos_csv()  # Persistir al crear por texto
+        await save_combos_async()  # Persistir al crear por texto
         await update.message.reply_text(
             f"✅ Combo creado:\n*{combo.get('titulo','Sin título')}* ({combo.get('subnombre','')})\nPrecio: ${float(combo.get('precio',0.0)):.2f}\nPlataformas: {', '.join(combo.get('plataformas',[]))}",
             parse_mode="Markdown"
@@ -2954,14 +5422,12 @@ async def eliminar_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Eliminar del dict y persistir
     try:
-        del clientes[target_id]
-        guardar_clientes()
+        async with lock_saldo(target_id):
+            saldo_anterior = clientes.pop(target_id)
+            await guardar_saldo_async(target_id, -saldo_anterior, 'baja', user_id)
         await update.message.reply_text(f"✅ Cliente ID {target_id} eliminado de {CSV_CLIENTES}. No se borró ningún otro archivo ni código.")
-        # opcional: notificar al usuario (intento silencioso)
-        try:
-            await context.bot.send_message(chat_id=target_id, text="⚠️ Tu cuenta de cliente ha sido eliminada por el administrador.")
-        except Exception:
-            logging.debug(f"No se pudo notificar al cliente {target_id} sobre su eliminación.")
+        # opcional: notificar al usuario
+        await notificar(target_id, "⚠️ Tu cuenta de cliente ha sido eliminada por el administrador.")
     except Exception as e:
         logging.exception(f"Error eliminando cliente {target_id}: {e}")
         await update.message.reply_text("❌ Error al intentar eliminar el cliente. Revisa los logs.")
@@ -2969,11 +5435,543 @@ async def eliminar_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Aquí podríamos preguntar si se desea eliminar también el historial de compras...
     # pero eso podría ser destructivo. Mejor que el admin lo haga manualmente si es necesario.
 
-def main():
-    """Configuración principal del bot y registro de handlers."""
+async def movimientos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/movimientos <ID> - Últimos movimientos de saldo de un cliente, según el ledger (solo Admin)."""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ Solo el administrador puede usar este comando.")
+        return
+
+    if not context.args or len(context.args) != 1:
+        await update.message.reply_text("❌ Uso: /movimientos <ID_USUARIO>")
+        return
+
+    try:
+        target_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ ID inválido. Debe ser un número entero.")
+        return
+
+    filas = await en_hilo(storage.movimientos_usuario, target_id)
+    if not filas:
+        await update.message.reply_text(f"ℹ️ No hay movimientos de saldo registrados para ID {target_id}.")
+        return
+
+    lineas = [f"📒 Movimientos de saldo de ID {target_id} (últimos {len(filas)}):", ""]
+    for fecha, _, delta, saldo, motivo, actor, id_compra in filas:
+        saldo_txt = f"${saldo}" if saldo else "baja"
+        extra = f" · compra {id_compra}" if id_compra else ""
+        lineas.append(f"{fecha} | {delta} → {saldo_txt} | {motivo} (por {actor}){extra}")
+    await update.message.reply_text("\n".join(lineas))
+
+def _rango_fechas(desde, hasta):
+    """Convierte los argumentos de /ventas (AAAA-MM-DD o AAAA-MM) en límites de texto inclusivos.
+    Lanza ValueError si alguno no es una fecha válida."""
+    def _limite(texto, final):
+        texto = texto.strip()
+        if re.fullmatch(r"\d{4}-\d{2}", texto):
+            inicio = datetime.strptime(texto, "%Y-%m")
+            if not final:
+                return inicio.strftime("%Y-%m-%d 00:00:00")
+            siguiente = inicio.replace(year=inicio.year + 1, month=1) if inicio.month == 12 else inicio.replace(month=inicio.month + 1)
+            return (siguiente - timedelta(seconds=1)).strftime("%Y-%m-%d %H:%M:%S")
+        dia = datetime.strptime(texto, "%Y-%m-%d")
+        return dia.strftime("%Y-%m-%d 23:59:59" if final else "%Y-%m-%d 00:00:00")
+    return _limite(desde, False), _limite(hasta, True)
+
+async def ventas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/ventas <desde> <hasta> [plataforma] - Totales de ventas en un rango de fechas (solo Admin)."""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ Solo el administrador puede usar este comando.")
+        return
+
+    if not context.args or len(context.args) < 2:
+        await update.message.reply_text("❌ Uso: /ventas <desde> <hasta> [plataforma]\nFechas como AAAA-MM-DD o AAAA-MM, p. ej. /ventas 2025-01 2025-03 Netflix")
+        return
+
+    try:
+        desde, hasta = _rango_fechas(context.args[0], context.args[1])
+    except ValueError:
+        await update.message.reply_text("❌ Fechas inválidas. Usa AAAA-MM-DD o AAAA-MM.")
+        return
+    if desde > hasta:
+        await update.message.reply_text("❌ La fecha inicial es posterior a la final.")
+        return
+    plataforma = " ".join(context.args[2:]).strip() or None
+
+    resumen = await en_hilo(storage.resumen_ventas, desde, hasta, plataforma)
+    titulo = f"📊 Ventas del {desde[:10]} al {hasta[:10]}" + (f" ({plataforma})" if plataforma else "")
+    if not resumen['items']:
+        await update.message.reply_text(f"{titulo}\n\nNo hay ventas en ese rango.")
+        return
+
+    lineas = [
+        titulo,
+        "",
+        f"🧾 Compras: {resumen['compras']} (cuentas entregadas: {resumen['items']})",
+        f"💰 Total: ${resumen['total']:.2f}",
+        "",
+        "Por plataforma:",
+    ]
+    for plat, (items, total) in sorted(resumen['por_plataforma'].items(), key=lambda kv: -kv[1][1]):
+        lineas.append(f"▪️ {plat or '(sin plataforma)'}: {items} — ${total:.2f}")
+    await update.message.reply_text("\n".join(lineas))
+
+# --- Difusión (/difundir) ---
+class TokenBucket:
+    """Limitador de tasa: `tasa` fichas por segundo con ráfagas de hasta `capacidad`.
+    `pausar` vacía el balde y bloquea a todos hasta que pase el tiempo (RetryAfter)."""
+
+    def __init__(self, tasa, capacidad=None):
+        self.tasa = tasa
+        self.capacidad = capacidad or tasa
+        self._fichas = self.capacidad
+        self._ultimo = time.monotonic()
+        self._pausa_hasta = 0.0
+
+    async def tomar(self):
+        while True:
+            ahora = time.monotonic()
+            if ahora < self._pausa_hasta:
+                await asyncio.sleep(self._pausa_hasta - ahora)
+                continue
+            self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultimo) * self.tasa)
+            self._ultimo = ahora
+            if self._fichas >= 1:
+                self._fichas -= 1
+                return
+            await asyncio.sleep((1 - self._fichas) / self.tasa)
+
+    def pausar(self, segundos):
+        self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+        self._fichas = 0
+
+
+class LimitadorEnvios:
+    """Límites de Telegram para mensajes salientes: unos 30 por segundo en total
+    (ENVIOS_POR_SEGUNDO deja margen para las respuestas normales de los handlers)
+    y no más de uno por segundo al mismo chat."""
+
+    def __init__(self, por_segundo, intervalo_por_chat=1.0):
+        self._global = TokenBucket(por_segundo)
+        self.intervalo_por_chat = intervalo_por_chat
+        self._proximo_por_chat = {}
+
+    async def esperar(self, chat_id):
+        ahora = time.monotonic()
+        if len(self._proximo_por_chat) > 10000:
+            self._proximo_por_chat = {c: t for c, t in self._proximo_por_chat.items() if t > ahora}
+        turno = max(ahora, self._proximo_por_chat.get(chat_id, 0.0))
+        self._proximo_por_chat[chat_id] = turno + self.intervalo_por_chat
+        if turno > ahora:
+            await asyncio.sleep(turno - ahora)
+        await self._global.tomar()
+
+    def pausar(self, segundos):
+        self._global.pausar(segundos)
+
+
+limitador_envios = LimitadorEnvios(ENVIOS_POR_SEGUNDO)
+
+
+def _segundos_retry_after(error):
+    espera = error.retry_after
+    return espera.total_seconds() if hasattr(espera, 'total_seconds') else float(espera)
+
+
+class Difusion:
+    """Un mensaje para todos los clientes, reanudable tras un reinicio.
+    DIFUSION_FILE guarda el texto y el estado; DIFUSION_DESTINOS_FILE los chats (uno por
+    línea, fijados al empezar) y DIFUSION_PROGRESO_FILE una línea 'índice,resultado' por
+    chat ya atendido, escrita apenas termina su envío. Al reanudar se saltan esos índices,
+    así que sólo se puede repetir el envío que estaba en curso en el momento del corte."""
+
+    RESULTADOS = ('ok', 'bloqueado', 'fallido')
+
+    def __init__(self, datos, destinos, hechos):
+        self.datos = datos
+        self.destinos = destinos
+        self.hechos = hechos  # {indice: resultado}
+        self.conteo = Counter(hechos.values())
+        self._lock = threading.Lock()
+        self._pendientes = None
+
+    @property
+    def estado(self):
+        return self.datos.get('estado')
+
+    @classmethod
+    def crear(cls, texto, destinos, chat_id):
+        datos = {'id': uuid.uuid4().hex[:8], 'texto': texto, 'estado': 'en_curso', 'total': len(destinos),
+                 'creada': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'chat_id': chat_id, 'message_id': None}
+        with open(DIFUSION_DESTINOS_FILE, 'w', encoding='utf-8') as f:
+            f.writelines(f"{d}\n" for d in destinos)
+        open(DIFUSION_PROGRESO_FILE, 'w').close()
+        difusion = cls(datos, list(destinos), {})
+        difusion.guardar()
+        return difusion
+
+    @classmethod
+    def cargar(cls):
+        """La última difusión registrada, o None si nunca hubo una."""
+        try:
+            with open(DIFUSION_FILE, 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+            with open(DIFUSION_DESTINOS_FILE, 'r', encoding='utf-8') as f:
+                destinos = [int(linea) for linea in f if linea.strip()]
+        except (FileNotFoundError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.error(f"Difusión ilegible, se ignora: {e}")
+            return None
+        hechos = {}
+        try:
+            with open(DIFUSION_PROGRESO_FILE, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    indice, _, resultado = linea.strip().partition(',')
+                    if indice.isdigit() and resultado in cls.RESULTADOS:
+                        hechos[int(indice)] = resultado
+        except FileNotFoundError:
+            pass
+        return cls(datos, destinos, hechos)
+
+    def guardar(self):
+        tmp_path = DIFUSION_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.datos, f, ensure_ascii=False)
+        os.replace(tmp_path, DIFUSION_FILE)
+
+    def _anotar(self, indice, resultado):
+        with self._lock, open(DIFUSION_PROGRESO_FILE, 'a', encoding='utf-8') as f:
+            f.write(f"{indice},{resultado}\n")
+
+    def progreso(self):
+        total = self.datos['total']
+        return (f"📣 Difusión {self.datos['id']} ({self.estado}): {len(self.hechos)}/{total}\n"
+                f"✅ Entregados: {self.conteo['ok']} | 🚫 Bloquearon el bot: {self.conteo['bloqueado']} | "
+                f"❌ Fallidos: {self.conteo['fallido']}")
+
+    async def _enviar(self, bot, chat_id):
+        for intento in range(DIFUSION_REINTENTOS):
+            await limitador_envios.esperar(chat_id)
+            try:
+                await bot.send_message(chat_id=chat_id, text=self.datos['texto'])
+                return 'ok'
+            except RetryAfter as e:
+                logging.warning(f"Difusión: flood control, pausa de {e.retry_after}s")
+                limitador_envios.pausar(_segundos_retry_after(e))
+            except Forbidden:
+                return 'bloqueado'
+            except BadRequest as e:
+                logging.info(f"Difusión: no se pudo enviar a {chat_id}: {e}")
+                return 'fallido'
+            except (TimedOut, NetworkError) as e:
+                logging.warning(f"Difusión: error de red con {chat_id} (intento {intento + 1}): {e}")
+                await asyncio.sleep(2 ** intento)
+            except Exception as e:
+                logging.exception(f"Difusión: error enviando a {chat_id}: {e}")
+                return 'fallido'
+        return 'fallido'
+
+    async def _trabajador(self, bot):
+        for indice in self._pendientes:
+            if self.estado != 'en_curso':
+                return
+            resultado = await self._enviar(bot, self.destinos[indice])
+            await en_hilo(self._anotar, indice, resultado)
+            self.hechos[indice] = resultado
+            self.conteo[resultado] += 1
+
+    async def _informar(self, bot):
+        """Edita el mensaje de progreso del admin (lo crea si aún no existe)."""
+        try:
+            if self.datos.get('message_id'):
+                await bot.edit_message_text(chat_id=self.datos['chat_id'], message_id=self.datos['message_id'],
+                                            text=self.progreso())
+            else:
+                mensaje = await bot.send_message(chat_id=self.datos['chat_id'], text=self.progreso())
+                self.datos['message_id'] = mensaje.message_id
+                await en_hilo(self.guardar)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logging.warning(f"Difusión: no se pudo actualizar el progreso: {e}")
+        except Exception as e:
+            logging.warning(f"Difusión: no se pudo actualizar el progreso: {e}")
+
+    async def ejecutar(self, bot):
+        """Envía a los destinos que faltan con DIFUSION_CONCURRENCIA envíos en paralelo
+        (todos pasan por `limitador_envios`) y va informando el progreso."""
+        self._pendientes = iter([i for i in range(len(self.destinos)) if i not in self.hechos])
+        trabajadores = [asyncio.create_task(self._trabajador(bot)) for _ in range(DIFUSION_CONCURRENCIA)]
+        try:
+            while not all(t.done() for t in trabajadores):
+                await self._informar(bot)
+                await asyncio.wait(trabajadores, timeout=DIFUSION_REPORTE_SEGUNDOS)
+        finally:
+            for tarea in trabajadores:
+                tarea.cancel()
+            await asyncio.gather(*trabajadores, return_exceptions=True)
+        if self.estado == 'en_curso':
+            self.datos['estado'] = 'terminada'
+        await en_hilo(self.guardar)
+        await self._informar(bot)
+        logging.info(self.progreso())
+
+
+_difusion = {'actual': None, 'tarea': None}
+
+
+def _lanzar_difusion(bot, difusion):
+    _difusion['actual'] = difusion
+    _difusion['tarea'] = asyncio.create_task(difusion.ejecutar(bot))
+    _tareas_de_fondo.append(_difusion['tarea'])
+
+
+async def difundir(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/difundir <mensaje> - Envía un mensaje a todos los clientes (solo Admin).
+    /difundir estado - Progreso de la última difusión. /difundir cancelar - La detiene."""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ Solo el administrador puede usar este comando.")
+        return
+
+    texto = update.message.text.partition(' ')[2].strip()
+    actual = _difusion['actual']
+    en_curso = actual is not None and actual.estado == 'en_curso'
+    tarea = _difusion['tarea']
+    if texto.lower() == 'estado':
+        actual = actual or await en_hilo(Difusion.cargar)
+        await update.message.reply_text(actual.progreso() if actual else "No hay difusiones registradas.")
+        return
+    if texto.lower() == 'cancelar':
+        if not en_curso:
+            await update.message.reply_text("No hay ninguna difusión en curso.")
+            return
+        actual.datos['estado'] = 'cancelada'
+        await en_hilo(actual.guardar)
+        # Se espera a que paren los trabajadores: si no, los envíos que estaban en vuelo
+        # anotarían sus índices en el DIFUSION_PROGRESO_FILE de la difusión siguiente
+        tarea.cancel()
+        await asyncio.gather(tarea, return_exceptions=True)
+        await update.message.reply_text(f"🛑 Difusión cancelada.\n{actual.progreso()}")
+        return
+    if not texto:
+        await update.message.reply_text("❌ Uso: /difundir <mensaje>\nTambién: /difundir estado, /difundir cancelar")
+        return
+    if en_curso or (tarea is not None and not tarea.done()):
+        await update.message.reply_text(f"⏳ Ya hay una difusión en curso.\n{actual.progreso()}")
+        return
+    if not clientes:
+        await update.message.reply_text("No hay clientes registrados.")
+        return
+
+    destinos = [cid for cid, _ in clientes.ordenados('id')]
+    difusion = await en_hilo(Difusion.crear, texto, destinos, update.effective_chat.id)
+    _lanzar_difusion(context.bot, difusion)
+    await update.message.reply_text(f"📣 Difusión iniciada para {len(destinos)} clientes.")
+
+
+async def reanudar_difusion(bot):
+    """Al arrancar, retoma una difusión que quedó en curso."""
+    difusion = await en_hilo(Difusion.cargar)
+    if difusion is not None and difusion.estado == 'en_curso':
+        logging.info(f"Reanudando difusión {difusion.datos['id']}: {len(difusion.hechos)}/{difusion.datos['total']} ya atendidos")
+        _lanzar_difusion(bot, difusion)
+
+# --- Cola de salida ---
+def mensaje_salida(chat_id, texto=None, parse_mode=None, tipo='texto', **extra):
+    """Mensaje para la cola de salida. tipo 'texto' lleva `texto`/`parse_mode`; tipo 'foto'
+    además el file_id en `foto` (el texto va de caption); tipo 'material' lleva correo,
+    perfil y caption y se envía con material_store."""
+    return {'id': uuid.uuid4().hex, 'chat_id': chat_id, 'tipo': tipo, 'texto': texto, 'parse_mode': parse_mode,
+            'intentos': 0, 'creado': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), **extra}
+
+
+class ColaSalida:
+    """Entregas y avisos salientes. El handler guarda el mensaje (storage.encolar_salida o,
+    en una venta, dentro de registrar_venta) y sigue; SALIDA_TRABAJADORES tareas lo envían
+    respetando `limitador_envios`. Un error de red se reintenta con backoff exponencial
+    (hasta SALIDA_REINTENTOS veces), RetryAfter pausa todos los envíos, y un mensaje sólo
+    sale del almacenamiento cuando se entregó o falló sin remedio (se avisa al admin).
+    Al arrancar se vuelven a encolar los que quedaron pendientes."""
+
+    def __init__(self):
+        self._cola = None
+        self._bot = None
+
+    def despachar(self, mensajes):
+        """Pasa a los trabajadores mensajes que ya están guardados."""
+        if self._cola is None:
+            return  # sin trabajadores todavía: `iniciar` los tomará del almacenamiento
+        for mensaje in mensajes:
+            self._cola.put_nowait(mensaje)
+
+    async def encolar(self, *mensajes):
+        await en_hilo(storage.encolar_salida, list(mensajes))
+        self.despachar(mensajes)
+
+    async def iniciar(self, bot):
+        """Carga lo pendiente y arranca los trabajadores. Devuelve sus tareas."""
+        self._bot = bot
+        self._cola = asyncio.Queue()
+        pendientes = await en_hilo(storage.salida_pendiente)
+        if pendientes:
+            logging.info(f"Cola de salida: {len(pendientes)} mensajes pendientes de la última ejecución")
+        self.despachar(pendientes)
+        return [asyncio.create_task(self._trabajador()) for _ in range(SALIDA_TRABAJADORES)]
+
+    async def _enviar(self, mensaje):
+        if mensaje.get('tipo') == 'material':
+            await material_store.enviar(self._bot, mensaje['chat_id'], mensaje['correo'], mensaje['perfil'],
+                                        caption=mensaje.get('caption'))
+        elif mensaje.get('tipo') == 'foto':
+            await self._bot.send_photo(chat_id=mensaje['chat_id'], photo=mensaje['foto'], caption=mensaje['texto'],
+                                       parse_mode=mensaje.get('parse_mode'))
+        else:
+            await self._bot.send_message(chat_id=mensaje['chat_id'], text=mensaje['texto'],
+                                         parse_mode=mensaje.get('parse_mode'))
+
+    def _reintentar(self, mensaje):
+        mensaje['intentos'] = mensaje.get('intentos', 0) + 1
+        if mensaje['intentos'] >= SALIDA_REINTENTOS:
+            return False
+        espera = min(SALIDA_ESPERA_MAX, 2 ** mensaje['intentos'])
+        asyncio.get_running_loop().call_later(espera, self._cola.put_nowait, mensaje)
+        return True
+
+    async def _trabajador(self):
+        while True:
+            mensaje = await self._cola.get()
+            chat_id = mensaje['chat_id']
+            await limitador_envios.esperar(chat_id)
+            try:
+                await self._enviar(mensaje)
+                resultado = 'enviado'
+            except RetryAfter as e:
+                logging.warning(f"Cola de salida: flood control, pausa de {e.retry_after}s")
+                limitador_envios.pausar(_segundos_retry_after(e))
+                self._cola.put_nowait(mensaje)
+                continue
+            except Forbidden as e:
+                resultado, error = 'bloqueado', e
+            except BadRequest as e:
+                if mensaje.get('parse_mode') and 'parse' in str(e).lower():
+                    # Un '_' o '*' en una contraseña rompe el Markdown: mejor en texto plano que no entregar
+                    mensaje['parse_mode'] = None
+                    self._cola.put_nowait(mensaje)
+                    continue
+                resultado, error = 'fallido', e
+            except Exception as e:
+                if self._reintentar(mensaje):
+                    logging.warning(f"Cola de salida: error enviando a {chat_id} (intento {mensaje['intentos']}): {e}")
+                    continue
+                resultado, error = 'fallido', e
+            try:
+                await en_hilo(storage.cerrar_salida, mensaje['id'], resultado)
+            except Exception as e:
+                logging.exception(f"Cola de salida: no se pudo cerrar el mensaje {mensaje['id']}: {e}")
+            if resultado != 'enviado':
+                logging.error(f"Cola de salida: mensaje {mensaje['id']} a {chat_id} {resultado}: {error}")
+                metricas.contar('bot_entregas_fallidas_total', tipo=mensaje.get('tipo') or 'texto', resultado=resultado)
+                if chat_id != ADMIN_ID:
+                    await self.encolar(mensaje_salida(
+                        ADMIN_ID, f"⚠️ No se pudo enviar un mensaje ({mensaje.get('tipo')}) a {chat_id}: {error}\n\n"
+                                  f"{mensaje.get('texto') or ''}"))
+
+
+salida = ColaSalida()
+
+
+async def notificar(chat_id, texto, parse_mode=None):
+    """Aviso por la cola de salida (no espera a Telegram)."""
+    try:
+        await salida.encolar(mensaje_salida(chat_id, texto, parse_mode))
+    except Exception as e:
+        logging.exception(f"No se pudo encolar el aviso para {chat_id}: {e}")
+
+# --- Tareas de fondo ---
+_tareas_de_fondo = []
+_servidor_metricas = None  # servidor de /metrics (asyncio.Server) mientras el bot corre
+
+async def iniciar_tareas_de_fondo(application):
+    """post_init: arranca las tareas periódicas (no se usa application.create_task porque
+    Application.stop espera a esas tareas y éstas no terminan nunca)."""
+    global _servidor_metricas
+    _tareas_de_fondo.append(asyncio.create_task(compactar_periodicamente()))
+    _tareas_de_fondo.append(asyncio.create_task(guardar_estadisticas_periodicamente()))
+    _tareas_de_fondo.extend(await salida.iniciar(application.bot))
+    await reanudar_difusion(application.bot)
+    _servidor_metricas = await iniciar_servidor_metricas()
+
+async def detener_tareas_de_fondo(application):
+    """post_shutdown: cancela las tareas periódicas y deja stock y saldos compactados."""
+    global _servidor_metricas
+    for tarea in _tareas_de_fondo:
+        tarea.cancel()
+    await asyncio.gather(*_tareas_de_fondo, return_exceptions=True)
+    _tareas_de_fondo.clear()
+    if _servidor_metricas is not None:
+        _servidor_metricas.close()
+        _servidor_metricas = None
+    try:
+        await registrar_altas_pendientes()
+        await compactar_stock_async()
+        await compactar_saldos_async()
+        await en_hilo(estadisticas.guardar)
+        await en_hilo(storage.compactar_salida)
+    except Exception as e:
+        logging.exception(f"Error compactando al salir: {e}")
+
+
+def ejecutar_bot(application):
+    """Recibe updates según MODO_BOT hasta SIGINT/SIGTERM. Al parar, PTB deja de aceptar
+    updates, termina los que están en curso y después corre post_shutdown (compactación).
+    El webhook no se borra al salir: Telegram guarda los updates hasta el próximo arranque."""
+    modo = MODO_BOT.strip().lower()
+    if modo == 'webhook':
+        if not WEBHOOK_URL:
+            raise RuntimeError("BOT_MODO=webhook requiere BOT_WEBHOOK_URL (URL pública https)")
+        ruta = WEBHOOK_PATH.strip('/')
+        logging.info(f"Modo webhook: escuchando en {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{ruta}, URL pública {WEBHOOK_URL}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=ruta,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            cert=WEBHOOK_CERT or None,
+            key=WEBHOOK_KEY or None,
+            max_connections=WEBHOOK_MAX_CONEXIONES,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        return
+    if modo != 'polling':
+        logging.warning(f"BOT_MODO desconocido '{MODO_BOT}', usando polling.")
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def cargar_estado():
+    """Carga clientes, combos, stock y estadísticas y compacta diario y ledger."""
     cargar_clientes()
     load_combos_csv()
-    application = ApplicationBuilder().token(TOKEN).build()
+    stock_index.cargar()  # foto de stock + diario
+    cleanup_stock()
+    storage.compactar_stock()
+    storage.compactar_saldos()
+    estadisticas.al_dia()
+
+def crear_aplicacion(base_url=None):
+    """Application con todos los handlers registrados. base_url apunta el bot a otra
+    Bot API (p. ej. el servidor falso de prueba_carga.py)."""
+    procesador = ProcesadorPorUsuario(MAX_UPDATES_CONCURRENTES) if PROCESAR_EN_PARALELO else False
+    # RequestTrazado: las llamadas a la Bot API de cada handler cuentan en su traza (pool como el de PTB)
+    builder = (ApplicationBuilder().token(TOKEN).concurrent_updates(procesador)
+               .request(RequestTrazado(connection_pool_size=256)))
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_url.replace('/bot', '/file/bot', 1))
+    application = (
+        builder.post_init(iniciar_tareas_de_fondo).post_shutdown(detener_tareas_de_fondo)
+        .build()
+    )
 
 
     # Conversation handler: combos
@@ -2997,6 +5995,7 @@ def main():
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("combos", show_combos_menu))
     application.add_handler(CommandHandler("verclientes", ver_clientes))
+    application.add_handler(CallbackQueryHandler(ver_clientes_callback, pattern=r'^verclientes_(csv|(saldo|id)_\d+_\d+)$'))
     ...
 
     # Comandos admin
@@ -3006,7 +6005,16 @@ def main():
     application.add_handler(CommandHandler("consultarsaldo", consultar_saldo))
     application.add_handler(CommandHandler("responder", responder))
     application.add_handler(CommandHandler("eliminarcliente", eliminar_cliente))
+    application.add_handler(CommandHandler("movimientos", movimientos))
+    application.add_handler(CommandHandler("ventas", ventas))
+    application.add_handler(CommandHandler("estadisticas", estadisticas_cmd))
+    application.add_handler(CommandHandler("difundir", difundir))
     application.add_handler(CommandHandler("borrarventa", borrar_venta))
+    application.add_handler(CommandHandler("importarstock", importar_stock))
+    application.add_handler(CommandHandler("buscar", buscar_stock))
+    # CSV enviado como documento con /importarstock en el pie
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/importarstock\b')
+                                           & filters.User(ADMIN_ID), importar_stock))
    
    
     # Conversation handler: combos (completa — incluye callbacks para botones)
@@ -3050,7 +6058,7 @@ def main():
             AGREGAR_CORREO: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), venta_correo)],
             AGREGAR_PASS: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), venta_pass)],
             AGREGAR_PRECIO: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), venta_precio)],
-            AGREGAR_MATERIAL: [MessageHandler((filters.TEXT | filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND & filters.User(ADMIN_ID), guardar_material_perfil)],
+            AGREGAR_MATERIAL: [MessageHandler((filters.TEXT | filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.ANIMATION | filters.AUDIO | filters.VOICE) & ~filters.COMMAND & filters.User(ADMIN_ID), guardar_material_perfil)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
@@ -3062,8 +6070,8 @@ def main():
     application.add_handler(CallbackQueryHandler(show_combos_menu, pattern='^show_combos_menu$'))
     application.add_handler(CallbackQueryHandler(show_categories, pattern='^show_categories$'))
     application.add_handler(CallbackQueryHandler(show_plataformas, pattern='^category_(completa|perfil)$'))
-    application.add_handler(CallbackQueryHandler(handle_platform_selection, pattern='^select_(completa|perfil)_.*'))
-    application.add_handler(CallbackQueryHandler(handle_compra_final, pattern='^buy_.*'))
+    # 'select_...' son botones de menús anteriores a los tokens: se responden como vencidos
+    application.add_handler(CallbackQueryHandler(handle_platform_selection, pattern=r'^(cp_[\w-]+|select_.*)$'))
     # Handler para comprar combos (cada botón produce comprar_combo_{i})
     application.add_handler(CallbackQueryHandler(handle_comprar_combo, pattern=r'^comprar_combo_\d+$'))
      # Mostrar información de recarga (botón del menú)
@@ -3076,18 +6084,33 @@ def main():
     application.add_handler(CallbackQueryHandler(borrar_combos_callback, pattern=r'^borrar_combos$'))
     application.add_handler(CallbackQueryHandler(borrar_combo_list_callback, pattern=r'^borrar_combo_list$'))
     application.add_handler(CallbackQueryHandler(vaciar_combos_callback, pattern=r'^vaciar_combos$'))
-    # Registrar handler que muestra la lista filtrada de stock (completa/perfil/otro)
-    application.add_handler(CallbackQueryHandler(mostrar_lista_borrar, pattern=r'^borrar_(completa|perfil|otro)$'))
+    # Lista paginada de stock por categoría (completa/perfil/otro) y borrado por ID de stock
+    application.add_handler(CallbackQueryHandler(mostrar_lista_borrar, pattern=r'^borrar_(completa|perfil|otro)(_\d+)?$'))
+    application.add_handler(CallbackQueryHandler(borrar_stock_item_callback,
+                                                 pattern=r'^borrarstock_(ver|ok)_(completa|perfil|otro)_\d+_[0-9a-f]{12}(-\d+)?$'))
     # Permitir volver al menú de borrado desde submenús
     application.add_handler(CallbackQueryHandler(borrar_venta, pattern=r'^borrar_venta_menu$'))
-    # Registrar handler que recibe el número para eliminar (sólo admin)
+    # Registrar handler que recibe el número del combo a eliminar (sólo admin)
     application.add_handler(MessageHandler(filters.Regex(r'^\d+$') & filters.User(ADMIN_ID), borrar_stock_por_indice))
-    # (El handler que muestra categorías para borrar ya está: mostrar_lista_borrar -> pattern '^borrar_(completa|perfil|otro)$')
-    # El MessageHandler que espera números ya está registrado y ahora soporta combos y stock:
-    # application.add_handler(MessageHandler(filters.Regex(r'^\d+$') & filters.Chat(ADMIN_ID), borrar_stock_por_indice))
+    trazar_handlers(application)
+    return application
+
+def main():
+    """Configuración principal del bot y registro de handlers."""
+    cargar_estado()
+    application = crear_aplicacion()
 
     # Ejecutar
-    application.run_polling()
+    try:
+        ejecutar_bot(application)
+    finally:
+        # Espera a que terminen las escrituras pendientes antes de salir
+        _io_pool.shutdown(wait=True)
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrar-sqlite':
+        print(migrar_csv_a_sqlite())
+    elif len(sys.argv) > 1 and sys.argv[1] == 'reconstruir-estadisticas':
+        print(reconstruir_estadisticas())
+    else:
+        main()
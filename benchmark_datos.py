@@ -0,0 +1,243 @@
+"""Micro-benchmarks de las funciones de datos de BotDeTelegram a distintos tamaños.
+
+Genera stock.csv, clientes.csv y compras_global.csv sintéticos (por defecto con 1k, 100k
+y 1M filas) en un directorio temporal, los carga con el backend elegido y mide:
+  load_stock, get_dynamic_stock_info, cleanup_stock, entregar_cuenta, guardar_clientes,
+  validar_id_compra (primera llamada, que carga el índice, y consultas siguientes)
+  y la exportación de /historial de un cliente con muchas compras.
+El resultado es un JSON (tiempos en ms, mediana y mínimo de varias repeticiones) pensado
+para compararse entre commits:
+
+    python benchmark_datos.py --json antes.json
+    (cambio)
+    python benchmark_datos.py --json despues.json --comparar antes.json
+
+No toca los archivos reales del bot: el directorio temporal se borra al terminar
+(salvo con --conservar).
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+PLATAFORMAS = ['Netflix', 'Prime', 'Disney', 'HBO', 'Spotify', 'Crunchyroll', 'Paramount', 'Vix',
+               'Star', 'AppleTV', 'YouTube', 'Canva', 'Deezer', 'Pluto', 'Universal', 'Tidal']
+USUARIO_HISTORIAL = 5000000001  # cliente con N/10 compras para medir la exportación de /historial
+
+
+def _tamano(texto):
+    texto = texto.strip().lower()
+    factor = {'k': 1000, 'm': 1000000}.get(texto[-1:], 1)
+    return int(float(texto.rstrip('km')) * factor)
+
+
+# --- Datos sintéticos ---
+def generar_datos(n, rnd):
+    """Escribe en el directorio actual los CSV del bot con n filas cada uno.
+    Devuelve los IDs de compra del cliente USUARIO_HISTORIAL y algunos IDs ajenos."""
+    with open('stock.csv', 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        for i in range(n):
+            plat = PLATAFORMAS[i % len(PLATAFORMAS)]
+            precio = f"{rnd.choice((25, 35, 45, 60, 80, 120)):.2f}"
+            if i % 3:
+                w.writerow([plat, 'perfil', f"cuenta{i}@correo.com", 'clave', precio, rnd.randint(1, 5), 1])
+            else:
+                w.writerow([plat, 'completa', f"cuenta{i}@correo.com", 'clave', precio])
+
+    with open('clientes.csv', 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        for i in range(n):
+            w.writerow([1000000000 + i, f"{rnd.randint(0, 5000):.2f}"])
+
+    inicio = datetime(2024, 1, 1)
+    propias = []
+    historial = []
+    with open('compras_global.csv', 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        w.writerow(['ID_Compra', 'ID_Usuario', 'Fecha', 'Plan', 'Correo', 'Contraseña', 'Precio'])
+        for i in range(n):
+            id_compra = f"{i:08X}"
+            fecha = (inicio + timedelta(seconds=i * 30)).strftime('%Y-%m-%d %H:%M:%S')
+            plan = 'perfil' if i % 3 else 'completa'
+            precio = f"{rnd.choice((25, 35, 45, 60, 80, 120)):.2f}"
+            if i % 10 == 0:
+                user_id = USUARIO_HISTORIAL
+                propias.append(id_compra)
+                historial.append([fecha, plan, f"cuenta{i}@correo.com", 'clave', precio, id_compra])
+            else:
+                user_id = 1000000000 + rnd.randrange(n)
+            w.writerow([id_compra, user_id, fecha, plan, f"cuenta{i}@correo.com", 'clave', precio])
+
+    with open(f'historial_{USUARIO_HISTORIAL}.csv', 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        w.writerow(['Fecha de entrega', 'Plan', 'Correo', 'Contraseña', 'Precio', 'ID_Compra'])
+        w.writerows(historial)
+    ajenas = [f"{i:08X}" for i in range(1, n, 10)]
+    return propias, ajenas
+
+
+# --- Mediciones ---
+def medir(func, repeticiones, preparar=None):
+    """Tiempos (s) de `repeticiones` llamadas a func(); `preparar` corre antes de cada una sin medirse."""
+    tiempos = []
+    for _ in range(repeticiones):
+        if preparar:
+            preparar()
+        t0 = time.perf_counter()
+        func()
+        tiempos.append(time.perf_counter() - t0)
+    return tiempos
+
+
+def _resumen(tiempos, operaciones=1, **extra):
+    """Mediana y mínimo en ms por operación."""
+    return dict({'mediana_ms': round(statistics.median(tiempos) / operaciones * 1000, 4),
+                 'min_ms': round(min(tiempos) / operaciones * 1000, 4),
+                 'repeticiones': len(tiempos)}, **extra)
+
+
+def medir_tamano(B, n, backend, repeticiones, rnd):
+    propias, ajenas = generar_datos(n, rnd)
+    if backend == 'sqlite':
+        B.SqliteStorage().importar_desde_csv(B.CsvStorage())
+        B.storage = B.crear_storage(backend)
+    else:
+        # Sólo los CSV generados: no el compras_global.csv que esté junto a BotDeTelegram.py
+        B.storage = B.CsvStorage(incluir_script_dir=False)
+    B.stock_index = B.StockIndex()
+    B.historial_cache = B.HistorialCache()
+    resultados = {}
+
+    filas = []
+
+    def cargar():
+        filas[:] = B.load_stock()
+    resultados['load_stock'] = _resumen(medir(cargar, repeticiones), filas=len(filas))
+
+    B.stock_index.cargar(list(filas))
+    resultados['get_dynamic_stock_info'] = _resumen(medir(B.get_dynamic_stock_info, repeticiones))
+    resultados['cleanup_stock'] = _resumen(medir(B.cleanup_stock, repeticiones))
+
+    # Cada entrega descuenta stock y escribe su evento: se mide por operación
+    entregas = min(200, n)
+    info = B.get_dynamic_stock_info()
+    pedidos = [(PLATAFORMAS[i % len(PLATAFORMAS)], 'perfil' if i % 2 else 'completa') for i in range(entregas)]
+
+    def entregar():
+        # Como en la compra: la plataforma y el tipo elegidos, al precio mínimo del catálogo
+        for plat, tipo in pedidos:
+            B.entregar_cuenta(plat, tipo, info[tipo][plat]['precio'])
+    resultados['entregar_cuenta'] = _resumen(medir(entregar, 1), entregas, llamadas=entregas)
+
+    B.cargar_clientes()
+    resultados['guardar_clientes'] = _resumen(medir(B.guardar_clientes, repeticiones), clientes=len(B.clientes))
+
+    consultas = [rnd.choice(propias) for _ in range(500)] + [rnd.choice(ajenas) for _ in range(500)]
+    resultados['validar_id_compra_primera'] = _resumen(
+        medir(lambda: B.validar_id_compra(USUARIO_HISTORIAL, consultas[0]), 1))
+
+    def validar():
+        for id_compra in consultas:
+            B.validar_id_compra(USUARIO_HISTORIAL, id_compra)
+    resultados['validar_id_compra'] = _resumen(medir(validar, repeticiones), len(consultas),
+                                               llamadas=len(consultas))
+
+    resultados['exportar_historial'] = _resumen(
+        medir(lambda: B._exportar_historial(USUARIO_HISTORIAL), repeticiones,
+              preparar=lambda: B.historial_cache.invalidar(USUARIO_HISTORIAL)),
+        filas=len(propias))
+    resultados['exportar_historial_cache'] = _resumen(
+        medir(lambda: B._exportar_historial(USUARIO_HISTORIAL), repeticiones))
+    return resultados
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def comparar(reporte, anterior):
+    """Imprime la mediana de cada medición contra la de `anterior` (otro reporte)."""
+    print(f"\nComparación con {anterior.get('commit') or '?'} ({anterior.get('storage')}):")
+    for tamano, mediciones in reporte['resultados'].items():
+        previas = anterior.get('resultados', {}).get(tamano, {})
+        for nombre, medicion in mediciones.items():
+            if nombre not in previas or not previas[nombre]['mediana_ms']:
+                continue
+            razon = medicion['mediana_ms'] / previas[nombre]['mediana_ms']
+            print(f"  {tamano:>8} {nombre:<28} {previas[nombre]['mediana_ms']:>12.4f} -> "
+                  f"{medicion['mediana_ms']:>12.4f} ms  (x{razon:.2f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de las funciones de datos del bot.")
+    parser.add_argument('--tamanos', default='1k,100k,1M', help="filas de cada CSV, separadas por coma")
+    parser.add_argument('--storage', choices=('csv', 'sqlite'), default='csv')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--json', help="guarda el reporte en este archivo")
+    parser.add_argument('--comparar', help="reporte JSON anterior con el que comparar")
+    parser.add_argument('--conservar', action='store_true', help="no borra los datos generados al terminar")
+    args = parser.parse_args()
+
+    salida_json = os.path.abspath(args.json) if args.json else None
+    anterior = None
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anterior = json.load(f)
+
+    # El bot usa rutas relativas: cada tamaño corre en su propio directorio temporal
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    inicial = os.getcwd()
+    base = Path(tempfile.mkdtemp(prefix='benchmark_datos_'))
+    os.chdir(base)
+    import BotDeTelegram as bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    reporte = {'commit': _commit(), 'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(), 'storage': args.storage,
+               'repeticiones': args.repeticiones, 'resultados': {}}
+    try:
+        for texto in args.tamanos.split(','):
+            n = _tamano(texto)
+            carpeta = base / str(n)
+            carpeta.mkdir()
+            os.chdir(carpeta)
+            t0 = time.perf_counter()
+            reporte['resultados'][str(n)] = medir_tamano(bot, n, args.storage, args.repeticiones,
+                                                         random.Random(args.semilla))
+            print(f"{n} filas ({time.perf_counter() - t0:.1f}s):")
+            for nombre, medicion in reporte['resultados'][str(n)].items():
+                print(f"  {nombre:<28} mediana {medicion['mediana_ms']:>12.4f} ms | mín {medicion['min_ms']:>12.4f} ms")
+    finally:
+        bot._io_pool.shutdown(wait=True)
+        os.chdir(inicial)
+        if args.conservar:
+            print(f"Datos generados en {base}")
+        else:
+            shutil.rmtree(base, ignore_errors=True)
+
+    if salida_json:
+        with open(salida_json, 'w', encoding='utf-8') as f:
+            json.dump(reporte, f, ensure_ascii=False, indent=2)
+    if anterior:
+        comparar(reporte, anterior)
+
+
+if __name__ == '__main__':
+    main()
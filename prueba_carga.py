@@ -0,0 +1,532 @@
+"""Prueba de carga de BotDeTelegram contra una Bot API falsa, todo en local.
+
+Levanta un servidor HTTP que imita los métodos de la Bot API que usa el bot (getUpdates,
+sendMessage, editMessageText, answerCallbackQuery, sendPhoto, sendDocument, ...), apunta
+la Application real a él (crear_aplicacion(base_url=...)) y simula N usuarios que
+recorren los flujos de siempre pulsando los botones que el bot les manda:
+  /start -> show_categories -> category_* -> cp_<token> (compra directa)
+  menú -> show_combos_menu -> comprar_combo_*
+  menú -> iniciar_reporte -> ID de compra, correo, contraseña, fecha, descripción
+
+Al final imprime throughput, latencias p50/p99 (por update dentro del bot y por paso
+desde el lado del usuario) y revisa que no haya sobreventa ni cobros dobles:
+  - ningún (correo, perfil) se entregó dos veces y las unidades que faltan en el
+    stock son exactamente las vendidas;
+  - lo que bajó el saldo de cada usuario es lo que dicen sus entregas, ningún saldo
+    quedó negativo y los saldos guardados coinciden con los de memoria.
+
+Uso:
+    python prueba_carga.py --usuarios 200 --iteraciones 3
+    python prueba_carga.py --usuarios 500 --limite-api 30 --storage sqlite --json reporte.json
+Corre en un directorio temporal: no toca los CSV reales.
+"""
+import argparse
+import asyncio
+import email
+import email.policy
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bot de prueba', 'username': 'bot_de_prueba'}
+USUARIO_BASE = 100000
+
+# --- Bot API falsa ---
+def _leer_parametros(tipo, cuerpo):
+    """Parámetros de una petición de PTB (form-urlencoded o multipart si sube archivos)."""
+    if tipo.startswith('multipart/form-data'):
+        mensaje = email.message_from_bytes(b'Content-Type: ' + tipo.encode() + b'\r\n\r\n' + cuerpo,
+                                           policy=email.policy.HTTP)
+        params = {}
+        for parte in mensaje.iter_parts():
+            nombre = parte.get_param('name', header='content-disposition')
+            params[nombre] = '<archivo>' if parte.get_filename() else parte.get_content()
+        return params
+    if tipo.startswith('application/json'):
+        return json.loads(cuerpo or b'{}')
+    return {k: v[0] for k, v in parse_qs(cuerpo.decode('utf-8')).items()}
+
+
+def _botones(reply_markup):
+    if isinstance(reply_markup, str):
+        reply_markup = json.loads(reply_markup)
+    return [(b.get('text'), b.get('callback_data'))
+            for fila in (reply_markup or {}).get('inline_keyboard', []) for b in fila]
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        cuerpo = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        metodo = self.path.rstrip('/').rsplit('/', 1)[-1]
+        params = _leer_parametros(self.headers.get('Content-Type', ''), cuerpo)
+        status, respuesta = self.server.atender(metodo, params)
+        datos = json.dumps(respuesta).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    do_GET = do_POST
+
+
+class BotApiFalsa(ThreadingHTTPServer):
+    """Bot API en memoria. Los updates se inyectan con `encolar_update`; cada mensaje que
+    manda o edita el bot se pasa a `oyente(evento)` (desde el hilo del servidor).
+    Con `limite_por_segundo` responde 429 (RetryAfter) como Telegram al pasarse."""
+
+    daemon_threads = True
+    METODOS_ENVIO = {'sendMessage', 'sendPhoto', 'sendDocument', 'sendVideo', 'sendAnimation',
+                     'sendAudio', 'sendVoice'}
+    METODOS_EDICION = {'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption'}
+
+    def __init__(self, limite_por_segundo=0):
+        super().__init__(('127.0.0.1', 0), _Manejador)
+        self._cond = threading.Condition()
+        self._updates = []
+        self._update_id = itertools.count(1)
+        self._message_id = itertools.count(1000)
+        self._archivo_id = itertools.count(1)
+        self.limite_por_segundo = limite_por_segundo
+        self._envios = deque()
+        self.llamadas = Counter()
+        self.rechazos_flood = 0
+        self.oyente = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def encolar_update(self, update):
+        with self._cond:
+            update['update_id'] = next(self._update_id)
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limite = time.monotonic() + min(float(params.get('timeout') or 0), 10.0)
+        with self._cond:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < limite:
+                self._cond.wait(limite - time.monotonic())
+            return self._updates[:int(params.get('limit') or 100)]
+
+    def _flood(self):
+        if not self.limite_por_segundo:
+            return False
+        with self._cond:
+            ahora = time.monotonic()
+            while self._envios and self._envios[0] < ahora - 1:
+                self._envios.popleft()
+            if len(self._envios) >= self.limite_por_segundo:
+                self.rechazos_flood += 1
+                return True
+            self._envios.append(ahora)
+            return False
+
+    def _mensaje(self, metodo, params):
+        chat_id = int(params['chat_id'])
+        message_id = int(params['message_id']) if params.get('message_id') else next(self._message_id)
+        mensaje = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        texto = params.get('text') or params.get('caption')
+        if texto:
+            mensaje['text' if 'text' in params else 'caption'] = texto
+        archivo = {'file_id': f"archivo-{next(self._archivo_id)}", 'file_unique_id': f"u-{message_id}"}
+        if metodo == 'sendPhoto':
+            mensaje['photo'] = [dict(archivo, width=1, height=1)]
+        elif metodo == 'sendDocument':
+            mensaje['document'] = archivo
+        elif metodo in ('sendVideo', 'sendAnimation'):
+            mensaje[metodo[4:].lower()] = dict(archivo, width=1, height=1, duration=1)
+        elif metodo in ('sendAudio', 'sendVoice'):
+            mensaje[metodo[4:].lower()] = dict(archivo, duration=1)
+        if self.oyente:
+            self.oyente({'metodo': metodo, 'chat_id': chat_id, 'message_id': message_id, 'texto': texto or '',
+                         'botones': _botones(params.get('reply_markup')), 't': time.perf_counter()})
+        return mensaje
+
+    def atender(self, metodo, params):
+        self.llamadas[metodo] += 1
+        if metodo == 'getMe':
+            return 200, {'ok': True, 'result': BOT_USER}
+        if metodo == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if metodo in self.METODOS_ENVIO:
+            if self._flood():
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                             'parameters': {'retry_after': 1}}
+            return 200, {'ok': True, 'result': self._mensaje(metodo, params)}
+        if metodo in self.METODOS_EDICION:
+            return 200, {'ok': True, 'result': self._mensaje(metodo, params)}
+        return 200, {'ok': True, 'result': True}
+
+
+# --- Usuarios simulados ---
+FIN_COMPRA = re.compile(r'Compra exitosa|Saldo insuficiente|se agotó|No hay stock')
+FIN_COMBO = re.compile(r'Compra realizada|Saldo insuficiente|ya no hay stock|No se pudo completar|no tiene plataformas')
+
+
+def con_boton(patron):
+    patron = re.compile(patron)
+    return lambda ev: any(data and patron.search(data) for _, data in ev['botones'])
+
+
+def con_texto(patron):
+    patron = re.compile(patron) if isinstance(patron, str) else patron
+    return lambda ev: bool(patron.search(ev['texto']))
+
+
+def alguno(*condiciones):
+    return lambda ev: any(c(ev) for c in condiciones)
+
+
+def botones(ev, patron):
+    return [data for _, data in ev['botones'] if data and re.search(patron, data)]
+
+
+class Usuario:
+    def __init__(self, carga, user_id):
+        self.carga = carga
+        self.id = user_id
+        self.eventos = asyncio.Queue()
+        self.menu = None  # último mensaje con el menú principal
+
+    def _de(self):
+        return {'id': self.id, 'is_bot': False, 'first_name': f"U{self.id}"}
+
+    def _inyectar_texto(self, texto):
+        mensaje = {'message_id': next(self.carga.ids_entrantes), 'date': int(time.time()),
+                   'chat': {'id': self.id, 'type': 'private'}, 'from': self._de(), 'text': texto}
+        if texto.startswith('/'):
+            mensaje['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(texto.split()[0])}]
+        self.carga.servidor.encolar_update({'message': mensaje})
+
+    def _inyectar_boton(self, ev, data):
+        self.carga.servidor.encolar_update({'callback_query': {
+            'id': str(next(self.carga.ids_entrantes)), 'from': self._de(), 'chat_instance': str(self.id),
+            'data': data, 'message': {'message_id': ev['message_id'], 'date': int(time.time()), 'from': BOT_USER,
+                                      'chat': {'id': self.id, 'type': 'private'}, 'text': ev['texto'] or '-'}}})
+
+    async def esperar(self, condicion):
+        limite = time.monotonic() + self.carga.timeout
+        while True:
+            ev = await asyncio.wait_for(self.eventos.get(), max(0.01, limite - time.monotonic()))
+            if con_boton('^show_categories$')(ev):
+                self.menu = ev
+            if condicion(ev):
+                return ev
+
+    async def paso(self, nombre, inyectar, condicion):
+        t0 = time.perf_counter()
+        inyectar()
+        ev = await self.esperar(condicion)
+        self.carga.latencias_paso[nombre].append(time.perf_counter() - t0)
+        return ev
+
+    async def iniciar(self):
+        await self.paso('start', lambda: self._inyectar_texto('/start'), con_boton('^show_categories$'))
+
+    async def comprar_cuenta(self):
+        ev = await self.paso('categorias', lambda: self._inyectar_boton(self.menu, 'show_categories'),
+                             alguno(con_boton('^category_'), con_texto('No hay stock')))
+        categorias = botones(ev, '^category_')
+        if not categorias:
+            return 'sin stock'
+        categoria = random.choice(categorias)
+        ev = await self.paso('plataformas', lambda: self._inyectar_boton(ev, categoria),
+                             alguno(con_boton('^cp_'), con_texto('No hay stock')))
+        selecciones = botones(ev, '^cp_')
+        if not selecciones:
+            return 'sin stock'
+        seleccion = random.choice(selecciones)
+        if random.random() < self.carga.doble_click:
+            # Doble pulsación del mismo botón: dos compras que compiten por saldo y stock
+            self._inyectar_boton(ev, seleccion)
+            await self.esperar(con_texto(FIN_COMPRA))
+        ev = await self.paso('compra', lambda: self._inyectar_boton(ev, seleccion), con_texto(FIN_COMPRA))
+        return ev['texto'].split('.')[0]
+
+    async def comprar_combo(self):
+        ev = await self.paso('combos', lambda: self._inyectar_boton(self.menu, 'show_combos_menu'),
+                             alguno(con_boton('^comprar_combo_'), con_texto('No hay combos')))
+        combos = botones(ev, '^comprar_combo_')
+        if not combos:
+            return 'sin combos'
+        combo = random.choice(combos)
+        ev = await self.paso('compra combo', lambda: self._inyectar_boton(ev, combo), con_texto(FIN_COMBO))
+        # El mensaje de compra queda editado; se vuelve al menú con /start
+        await self.iniciar()
+        return ev['texto'].split('.')[0]
+
+    async def reportar(self):
+        ids = self.carga.ids_compra.get(self.id)
+        if not ids:
+            return 'sin compras'
+        await self.paso('reporte', lambda: self._inyectar_boton(self.menu, 'iniciar_reporte'),
+                        con_texto('ID de Compra'))
+        pasos = [(random.choice(ids), 'ID Validado'), ('cuenta@correo.com', 'contraseña'),
+                 ('clave', 'fecha'), ('01/01/2025', 'Describe'), ('No carga la cuenta', 'Reporte enviado')]
+        for texto, esperado in pasos:
+            await self.paso('reporte', lambda texto=texto: self._inyectar_texto(texto), con_texto(esperado))
+        await self.iniciar()
+        return 'reporte enviado'
+
+    async def correr(self, iteraciones):
+        try:
+            await self.iniciar()
+            for _ in range(iteraciones):
+                r = random.random()
+                if r < 0.7:
+                    flujo = self.comprar_cuenta
+                elif r < 0.9:
+                    flujo = self.comprar_combo
+                else:
+                    flujo = self.reportar
+                resultado = await flujo()
+                self.carga.resultados[f"{flujo.__name__}: {resultado}"] += 1
+        except asyncio.TimeoutError:
+            self.carga.resultados['timeout'] += 1
+
+
+# --- Carga ---
+RE_DESCONTADO = re.compile(r'Se descontó: \$([\d.]+)')
+RE_ID = re.compile(r'ID de Compra: `?([A-Z0-9]+)`?')
+RE_ENTREGA = re.compile(r'➡️ Plataforma: (.+)\n➡️ Correo: (.+)\n➡️ Contraseña: .*\n➡️ Perfil asignado: (.+)')
+RE_ENTREGA_COMBO = re.compile(r'• (.+?) — (.+)\n.*\n {3}Correo: `(.+?)`')
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(round(p * (len(valores) - 1))))]
+
+
+class Carga:
+    def __init__(self, args, bot, servidor):
+        self.args = args
+        self.B = bot
+        self.servidor = servidor
+        self.timeout = args.timeout
+        self.doble_click = args.doble_click
+        self.ids_entrantes = itertools.count(1)
+        self.usuarios = {}
+        self.latencias_paso = defaultdict(list)
+        self.latencias_update = []
+        self.resultados = Counter()
+        self.entregas = []  # (user_id, texto)
+        self.ids_compra = defaultdict(list)
+
+    def repartir(self, ev):
+        if 'ID de Compra' in ev['texto'] and 'Se descontó' in ev['texto']:
+            self.entregas.append((ev['chat_id'], ev['texto']))
+            encontrado = RE_ID.search(ev['texto'])
+            if encontrado:
+                self.ids_compra[ev['chat_id']].append(encontrado.group(1))
+        usuario = self.usuarios.get(ev['chat_id'])
+        if usuario:
+            usuario.eventos.put_nowait(ev)
+
+    def sembrar(self):
+        """Clientes con saldo, stock de tres plataformas y un combo."""
+        B, a = self.B, self.args
+        B.storage.guardar_clientes({USUARIO_BASE + i: float(a.saldo) for i in range(a.usuarios)})
+        filas = []
+        for i in range(a.cuentas):
+            filas.append(['Netflix', 'perfil', f"netflix{i}@prueba.com", 'clave', '35.00', '4', '1'])
+            filas.append(['Prime', 'perfil', f"prime{i}@prueba.com", 'clave', '25.00', '3', '1'])
+            filas.append(['Disney', 'completa', f"disney{i}@prueba.com", 'clave', '80.00'])
+        B.storage.save_stock(filas)
+        B.storage.guardar_combos([{'titulo': 'COMBO PRUEBA', 'subnombre': '1', 'precio': 120.0,
+                                   'plataformas': ['Netflix', 'Prime', 'Disney']}])
+        return sum(B.StockIndex._unidades(f) for f in filas)
+
+    def _medir_updates(self, application):
+        procesador = application.update_processor
+        original = procesador.do_process_update
+
+        async def medido(update, coroutine):
+            t0 = time.perf_counter()
+            try:
+                await original(update, coroutine)
+            finally:
+                self.latencias_update.append(time.perf_counter() - t0)
+
+        procesador.do_process_update = medido
+
+    async def correr(self):
+        B, a = self.B, self.args
+        unidades_iniciales = self.sembrar()
+        B.cargar_estado()
+        saldos_iniciales = dict(B.clientes)
+        loop = asyncio.get_running_loop()
+        self.servidor.oyente = lambda ev: loop.call_soon_threadsafe(self.repartir, ev)
+
+        application = B.crear_aplicacion(base_url=self.servidor.url)
+        self._medir_updates(application)
+        await application.initialize()
+        await B.iniciar_tareas_de_fondo(application)  # post_init sólo corre con run_polling/run_webhook
+        await application.updater.start_polling(poll_interval=0.0, timeout=5)
+        await application.start()
+
+        self.usuarios = {USUARIO_BASE + i: Usuario(self, USUARIO_BASE + i) for i in range(a.usuarios)}
+        t0 = time.perf_counter()
+        await asyncio.gather(*(u.correr(a.iteraciones) for u in self.usuarios.values()))
+        duracion = time.perf_counter() - t0
+        # Las entregas salen por la cola de salida: se espera a que se vacíe
+        limite = time.monotonic() + a.timeout
+        while time.monotonic() < limite and (await B.en_hilo(B.storage.salida_pendiente)):
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(0.5)
+
+        await application.updater.stop()
+        await application.stop()
+        await B.detener_tareas_de_fondo(application)
+        await application.shutdown()
+        return self.reporte(duracion, unidades_iniciales, saldos_iniciales)
+
+    def _verificar(self, unidades_iniciales, saldos_iniciales):
+        B = self.B
+        entregadas = Counter()
+        descontado = defaultdict(float)
+        for user_id, texto in self.entregas:
+            for plataforma, correo, perfil in RE_ENTREGA.findall(texto):
+                entregadas[(correo.strip(), perfil.strip())] += 1
+            for plataforma, perfil, correo in RE_ENTREGA_COMBO.findall(texto):
+                entregadas[(correo.strip(), perfil.strip())] += 1
+            encontrado = RE_DESCONTADO.search(texto)
+            if encontrado:
+                descontado[user_id] += float(encontrado.group(1))
+        repetidas = {k: n for k, n in entregadas.items() if n > 1}
+        unidades_restantes = sum(B.StockIndex._unidades(f) for f in B.storage.load_stock())
+        vendidas = len(B.storage.filas_ventas())
+        cobros_mal = {uid: (round(saldos_iniciales[uid] - B.clientes.get(uid, 0.0), 2), round(descontado[uid], 2))
+                      for uid in saldos_iniciales
+                      if abs(saldos_iniciales[uid] - B.clientes.get(uid, 0.0) - descontado[uid]) > 0.011}
+        guardados = B.storage.cargar_clientes()
+        distintos = [uid for uid, saldo in B.clientes.items() if abs(guardados.get(uid, -1) - saldo) > 0.001]
+        return {
+            'unidades_iniciales': unidades_iniciales,
+            'unidades_restantes': unidades_restantes,
+            'unidades_vendidas': vendidas,
+            'unidades_entregadas': sum(entregadas.values()),
+            'entregas_repetidas': len(repetidas),
+            'stock_cuadra': unidades_iniciales - unidades_restantes == vendidas == sum(entregadas.values()),
+            'saldos_negativos': sum(1 for s in B.clientes.values() if s < 0),
+            'cobros_que_no_cuadran': len(cobros_mal),
+            'saldos_guardados_distintos': len(distintos),
+            'mensajes_sin_enviar': len(B.storage.salida_pendiente()),
+        }
+
+    def reporte(self, duracion, unidades_iniciales, saldos_iniciales):
+        pasos = [lat for lista in self.latencias_paso.values() for lat in lista]
+        verificacion = self._verificar(unidades_iniciales, saldos_iniciales)
+        return {
+            'usuarios': self.args.usuarios,
+            'iteraciones': self.args.iteraciones,
+            'storage': self.B.storage.nombre,
+            'duracion_s': round(duracion, 3),
+            'updates': len(self.latencias_update),
+            'updates_por_s': round(len(self.latencias_update) / duracion, 1) if duracion else 0,
+            'compras_por_s': round(len(self.entregas) / duracion, 1) if duracion else 0,
+            'latencia_update_ms': {'p50': round(percentil(self.latencias_update, 0.5) * 1000, 1),
+                                   'p99': round(percentil(self.latencias_update, 0.99) * 1000, 1),
+                                   'max': round(max(self.latencias_update, default=0) * 1000, 1)},
+            'latencia_paso_ms': {'p50': round(percentil(pasos, 0.5) * 1000, 1),
+                                 'p99': round(percentil(pasos, 0.99) * 1000, 1)},
+            'latencia_por_paso_p99_ms': {n: round(percentil(v, 0.99) * 1000, 1)
+                                         for n, v in sorted(self.latencias_paso.items())},
+            'resultados': dict(self.resultados),
+            'llamadas_api': dict(self.servidor.llamadas),
+            'rechazos_flood': self.servidor.rechazos_flood,
+            'verificacion': verificacion,
+            'ok': (verificacion['entregas_repetidas'] == 0 and verificacion['stock_cuadra']
+                   and verificacion['saldos_negativos'] == 0 and verificacion['cobros_que_no_cuadran'] == 0
+                   and verificacion['saldos_guardados_distintos'] == 0 and self.resultados['timeout'] == 0),
+        }
+
+
+def imprimir(reporte):
+    v = reporte['verificacion']
+    print(f"Usuarios: {reporte['usuarios']} x {reporte['iteraciones']} iteraciones ({reporte['storage']}) "
+          f"en {reporte['duracion_s']}s")
+    print(f"Updates: {reporte['updates']} ({reporte['updates_por_s']}/s) | compras entregadas/s: {reporte['compras_por_s']}")
+    print(f"Latencia por update: p50 {reporte['latencia_update_ms']['p50']} ms | "
+          f"p99 {reporte['latencia_update_ms']['p99']} ms | máx {reporte['latencia_update_ms']['max']} ms")
+    print(f"Latencia por paso (usuario): p50 {reporte['latencia_paso_ms']['p50']} ms | p99 {reporte['latencia_paso_ms']['p99']} ms")
+    for nombre, n in sorted(reporte['resultados'].items()):
+        print(f"  {nombre}: {n}")
+    print(f"Stock: {v['unidades_iniciales']} unidades, {v['unidades_vendidas']} vendidas, "
+          f"{v['unidades_entregadas']} entregadas, {v['unidades_restantes']} restantes "
+          f"({'cuadra' if v['stock_cuadra'] else 'NO CUADRA'})")
+    print(f"Sobreventa (entregas repetidas): {v['entregas_repetidas']} | saldos negativos: {v['saldos_negativos']} | "
+          f"cobros que no cuadran: {v['cobros_que_no_cuadran']} | saldos guardados distintos: {v['saldos_guardados_distintos']}")
+    print(f"Rechazos por flood: {reporte['rechazos_flood']} | mensajes sin enviar: {v['mensajes_sin_enviar']}")
+    print("OK" if reporte['ok'] else "FALLÓ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del bot contra una Bot API falsa.")
+    parser.add_argument('--usuarios', type=int, default=50)
+    parser.add_argument('--iteraciones', type=int, default=3, help="flujos por usuario")
+    parser.add_argument('--saldo', type=float, default=300.0, help="saldo inicial de cada usuario")
+    parser.add_argument('--cuentas', type=int, default=None, help="cuentas por plataforma (por defecto usuarios/4)")
+    parser.add_argument('--doble-click', type=float, default=0.1, help="probabilidad de pulsar dos veces comprar")
+    parser.add_argument('--limite-api', type=int, default=0, help="envíos/s antes de responder 429 (0 = sin límite)")
+    parser.add_argument('--envios-por-segundo', type=float, default=None, help="sustituye ENVIOS_POR_SEGUNDO del bot")
+    parser.add_argument('--storage', choices=('csv', 'sqlite'), default='csv')
+    parser.add_argument('--timeout', type=float, default=60.0, help="espera máxima por respuesta")
+    parser.add_argument('--semilla', type=int, default=None)
+    parser.add_argument('--json', help="guarda el reporte en este archivo")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    if args.cuentas is None:
+        args.cuentas = max(5, args.usuarios // 4)
+    random.seed(args.semilla)
+
+    # El bot usa rutas relativas: se importa ya dentro del directorio temporal
+    salida_json = os.path.abspath(args.json) if args.json else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    directorio = tempfile.mkdtemp(prefix='prueba_carga_')
+    os.chdir(directorio)
+    os.environ['BOT_STORAGE'] = args.storage
+    import BotDeTelegram as bot
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    if args.envios_por_segundo:
+        bot.limitador_envios = bot.LimitadorEnvios(args.envios_por_segundo)
+
+    servidor = BotApiFalsa(args.limite_api)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    try:
+        reporte = asyncio.run(Carga(args, bot, servidor).correr())
+    finally:
+        servidor.shutdown()
+        bot._io_pool.shutdown(wait=True)
+    imprimir(reporte)
+    print(f"Datos de la prueba en {directorio}")
+    if salida_json:
+        with open(salida_json, 'w', encoding='utf-8') as f:
+            json.dump(reporte, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if reporte['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()